@@ -1,5 +1,6 @@
 import asyncio
-from typing import Dict, Union, Tuple
+import time
+from typing import Dict, List, Union, Tuple
 
 # NameType = Union[str, Tuple[str]]
 NameType = Union[str, int, Tuple[Union[str, int]]]
@@ -8,15 +9,29 @@ NameType = Union[str, int, Tuple[Union[str, int]]]
 class FuturesPool:
     """
     Manage a collection of named futures.
+
+    A named future is owned by one query (`acquire`, `acquire_timeout`), `acquire_timeout` waits for the completion
+    of a pending one instead of failing. Any number of consumers can additionally await the next result of a name
+    without owning it (`next_result`, broadcast).
     """
 
     def __init__(self):
         self._futures: Dict[str, asyncio.Future] = {}
+        self._broadcast: Dict[str, List[asyncio.Future]] = {}
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.num_acquired = 0
+        self.num_contended = 0  # acquisitions that waited for a pending future
+        self.num_acquire_timeouts = 0
+        self.num_broadcast = 0  # results delivered to next_result() consumers
+        self.wait_time_total = 0.
+        self.wait_time_max = 0.
 
     def acquire(self, name: NameType):
         if isinstance(name, tuple):
-            tuple(self.acquire(n) for n in name)
-            return FutureContext(name, pool=self)
+            contexts = tuple(self.acquire(n) for n in name)
+            return FutureContext(name, pool=self, fut=tuple(c.fut for c in contexts))
 
         assert isinstance(name, (str, int))
 
@@ -26,30 +41,67 @@ class FuturesPool:
 
         fut = asyncio.Future()
         self._futures[name] = fut
-        return FutureContext(name, pool=self)
+        self.num_acquired += 1
+        return FutureContext(name, pool=self, fut=fut)
 
     async def acquire_timeout(self, name: NameType, timeout):
         if isinstance(name, tuple):
-            await asyncio.gather(*tuple(self.acquire_timeout(n, timeout) for n in name), return_exceptions=False)
-            return FutureContext(name, pool=self)
+            # one at a time, so the names acquired so far can be released if a later one times out
+            deadline = time.time() + timeout
+            contexts = []
+            try:
+                for n in name:
+                    contexts.append(await self.acquire_timeout(n, max(0., deadline - time.time())))
+            except BaseException:
+                for c in contexts:
+                    self.remove(c.name, c.fut)
+                raise
+            return FutureContext(name, pool=self, fut=tuple(c.fut for c in contexts))
 
         assert isinstance(name, (str, int))
 
         existing = self._futures.get(name)
         if existing and not existing.done():
-            for i in range(int(timeout * 10)):
-                await asyncio.sleep(.1)
-                if existing.done():
-                    existing = None
-                    break
-            if existing:
-                raise Exception("still waiting for future named '%s'" % name)
-
+            # wait for the owner to finish (result, timeout or release), then compete for the name again
+            t0 = time.time()
+            deadline = t0 + timeout
+            while existing and not existing.done():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.num_acquire_timeouts += 1
+                    raise Exception("still waiting for future named '%s'" % name)
+                await asyncio.wait((existing,), timeout=remaining)
+                existing = self._futures.get(name)
+            dt = time.time() - t0
+            self.num_contended += 1
+            self.wait_time_total += dt
+            self.wait_time_max = max(self.wait_time_max, dt)
+
+        return self.acquire(name)
+
+    async def next_result(self, name: Union[str, int], timeout):
+        """
+        Wait for the next result of `name`, without owning it. Several consumers can wait for the same name.
+        """
         fut = asyncio.Future()
-        self._futures[name] = fut
-        return FutureContext(name, pool=self)
+        waiters = self._broadcast.setdefault(name, [])
+        waiters.append(fut)
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            raise asyncio.TimeoutError("timeout waiting for %s" % name)
+        finally:
+            if fut in waiters:
+                waiters.remove(fut)
 
     def set_result(self, name, value):
+        waiters = self._broadcast.pop(name, None)
+        if waiters:
+            for w in waiters:
+                if not w.done():
+                    w.set_result(value)
+                    self.num_broadcast += 1
+
         fut = self._futures.get(name, None)
         if fut:
             if fut.done():
@@ -62,37 +114,59 @@ class FuturesPool:
         for fut in self._futures.values():
             fut.cancel()
         self._futures.clear()
-
-    def remove(self, name):
+        for waiters in self._broadcast.values():
+            for w in waiters:
+                w.cancel()
+        self._broadcast.clear()
+
+    def remove(self, name, fut: asyncio.Future = None):
+        """
+        :param fut: only remove this future, not one acquired by the next owner in the meantime
+        """
         if isinstance(name, tuple):
-            return tuple(self.remove(n) for n in name)
+            return tuple(self.remove(n, f) for n, f in zip(name, fut or (None,) * len(name)))
         assert isinstance(name, (str, int))
-        self._futures.pop(name, None)
+        current = self._futures.get(name)
+        if current is None or (fut is not None and current is not fut):
+            return
+        del self._futures[name]
+        if not current.done():
+            # released without a result, wakes up acquire_timeout() waiters
+            current.cancel()
 
     async def wait_for(self, name: NameType, timeout):
         if isinstance(name, tuple):
             tasks = [self.wait_for(n, timeout) for n in name]
             return await asyncio.gather(*tasks, return_exceptions=False)
 
-        if name not in self._futures:
+        fut = self._futures.get(name)
+        if fut is None:
             raise KeyError('future %s not found' % name)
 
         try:
-            return await asyncio.wait_for(self._futures.get(name), timeout)
+            return await asyncio.wait_for(fut, timeout)
         except (asyncio.TimeoutError, asyncio.CancelledError):
-            self.remove(name)
             raise asyncio.TimeoutError("timeout waiting for %s" % name)
         finally:
-            self.remove(name)
+            self.remove(name, fut)
+
+    def pop_stats(self) -> dict:
+        stats = dict(acquired=self.num_acquired, contended=self.num_contended,
+                     acquire_timeouts=self.num_acquire_timeouts, broadcast=self.num_broadcast,
+                     wait_mean=round(self.wait_time_total / self.num_contended, 3) if self.num_contended else 0,
+                     wait_max=round(self.wait_time_max, 3))
+        self._reset_stats()
+        return stats
 
 
 class FutureContext:
-    def __init__(self, name: NameType, pool: FuturesPool):
+    def __init__(self, name: NameType, pool: FuturesPool, fut=None):
         self.name = name
         self.pool = pool
+        self.fut = fut
 
     def __enter__(self):
         pass
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.pool.remove(self.name)
+        self.pool.remove(self.name, self.fut)
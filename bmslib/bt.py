@@ -2,24 +2,40 @@ import asyncio
 import re
 import subprocess
 import time
-from typing import Callable, List, Union
+from typing import Any, Awaitable, Callable, List, Sequence, Set, Union, Optional
 
 import backoff
 import bleak.exc
-from bleak import BleakClient, BleakScanner
+from bleak import BleakClient
 from bleak.backends.characteristic import BleakGATTCharacteristic
 
 from . import FuturesPool
 from .bms import BmsSample, DeviceInfo
+from .connection import connection_manager
+from .gatt import GattMap
+from .scanner import get_scanner
 from .util import get_logger
 
 BleakDeviceNotFoundError = getattr(bleak.exc, 'BleakDeviceNotFoundError', bleak.exc.BleakError)
 
+SCAN_MAX_AGE = 30  # advertisements older than this don't count as "in range"
+
+_scanner_starts: Set[asyncio.Task] = set()  # keeps the tasks referenced until done
+
+# MAC address (linux) or CoreBluetooth UUID (macOS)
+_address_re = re.compile(r'^([0-9A-F]{2}:){5}[0-9A-F]{2}$|^[0-9A-F]{8}-([0-9A-F]{4}-){3}[0-9A-F]{12}$', re.IGNORECASE)
+
+
+def is_device_address(s: str) -> bool:
+    """ Whether `s` is a bluetooth device address rather than a device name """
+    return bool(_address_re.match(s.strip()))
+
 
 @backoff.on_exception(backoff.expo, Exception, max_time=10, logger=None)
-async def bt_discovery(logger):
+async def bt_discovery(logger, adapter=None, duration=5.):
+    """ Devices seen by the shared scanner (see bmslib/scanner.py), which keeps running afterwards """
     logger.info('BT Discovery:')
-    devices = await BleakScanner.discover()
+    devices = await get_scanner(adapter).discover(duration)
     if not devices:
         logger.info(' - no devices found - ')
     for d in devices:
@@ -66,6 +82,9 @@ def bt_power(on):
 class BtBms:
     shutdown = False
 
+    # commands the BMS accepts back-to-back, before the response of the previous one arrived (see _q_pipelined)
+    PIPELINE_SAFE = frozenset()
+
     def __init__(self, address: str, name: str, keep_alive=False, psk=None, adapter=None, verbose_log=False,
                  _uses_pin=False):
         self.address = address
@@ -77,16 +96,16 @@ class BtBms:
         self._psk = psk
         self._connect_time = 0
         self._pending_disconnect_call = False
+        self._meta: Optional[dict] = None
+        self._gatt: Optional[GattMap] = None
+        self._gatt_services = None  # the client's service collection the map was built from
 
         if not _uses_pin and psk:
             self.logger.warning('%s usually does not use a pairing PIN', type(self).__name__)
 
         if address.startswith('test_'):
-            from bmslib.models.dummy import BleakDummyClient
-            self.client = BleakDummyClient(address, disconnected_callback=self._on_disconnect)
             self._adapter = "fake"
         else:
-            kwargs = {}
             if psk:
                 try:
                     import bleak.backends.bluezdbus.agent
@@ -99,13 +118,6 @@ class BtBms:
             self._adapter = adapter
             if adapter:  # hci0, hci1 (BT adapter hardware)
                 self.logger.info('Using adapter %s', adapter)
-                kwargs['adapter'] = adapter
-
-            self.client = BleakClient(address,
-                                      handle_pairing=bool(psk),
-                                      disconnected_callback=self._on_disconnect,
-                                      **kwargs
-                                      )
 
             self._in_disconnect = False
 
@@ -115,10 +127,78 @@ class BtBms:
             """
             self._pending_disconnect_call = False
 
+        self.client = self._create_client()
+
+    def _create_client(self):
+        if self.address.startswith('test_'):
+            from bmslib.models.dummy import BleakDummyClient
+            return BleakDummyClient(self.address, disconnected_callback=self._on_disconnect)
+
+        kwargs = {}
+        if self._adapter:  # hci0, hci1 (BT adapter hardware)
+            kwargs['adapter'] = self._adapter
+
+        return BleakClient(self.address,
+                           handle_pairing=bool(self._psk),
+                           disconnected_callback=self._on_disconnect,
+                           **kwargs
+                           )
+
+    async def recreate_client(self):
+        """
+        Disconnect and replace the BleakClient with a fresh instance. Recovers from bleak/BlueZ states a
+        plain reconnect doesn't get out of.
+        """
+        self.logger.warning('%s recreating bleak client', self.name)
+        try:
+            await asyncio.wait_for(self.disconnect(), timeout=10)
+        except Exception as e:
+            self.logger.info('%s disconnect before recreating client: %s', self.name, e)
+        self._fetch_futures.clear()
+        self._pending_disconnect_call = False
+        self._gatt_services = None
+        self.client = self._create_client()
+        self.circuit_breaker.reset()
+
     @property
     def connect_time(self):
         return self._connect_time
 
+    @property
+    def adapter(self) -> str:
+        """ Name of the bluetooth adapter used by this device, `default` if not configured """
+        return self._adapter or 'default'
+
+    @property
+    def circuit_breaker(self):
+        return connection_manager.breaker(self)
+
+    @property
+    def meta(self) -> dict:
+        """
+        Device metadata persisted across restarts (characteristic handles, num_cells, device info, firmware flags).
+        Drivers use it to skip queries on connect and re-validate the values once the device responds.
+        """
+        if self._meta is None:
+            from bmslib.store import load_device_meta
+            self._meta = load_device_meta(self.address)
+        return self._meta
+
+    def update_meta(self, **meta):
+        if all(self.meta.get(k) == v for k, v in meta.items()):
+            return
+        self.logger.info('%s update device meta %s', self.name, meta)
+        self._meta.update(meta)
+        try:
+            from bmslib.store import store_device_meta
+            store_device_meta(self.address, **meta)
+        except Exception as e:
+            self.logger.warning('%s error storing device meta: %s', self.name, e)
+
+    def cached_device_info(self) -> Optional[DeviceInfo]:
+        di = self.meta.get('device_info')
+        return DeviceInfo(**di) if di else None
+
     async def start_notify(self, char_specifier, callback: Callable[[int, bytearray], None], **kwargs):
         """
         This function wraps BleakClient.start_notify, differences:
@@ -145,19 +225,42 @@ class BtBms:
         await enumerate_services(self.client, self.logger)
         raise exception
 
+    @property
+    def gatt(self) -> GattMap:
+        """
+        Indexed characteristic map. Rebuilt when the client discovered (new) services, otherwise the map persisted
+        in the device meta.
+        """
+        try:
+            services = self.client.services
+        except Exception:  # bleak.exc.BleakError: Service Discovery has not been performed yet
+            services = None
+        if services:
+            if services is not self._gatt_services:
+                self._gatt = GattMap.from_services(services)
+                self._gatt_services = services
+                self.update_meta(gatt=self._gatt.to_meta())
+        elif self._gatt is None:
+            self._gatt = GattMap.from_meta(self.meta.get('gatt') or [])
+        return self._gatt
+
+    async def refresh_gatt(self):
+        """ Re-run service discovery, only needed if the map turned out to be invalid """
+        get_services = getattr(self.client, 'get_services', None)  # removed in bleak 0.21
+        if get_services:
+            await get_services()
+        self._gatt_services = None
+
     def find_char(self, uuid_or_handle: Union[str, int], property_name: str, service=None) -> Union[
-        None, BleakGATTCharacteristic]:
-        for service in ((service,) if service else self.client.services):
-            for char in service.characteristics:
-                if (char.uuid == uuid_or_handle or char.handle == uuid_or_handle) and property_name in char.properties:
-                    return char if char.__hash__ else char.uuid
-        return None
+        None, int, BleakGATTCharacteristic]:
+        char = self.gatt.find(uuid_or_handle, property_name, service=service)
+        return char.specifier() if char else None
 
     def get_service(self, uuid):
-        for s in self.client.services:
-            if s.uuid.startswith(uuid):
-                return s
-        raise RuntimeError("service %s not found (have %s)", uuid, list(s.uuid for s in self.client.services))
+        s = self.gatt.service(uuid)
+        if s is None:
+            raise RuntimeError("service %s not found (have %s)" % (uuid, self.gatt.service_uuids))
+        return s
 
     def _on_disconnect(self, _client):
         if self.keep_alive and self._connect_time:
@@ -183,10 +286,16 @@ class BtBms:
                              self._adapter or "default", timeout)
         # bleak`s connect timeout is buggy (on macos)
         try:
-            await asyncio.wait_for(self.client.connect(timeout=timeout), timeout=timeout + 1)
+            # one connect at a time per adapter, the timeout starts when it's our turn
+            async with connection_manager.arbiter(self.adapter).turn():
+                await asyncio.wait_for(self.client.connect(timeout=timeout), timeout=timeout + 1)
         except getattr(bleak.exc, 'BleakDeviceNotFoundError', bleak.exc.BleakError) as exc:
-            self.logger.error("%s, starting scanner", exc)
-            await bt_discovery(self.logger)
+            scanner = get_scanner(self._adapter)
+            self.logger.error("%s, last advertisement: %s", exc, scanner.get(self.address))
+            if not scanner.running:
+                task = asyncio.ensure_future(self._start_scanner(scanner))
+                _scanner_starts.add(task)
+                task.add_done_callback(_scanner_starts.discard)
             raise
 
         self._connect_time = time.time()
@@ -252,22 +361,21 @@ class BtBms:
         if BtBms.shutdown:
             raise RuntimeError("in shutdown")
 
-        import bleak
-        scanner_kw = {}
-        if self._adapter:
-            scanner_kw['adapter'] = self._adapter
-        scanner = bleak.BleakScanner(**scanner_kw)
-        self.logger.debug("starting scan")
+        scanner = get_scanner(self._adapter)
         await scanner.start()
 
         attempt = 1
         while True:
             try:
-                discovered = set(b.address for b in scanner.discovered_devices)
-                if self.client.address not in discovered:
+                # the shared scanner keeps running, a recent advertisement lets us connect right away
+                adv = scanner.get(self.client.address, max_age=SCAN_MAX_AGE) or \
+                    await scanner.wait_for(self.client.address, timeout=0.2 * (1.5 ** attempt),
+                                           since=time.time() - SCAN_MAX_AGE)
+                if adv is None:
                     raise BleakDeviceNotFoundError(
                         self.client.address, 'Device %s not discovered. Make sure it in range and is not being '
-                                             'accessed by another app. (found %s)' % (self.client.address, discovered))
+                                             'accessed by another app. (found %d devices)' % (
+                                                 self.client.address, len(scanner.advertisements)))
 
                 self.logger.debug("connect attempt %d", attempt)
                 await self._connect_client(timeout=timeout / 2)
@@ -279,10 +387,13 @@ class BtBms:
                     await asyncio.sleep(0.2 * (1.5 ** attempt))
                     attempt += 1
                 else:
-                    await scanner.stop()
                     raise
 
-        await scanner.stop()
+    async def _start_scanner(self, scanner):
+        try:
+            await scanner.start()
+        except Exception as e:
+            self.logger.warning('Error starting scanner: %s', e)
 
     async def disconnect(self):
         self._in_disconnect = True
@@ -290,6 +401,32 @@ class BtBms:
         self._in_disconnect = False
         self._fetch_futures.clear()
 
+    async def _q_pipelined(self, commands: Sequence, write: Callable[[Any], Awaitable], timeout) -> list:
+        """
+        Write several commands back-to-back and await their responses as they arrive, matched by command (the name
+        the notification handler passes to `_fetch_futures.set_result`). Consecutive commands in `PIPELINE_SAFE` are
+        pipelined, others are queried one at a time. A pipelined run holds each command once only, the responses
+        of a repeated command couldn't be told apart.
+        :param write: writes a command
+        :return: responses in the order of `commands`
+        """
+        responses = []
+        i = 0
+        while i < len(commands):
+            batch = [commands[i]]
+            if commands[i] in self.PIPELINE_SAFE:
+                for cmd in commands[i + 1:]:
+                    if cmd not in self.PIPELINE_SAFE or cmd in batch:
+                        break
+                    batch.append(cmd)
+            names = tuple(batch)
+            with await self._fetch_futures.acquire_timeout(names, timeout=timeout / 2):
+                for cmd in batch:
+                    await write(cmd)
+                responses += await self._fetch_futures.wait_for(names, timeout)
+            i += len(batch)
+        return responses
+
     async def fetch_device_info(self) -> DeviceInfo:
         """
         Retrieve static BMS device info (HW, SW version, serial number, etc)
@@ -321,10 +458,20 @@ class BtBms:
         raise NotImplementedError()
 
     async def subscribe(self, callback: Callable[[BmsSample], None]):
-        raise NotImplemented()
+        """
+        Call `callback` with each sample the BMS streams while connected (push mode, see BmsSampler.enable_push).
+        Drivers without a stream don't implement this and are polled with fetch().
+        :param callback: called on the event loop with the decoded sample
+        """
+        raise NotImplementedError()
+
+    @property
+    def supports_push(self) -> bool:
+        # streams only run while connected
+        return type(self).subscribe is not BtBms.subscribe and self.keep_alive
 
     async def subscribe_voltages(self, callback: Callable[[List[int]], None]):
-        raise NotImplemented()
+        raise NotImplementedError()
 
     async def set_switch(self, switch: str, state: bool):
         """
@@ -340,12 +487,30 @@ class BtBms:
 
     async def __aenter__(self):
         # print("enter")
+        breaker = self.circuit_breaker
+        if not self.is_connected:
+            breaker.check(self.name)  # don't queue connects (or evict others) for an unreachable device
+        slots = connection_manager.get(self.adapter)
+        if slots:
+            # might disconnect an idle device to free a connection slot
+            await slots.acquire(self)
         if self.keep_alive and self.is_connected:
             return
-        await self.connect()
+        t_connect = time.time()
+        try:
+            await self.connect()
+        except BaseException as e:
+            slots and slots.release(self)
+            if isinstance(e, Exception):
+                breaker.failure(self.name)
+            raise
+        breaker.success()
+        slots and slots.connected(self, time.time() - t_connect)
 
     async def __aexit__(self, *args):
         # print("exit")
+        slots = connection_manager.get(self.adapter)
+        slots and slots.release(self)
         if self.keep_alive:
             return
         if self.client.is_connected:
@@ -362,6 +527,10 @@ class BtBms:
     def debug_data(self):
         return None
 
+    def pop_response_stats(self) -> dict:
+        """ Response wait metrics since the last call (see FuturesPool.pop_stats) """
+        return self._fetch_futures.pop_stats()
+
 
 # noinspection DuplicatedCode
 async def enumerate_services(client: BleakClient, logger):
@@ -1,7 +1,5 @@
 from typing import Callable
 
-import pandas as pd
-
 import os
 import pickle
 import random
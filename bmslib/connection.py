@@ -0,0 +1,294 @@
+"""
+Connection slot manager.
+
+BlueZ and most USB dongles only hold a handful of simultaneous LE connections. With `connection_slots` set, each
+adapter keeps at most that many devices connected. When a device needs to connect and all slots are taken, an idle
+connection (not inside `async with bms`) is closed: the one of least value (poll rate) and, among equal ones, the most
+recently connected. So the most frequently polled devices (and the first ones connected) stay connected and the rest
+rotates through the remaining slot(s).
+
+Independent of the slots, BlueZ runs only one LE connect at a time per adapter. The `ConnectArbiter` queues connect
+attempts per adapter (reads on connected devices are not affected), and a `CircuitBreaker` per device stops connecting
+to a device that failed repeatedly, it is only probed at a low rate until a connect succeeds again.
+
+"""
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Tuple, Optional
+
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+RATE_SMOOTHING = .2  # EWMA weight of the last poll interval
+
+CIRCUIT_FAILURE_THRESHOLD = 5  # consecutive failed connects that open the circuit
+CIRCUIT_PROBE_INTERVAL = 60.  # first probe after opening, doubles with each failed probe
+CIRCUIT_MAX_PROBE_INTERVAL = 600.
+
+
+class _Slot:
+    def __init__(self, bms):
+        self.bms = bms
+        self.in_use = 0
+        self.connecting = False
+        self.evicting = False
+        self.t_used = 0.
+        self.t_connected = 0.
+        self.rate = 0.  # polls per second (EWMA)
+
+    def value(self) -> int:
+        # the poll rate in powers of 2, so jitter doesn't reorder devices with the same sample period
+        return round(math.log2(self.rate)) if self.rate > 0 else -1000
+
+    def occupies(self) -> bool:
+        return self.connecting or self.bms.is_connected
+
+
+class AdapterSlots:
+    def __init__(self, adapter: str, num_slots: int):
+        self.adapter = adapter
+        self.num_slots = num_slots
+        self.slots: Dict[object, _Slot] = {}
+        self._released = asyncio.Event()
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+        self.connect_time_sum = 0.
+        self.num_connects = 0
+
+    def _slot(self, bms) -> _Slot:
+        slot = self.slots.get(bms)
+        if slot is None:
+            slot = self.slots[bms] = _Slot(bms)
+        return slot
+
+    async def acquire(self, bms):
+        """ Returns when `bms` is connected or may connect """
+        slot = self._slot(bms)
+        now = time.time()
+        if slot.t_used:
+            dt = max(now - slot.t_used, 1e-3)
+            slot.rate = 1 / dt if not slot.rate else (1 - RATE_SMOOTHING) * slot.rate + RATE_SMOOTHING / dt
+        slot.t_used = now
+        slot.in_use += 1
+
+        if bms.is_connected:
+            self.num_hits += 1
+            return
+        self.num_misses += 1
+
+        try:
+            while True:
+                occupied = [s for s in self.slots.values() if s is not slot and s.occupies()]
+                if len(occupied) < self.num_slots:
+                    break
+                idle = [s for s in occupied if not s.in_use and not s.connecting and not s.evicting]
+                if idle:
+                    victim = min(idle, key=lambda s: (s.value(), -s.t_connected))
+                    await self._evict(victim, bms)
+                    continue
+                # all slots busy, wait for one to be released (external disconnects don't signal, poll)
+                self._released.clear()
+                try:
+                    await asyncio.wait_for(self._released.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            slot.in_use -= 1
+            raise
+
+        slot.connecting = True
+
+    async def _evict(self, victim: _Slot, for_bms):
+        victim.evicting = True
+        self.num_evictions += 1
+        logger.debug('%s: disconnect %s to free a connection slot for %s', self.adapter, victim.bms.name,
+                     for_bms.name)
+        try:
+            await victim.bms.disconnect()
+        except Exception as e:
+            logger.warning('%s: error disconnecting %s: %s', self.adapter, victim.bms.name, e)
+        finally:
+            victim.evicting = False
+
+    def connected(self, bms, connect_time: float):
+        slot = self._slot(bms)
+        if slot.connecting:
+            slot.connecting = False
+            slot.t_connected = time.time()
+            self.num_connects += 1
+            self.connect_time_sum += connect_time
+
+    def release(self, bms):
+        slot = self._slot(bms)
+        slot.connecting = False
+        slot.in_use = max(0, slot.in_use - 1)
+        self._released.set()
+
+    def forget(self, bms):
+        if self.slots.pop(bms, None):
+            self._released.set()
+
+    def stats(self) -> dict:
+        return dict(slots=self.num_slots, connected=sum(s.bms.is_connected for s in self.slots.values()),
+                    hit_rate=round(self.num_hits / max(1, self.num_hits + self.num_misses), 3),
+                    evictions=self.num_evictions,
+                    connect_time_mean=round(self.connect_time_sum / self.num_connects, 2) if self.num_connects
+                    else None)
+
+
+class CircuitOpenError(Exception):
+    """ Connecting was skipped, the device failed too often and the next probe is not due yet """
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__('%s unreachable, circuit open, next connect probe in %.0fs' % (name, retry_in))
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, probe_interval=CIRCUIT_PROBE_INTERVAL,
+                 max_probe_interval=CIRCUIT_MAX_PROBE_INTERVAL):
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.max_probe_interval = max_probe_interval
+        self.num_failures = 0  # consecutive
+        self.num_opened = 0
+        self.interval = probe_interval
+        self.t_next_probe = 0.
+
+    @property
+    def is_open(self) -> bool:
+        return self.num_failures >= self.failure_threshold
+
+    def check(self, name: str):
+        """ Raises `CircuitOpenError` if the device should not connect now """
+        if self.is_open:
+            retry_in = self.t_next_probe - time.time()
+            if retry_in > 0:
+                raise CircuitOpenError(name, retry_in)
+
+    def success(self):
+        self.num_failures = 0
+        self.interval = self.probe_interval
+
+    def failure(self, name: str):
+        self.num_failures += 1
+        if not self.is_open:
+            return
+        if self.num_failures == self.failure_threshold:
+            self.num_opened += 1
+            logger.warning('%s failed to connect %d times, probing every %.0fs', name, self.num_failures,
+                           self.interval)
+        else:
+            self.interval = min(self.interval * 2, self.max_probe_interval)
+        self.t_next_probe = time.time() + self.interval
+
+    def probe_now(self):
+        """ Allow the next connect (e.g. when the device advertised again) """
+        self.t_next_probe = 0.
+
+    def reset(self):
+        """ Close the circuit, e.g. after a recovery action: the device gets a fresh series of connect attempts """
+        self.success()
+        self.t_next_probe = 0.
+
+
+class ConnectArbiter:
+    """ Serializes connect attempts on an adapter, in arrival order """
+
+    def __init__(self, adapter: str):
+        self.adapter = adapter
+        self._lock = asyncio.Lock()
+        self.num_waiting = 0
+        self.num_connects = 0
+        self.wait_sum = 0.
+        self.wait_max = 0.
+
+    @asynccontextmanager
+    async def turn(self):
+        t_wait = time.time()
+        self.num_waiting += 1
+        try:
+            await self._lock.acquire()
+        finally:
+            self.num_waiting -= 1
+        try:
+            dt = time.time() - t_wait
+            self.num_connects += 1
+            self.wait_sum += dt
+            self.wait_max = max(self.wait_max, dt)
+            yield
+        finally:
+            self._lock.release()
+
+    def stats(self) -> dict:
+        return dict(connect_attempts=self.num_connects,
+                    connect_wait_mean=round(self.wait_sum / self.num_connects, 2) if self.num_connects else None,
+                    connect_wait_max=round(self.wait_max, 2))
+
+
+class ConnectionManager:
+    """
+    Connect arbiters and circuit breakers for all adapters and devices, connection slots by adapter (adapters without
+    a slot count are not managed)
+    """
+
+    def __init__(self):
+        self.limits: Dict[str, int] = {}
+        self.default = 0
+        self.adapters: Dict[str, AdapterSlots] = {}
+        self.arbiters: Dict[str, ConnectArbiter] = {}
+        self.breakers: Dict[object, CircuitBreaker] = {}
+
+    def configure(self, limits: Tuple[Dict[str, int], int]):
+        """ :param limits: as returned by `parse_adapter_limits()` """
+        self.limits, self.default = limits
+        self.adapters.clear()
+
+    def get(self, adapter: str) -> Optional[AdapterSlots]:
+        slots = self.adapters.get(adapter)
+        if slots is None:
+            n = self.limits.get(adapter, self.default)
+            if not n:
+                return None
+            slots = self.adapters[adapter] = AdapterSlots(adapter, n)
+        return slots
+
+    def arbiter(self, adapter: str) -> ConnectArbiter:
+        arbiter = self.arbiters.get(adapter)
+        if arbiter is None:
+            arbiter = self.arbiters[adapter] = ConnectArbiter(adapter)
+        return arbiter
+
+    def breaker(self, bms) -> CircuitBreaker:
+        breaker = self.breakers.get(bms)
+        if breaker is None:
+            breaker = self.breakers[bms] = CircuitBreaker()
+        return breaker
+
+    def reset_breakers(self):
+        """ Close all circuits, e.g. after an adapter power cycle """
+        for breaker in self.breakers.values():
+            breaker.reset()
+
+    def forget(self, bms):
+        """ Drop the circuit breaker and connection slot of a removed device """
+        self.breakers.pop(bms, None)
+        for slots in self.adapters.values():
+            slots.forget(bms)
+
+    def stats(self) -> Dict[str, dict]:
+        stats = {adapter: arbiter.stats() for adapter, arbiter in self.arbiters.items()}
+        for adapter, slots in self.adapters.items():
+            stats.setdefault(adapter, {}).update(slots.stats())
+        for bms, breaker in self.breakers.items():
+            s = stats.setdefault(bms.adapter, {})
+            s['open_circuits'] = s.get('open_circuits', 0) + breaker.is_open
+        return stats
+
+
+connection_manager = ConnectionManager()
@@ -0,0 +1,139 @@
+"""
+Frame reassembly for BMS notification streams.
+
+BMS responses arrive in notification fragments (20-240 bytes, depending on the MTU). `FrameReassembler` collects
+them in a preallocated buffer, finds frame boundaries by header, length field and/or terminator, checks the CRC and
+hands each complete frame to the decoder as a `memoryview` into the buffer, without copying. On garbage or a failed
+CRC it re-synchronizes on the next header.
+
+The view is only valid during the `on_frame` call, the buffer is reused for the next fragments. Decoders that keep
+a frame (e.g. for a waiting `fetch()`) copy it with `bytes()`/`bytearray()`.
+
+"""
+from typing import Callable, Optional, Union
+
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+LengthType = Union[int, Callable[[memoryview], Optional[int]], None]
+
+
+class FrameReassembler:
+    def __init__(self, on_frame: Callable[[memoryview], None], header: bytes = b'', length: LengthType = None,
+                 terminator: bytes = b'', crc: Optional[Callable[[memoryview], bool]] = None, max_frame=512,
+                 name=''):
+        """
+        :param on_frame: called with a view of each complete frame (header to terminator)
+        :param header: start of a frame, frames are searched for it (re-synchronization)
+        :param length: fixed frame length, or a function returning the length from the frame start once enough bytes
+                       arrived (None if not yet). Without a length a frame ends at the first terminator, or without a
+                       header when a fragment ends with the terminator.
+        :param terminator: end of a frame, checked if a length is given
+        :param crc: returns whether the frame checksum is valid
+        :param max_frame: longest frame expected, the buffer holds 2 of them
+        """
+        assert length or terminator, "need a length or a terminator to find the end of a frame"
+        self.on_frame = on_frame
+        self.header = header
+        self.length = length
+        self.terminator = terminator
+        self.crc = crc
+        self.name = name
+
+        self._buf = bytearray(2 * max_frame)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+        self.num_frames = 0
+        self.num_crc_errors = 0
+        self.num_resyncs = 0  # bytes skipped to find the next header
+        self.num_discarded = 0  # bytes discarded (garbage, bad frames, overflow)
+
+    def reset(self):
+        """ Drop a partial frame, e.g. on reconnect """
+        self._start = self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def feed(self, data: Union[bytes, bytearray, memoryview]):
+        n = len(data)
+        if self._end + n > len(self._buf):
+            self._compact()
+            if self._end + n > len(self._buf):
+                logger.warning('%s frame buffer overflow, discarding %d bytes', self.name, self._end)
+                self.num_discarded += self._end
+                self._start = self._end = 0
+                if n > len(self._buf):
+                    self.num_discarded += n - len(self._buf)
+                    data = data[n - len(self._buf):]
+                    n = len(data)
+        self._buf[self._end:self._end + n] = data
+        self._end += n
+        self._parse()
+
+    def _compact(self):
+        if self._start:
+            n = self._end - self._start
+            self._buf[:n] = bytes(self._view[self._start:self._end])  # regions may overlap
+            self._start, self._end = 0, n
+
+    def _skip(self, n: int, resync: bool):
+        self._start += n
+        self.num_discarded += n
+        if resync:
+            self.num_resyncs += 1
+
+    def _parse(self):
+        buf, view = self._buf, self._view
+        while self._start < self._end:
+            start, end = self._start, self._end
+
+            if self.header:
+                i = buf.find(self.header, start, end)
+                if i < 0:
+                    # keep what might be the beginning of a header
+                    keep = len(self.header) - 1
+                    if end - start > keep:
+                        self._skip(end - start - keep, resync=True)
+                    break
+                if i > start:
+                    self._skip(i - start, resync=True)
+                    start = i
+
+            if self.length:
+                n = self.length if isinstance(self.length, int) else self.length(view[start:end])
+                if n is None or end - start < n:
+                    break
+            elif self.header:
+                t = buf.find(self.terminator, start + len(self.header), end)
+                if t < 0:
+                    break
+                n = t + len(self.terminator) - start
+            else:
+                # no framing but the terminator, a frame is complete when a fragment ends with it
+                if not buf.endswith(self.terminator, start, end):
+                    break
+                n = end - start
+
+            frame = view[start:start + n]
+            if (self.terminator and self.length and not buf.endswith(self.terminator, start, start + n)) or \
+                    (self.crc and not self.crc(frame)):
+                self.num_crc_errors += 1
+                logger.debug('%s bad frame %s', self.name, bytes(frame).hex())
+                # not a frame, look for the next header after this one
+                self._skip(len(self.header) or n, resync=False)
+                continue
+
+            self._start = start + n
+            self.num_frames += 1
+            self.on_frame(frame)
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def stats(self) -> dict:
+        return dict(frames=self.num_frames, crc_errors=self.num_crc_errors, resyncs=self.num_resyncs,
+                    discarded=self.num_discarded)
@@ -0,0 +1,91 @@
+"""
+Indexed GATT characteristic map.
+
+Built once per connection from the discovered services and indexed by (uuid, property) and by handle, so drivers
+resolve characteristics without scanning all services. The map is persisted with the device meta (`gatt`); before
+services are discovered (or if the backend doesn't expose them) drivers resolve handles from the stored map.
+
+"""
+from typing import Dict, List, Optional, Tuple, Union
+
+
+def _properties(props) -> Tuple[str, ...]:
+    # bleak has a list, the dummy client a comma separated string
+    return tuple(props.split(',')) if isinstance(props, str) else tuple(props)
+
+
+class GattChar:
+    __slots__ = ('service_uuid', 'handle', 'uuid', 'properties', 'char')
+
+    def __init__(self, service_uuid: str, handle: int, uuid: str, properties, char=None):
+        self.service_uuid = service_uuid
+        self.handle = handle
+        self.uuid = uuid
+        self.properties = _properties(properties)
+        self.char = char  # BleakGATTCharacteristic, None if loaded from meta
+
+    def specifier(self):
+        """ What to pass to read_gatt_char, write_gatt_char and start_notify """
+        return self.handle if self.char is None else self.char
+
+    def __repr__(self):
+        return 'GattChar(%s,handle=%s,%s)' % (self.uuid, self.handle, ','.join(self.properties))
+
+
+class GattMap:
+    def __init__(self, chars: List[GattChar], services: Dict[str, object] = None):
+        """
+        :param chars: characteristics in discovery order
+        :param services: service objects by uuid (None if loaded from meta)
+        """
+        self.chars = chars
+        self.discovered = services is not None
+        self._services = services or {c.service_uuid: c.service_uuid for c in chars}
+        self._by_handle: Dict[int, GattChar] = {}
+        self._by_uuid: Dict[Tuple[str, str], List[GattChar]] = {}
+        for c in chars:
+            self._by_handle.setdefault(c.handle, c)
+            for p in c.properties:
+                self._by_uuid.setdefault((c.uuid, p), []).append(c)
+
+    @classmethod
+    def from_services(cls, services) -> 'GattMap':
+        chars = [GattChar(s.uuid, c.handle, c.uuid, c.properties, char=c)
+                 for s in services for c in s.characteristics]
+        return cls(chars, {s.uuid: s for s in services})
+
+    @classmethod
+    def from_meta(cls, entries: list) -> 'GattMap':
+        return cls([GattChar(*e) for e in entries])
+
+    def to_meta(self) -> list:
+        return [[c.service_uuid, c.handle, c.uuid, list(c.properties)] for c in self.chars]
+
+    def find(self, uuid_or_handle: Union[str, int], property_name: str, service=None) -> Optional[GattChar]:
+        """
+        :param service: service object or uuid to restrict the search to
+        """
+        service_uuid = getattr(service, 'uuid', service)
+        if isinstance(uuid_or_handle, int):
+            c = self._by_handle.get(uuid_or_handle)
+            candidates = [c] if c and property_name in c.properties else []
+        else:
+            candidates = self._by_uuid.get((uuid_or_handle, property_name), [])
+        for c in candidates:
+            if service_uuid is None or c.service_uuid == service_uuid:
+                return c
+        return None
+
+    def service(self, uuid: str):
+        """ Service object (or uuid, if loaded from meta) by uuid or uuid prefix """
+        s = self._services.get(uuid)
+        if s is None:
+            s = next((s for u, s in self._services.items() if u.startswith(uuid)), None)
+        return s
+
+    @property
+    def service_uuids(self) -> List[str]:
+        return list(self._services.keys())
+
+    def __len__(self):
+        return len(self.chars)
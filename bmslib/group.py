@@ -122,6 +122,9 @@ class VirtualGroupBms:
     async def fetch_device_info(self):
         raise NotImplementedError()
 
+    def cached_device_info(self):
+        return None
+
 
 def is_finite(x):
     return x is not None and math.isfinite(x)
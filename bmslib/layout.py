@@ -0,0 +1,108 @@
+"""
+Declarative binary frame layouts.
+
+Drivers declare the fields of a response frame (offset, struct type, scale, n/a sentinel) once. A `Layout` compiles
+them into a single `struct.Struct` (gaps become pad bytes), so decoding a frame is one `unpack_from` call instead of a
+slice and `int.from_bytes` per field. Firmware variants that shift a block of fields (e.g. JK's 32-cell frame) decode
+the same layout at a `base` offset or declare a `variant()` with a few fields replaced.
+
+`CellArray` decodes runs of equally typed values (cell voltages, temperatures) into an `array.array`.
+
+"""
+import math
+import struct
+import sys
+from array import array
+from typing import Dict, NamedTuple, Optional, Union
+
+
+class Field(NamedTuple):
+    offset: int
+    fmt: str  # struct format character, e.g. 'H' (uint16), 'h' (int16), 'I', 'i', 'B'
+    scale: Optional[float] = None  # raw value is multiplied by this, None keeps the integer
+    nan: Optional[int] = None  # raw value meaning "not available", decoded as nan
+    bias: int = 0  # added to the raw value before scaling
+
+
+class Layout:
+    def __init__(self, byteorder: str, fields: Dict[str, Union[Field, tuple]]):
+        """
+        :param byteorder: '<' little endian, '>' big endian
+        :param fields: name -> Field(offset, fmt, scale, nan, bias)
+        """
+        self.byteorder = byteorder
+        self.fields = {name: Field(*f) for name, f in fields.items()}
+
+        ordered = sorted(self.fields.items(), key=lambda kv: kv[1].offset)
+        self.start = ordered[0][1].offset
+        fmt, pos = byteorder, self.start
+        for name, f in ordered:
+            if f.offset < pos:
+                raise ValueError("field %s at %d overlaps the previous field" % (name, f.offset))
+            fmt += ('%dx' % (f.offset - pos) if f.offset > pos else '') + f.fmt
+            pos = f.offset + struct.calcsize(byteorder + f.fmt)
+
+        self._struct = struct.Struct(fmt)
+        self.end = pos  # frame must be at least base + end long
+        self.names = tuple(name for name, _ in ordered)
+        self._convert = tuple((_divisor(f.scale), f.nan, f.bias) for _, f in ordered)
+        self._raw = all(c == (None, None, 0) for c in self._convert)
+
+    def variant(self, **fields: Union[Field, tuple, None]) -> 'Layout':
+        """ Copy with fields replaced, added or removed (None) """
+        merged = dict(self.fields)
+        for name, f in fields.items():
+            if f is None:
+                merged.pop(name, None)
+            else:
+                merged[name] = f
+        return Layout(self.byteorder, merged)
+
+    def unpack(self, buf, base=0) -> tuple:
+        """ Raw values in the order of `names` """
+        return self._struct.unpack_from(buf, base + self.start)
+
+    def decode(self, buf, base=0) -> Dict[str, Union[int, float]]:
+        """
+        :param buf: frame (bytes, bytearray or memoryview)
+        :param base: offset added to all fields, for variants that shift the whole layout
+        """
+        raw = self._struct.unpack_from(buf, base + self.start)
+        if self._raw:
+            return dict(zip(self.names, raw))
+        return {name: _convert(v, c) for name, v, c in zip(self.names, raw, self._convert)}
+
+
+def _divisor(scale: Optional[float]):
+    # decimal scales are applied as a division, so 2640 * .01 decodes to 26.4 and not 26.400000000000002
+    if scale is None:
+        return None
+    div = round(1 / scale)
+    return div if div and abs(div * scale - 1) < 1e-9 else 1 / scale
+
+
+def _convert(v, c):
+    div, nan, bias = c
+    if nan is not None and v == nan:
+        return math.nan
+    if bias:
+        v += bias
+    return v if div is None else v / div
+
+
+class CellArray:
+    def __init__(self, byteorder: str, typecode: str = 'H'):
+        """
+        :param byteorder: '<' little endian, '>' big endian
+        :param typecode: array typecode ('H' uint16, 'h' int16, ...)
+        """
+        self.typecode = typecode
+        self.itemsize = array(typecode).itemsize
+        self._swap = (byteorder == '<') != (sys.byteorder == 'little')
+
+    def decode(self, buf, offset: int, count: int) -> array:
+        a = array(self.typecode)
+        a.frombytes(buf[offset:offset + count * self.itemsize])
+        if self._swap:
+            a.byteswap()
+        return a
@@ -0,0 +1,113 @@
+"""
+Event loop lag monitor.
+
+A heartbeat coroutine on the event loop updates a timestamp every `interval` seconds and records how late it woke up
+(the loop lag). A thread checks the heartbeat: when the loop hasn't beaten for longer than `dump_threshold` it logs the
+stack of the loop thread (the synchronous call that is blocking the loop) and the stacks of all tasks.
+Synchronous calls that block the loop (file writes, InfluxDB flushes, subprocesses) show up as lag spikes long before
+a dead-lock is detected by the publish watchdog.
+
+"""
+import asyncio
+import math
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Optional
+
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+
+def percentile(sorted_values, p: float):
+    if not sorted_values:
+        return math.nan
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+class LoopMonitor:
+
+    def __init__(self, interval=.5, dump_threshold=2., dump_min_interval=60., window=3000):
+        """
+        :param interval: heartbeat period, lag is measured as the overshoot of its sleep
+        :param dump_threshold: dump the stacks if the loop is blocked longer than this
+        :param dump_min_interval: minimum time between stack dumps
+        :param window: number of lag samples kept for the percentiles
+        """
+        self.interval = interval
+        self.dump_threshold = dump_threshold
+        self.dump_min_interval = dump_min_interval
+        self.lags = deque(maxlen=window)
+        self.lag_max = 0.
+        self.num_dumps = 0
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id = None
+        self._t_beat = time.monotonic()
+        self._t_last_dump = 0.
+        self._dumped_beat = None
+
+    def start(self, loop: asyncio.AbstractEventLoop = None):
+        """ Start the heartbeat on the running loop. `check()` must be called periodically from another thread. """
+        self._loop = loop or asyncio.get_running_loop()
+        return self._loop.create_task(self._heartbeat())
+
+    async def _heartbeat(self):
+        self._loop_thread_id = threading.get_ident()
+        self._t_beat = time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0., now - self._t_beat - self.interval)
+            self._t_beat = now
+            self.lags.append(lag)
+            self.lag_max = max(self.lag_max, lag)
+
+    def stall_time(self) -> float:
+        """ Time since the loop missed its last heartbeat """
+        return max(0., time.monotonic() - self._t_beat - self.interval)
+
+    def check(self) -> float:
+        """
+        Called from the watchdog thread. Dumps the stacks once per stall if the loop is blocked.
+        :return: the current stall time
+        """
+        stall = self.stall_time()
+        t_beat = self._t_beat
+        if stall > self.dump_threshold and self._dumped_beat != t_beat \
+                and time.monotonic() - self._t_last_dump > self.dump_min_interval:
+            self._dumped_beat = t_beat
+            self._t_last_dump = time.monotonic()
+            self.num_dumps += 1
+            logger.warning('Event loop blocked for %.1fs\n%s', stall, self.format_stacks())
+        return stall
+
+    def format_stacks(self) -> str:
+        lines = []
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame:
+            lines.append('Loop thread:\n' + ''.join(traceback.format_stack(frame)))
+        try:
+            tasks = asyncio.all_tasks(self._loop) if self._loop else []
+        except RuntimeError:  # changed during iteration, the loop isn't blocked anymore
+            tasks = []
+        for task in tasks:
+            stack = ''.join(''.join(traceback.format_stack(f, limit=1)) for f in task.get_stack())
+            lines.append('%s:\n%s' % (task.get_name(), stack))
+        return '\n'.join(lines)
+
+    def pop_stats(self) -> dict:
+        """ Lag percentiles in milliseconds since the last call """
+        lags = sorted(self.lags)
+        stats = dict(p50=percentile(lags, .5), p90=percentile(lags, .9), p99=percentile(lags, .99),
+                     max=self.lag_max)
+        stats = {k: round(v * 1000, 1) for k, v in stats.items()}
+        stats['dumps'] = self.num_dumps
+        self.lags.clear()
+        self.lag_max = 0.
+        self.num_dumps = 0
+        return stats
+
@@ -1,35 +1,32 @@
+import importlib
 
 from bmslib.util import get_logger
 
 logger = get_logger()
 
+# device type -> "module:class". driver modules are imported on first use, so only the drivers of the configured
+# devices (and their dependencies, e.g. crcmod) are loaded
+bms_registry = dict(
+    daly='bmslib.models.daly:DalyBt',
+    jbd='bmslib.models.jbd:JbdBt',
+    jk='bmslib.models.jikong:JKBt',
+    ant='bmslib.models.ant:AntBt',
+    victron='bmslib.models.victron:SmartShuntBt',
+    victron_adv='bmslib.models.victron_adv:VictronAdvBt',
+    group_parallel='bmslib.group:VirtualGroupBms',
+    # group_serial='bmslib.group:VirtualGroupBms', # TODO
+    supervolt='bmslib.models.supervolt:SuperVoltBt',
+    sok='bmslib.models.sok:SokBt',
+    dummy='bmslib.models.dummy:DummyBt',
+)
+
 
 def get_bms_model_class(name):
-    import bmslib.models.ant
-    import bmslib.models.daly
-    import bmslib.models.dummy
-    import bmslib.models.jbd
-    import bmslib.models.jikong
-    import bmslib.models.sok
-    import bmslib.models.supervolt
-    import bmslib.models.victron
-
-    import bmslib.group
-
-    bms_registry = dict(
-        daly=bmslib.models.daly.DalyBt,
-        jbd=bmslib.models.jbd.JbdBt,
-        jk=bmslib.models.jikong.JKBt,
-        ant=bmslib.models.ant.AntBt,
-        victron=bmslib.models.victron.SmartShuntBt,
-        group_parallel=bmslib.group.VirtualGroupBms,
-        # group_serial=bmslib.group.VirtualGroupBms, # TODO
-        supervolt=bmslib.models.supervolt.SuperVoltBt,
-        sok=bmslib.models.sok.SokBt,
-        dummy=bmslib.models.dummy.DummyBt,
-    )
-
-    return bms_registry.get(name)
+    ref = bms_registry.get(name)
+    if ref is None:
+        return None
+    module_name, class_name = ref.split(':')
+    return getattr(importlib.import_module(module_name), class_name)
 
 
 def construct_bms(dev, verbose_log, bt_discovered_devices):
@@ -47,22 +44,40 @@ def construct_bms(dev, verbose_log, bt_discovered_devices):
     if dev.get('debug'):
         logger.info('Verbose log for %s enabled', addr)
 
-    def name2addr(name: str):
-        return next((d.address for d in bt_discovered_devices if (d.name or "").strip() == name.strip()), name)
+    from bmslib.store import store_device_meta, find_device_address, load_device_meta
+    from bmslib.scanner import find_advertisement
 
-    def dev_by_addr(address: str):
-        dev = next((d for d in bt_discovered_devices if d.address == address), None)
-        if not dev:
+    def name2addr(name: str):
+        address = next((d.address for d in bt_discovered_devices if (d.name or "").strip() == name.strip()), None)
+        if not address:
+            # seen by the shared scanner since the discovery
+            adv = find_advertisement(name=name)
+            address = adv and adv.address
+        if address:
+            store_device_meta(address, name=name.strip())
+            return address
+        # resolved by a previous run
+        return find_device_address(name.strip()) or name
+
+    def addr2name(address: str):
+        dev = next((d for d in bt_discovered_devices if d.address == address), None) or \
+            find_advertisement(address=address)
+        if dev and dev.name:
+            store_device_meta(address, name=dev.name.strip())
+            return dev.name
+        name = load_device_meta(address).get('name')
+        if not name:
             raise Exception("Can't resolve device name %s, not discovered" % address)
-        return dev
+        return name
 
     addr = name2addr(addr)
 
-    name: str = dev.get('alias') or dev_by_addr(addr).name
+    name: str = dev.get('alias') or addr2name(addr)
 
     return bms_class(addr,
                      name=name,
                      verbose_log=verbose_log or dev.get('debug'),
                      psk=dev.get('pin'),
                      adapter=dev.get('adapter'),
+                     **({'adv_key': dev['adv_key']} if dev.get('adv_key') else {}),
                      )
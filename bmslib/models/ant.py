@@ -22,7 +22,11 @@ import crcmod as crcmod
 
 from bmslib.bms import BmsSample, DeviceInfo
 from bmslib.bt import BtBms
-from bmslib.util import to_hex_str
+from bmslib.frame import FrameReassembler
+from bmslib.layout import Layout, Field, CellArray
+from bmslib.util import to_hex_str, get_logger
+
+logger = get_logger()
 
 crc16_modbus = crcmod.mkCrcFun(0x18005, rev=True, initCrc=0xFFFF, xorOut=0x0000)
 
@@ -32,6 +36,49 @@ def calc_crc16(data: bytes):
     return [i & 0xff, (i >> 8) & 0xff]
 
 
+STATUS_DATA_LEN = 0xbe  # requested data length of the status (0x11) response
+DEVICE_INFO_DATA_LEN = 0x20
+
+
+def _frame_size(data_len: int):
+    # header (7e a1), func, addr (2), data length, data, crc16, terminator (aa 55)
+    return 6 + data_len + 4
+
+
+MAX_RESPONSE_SIZE = _frame_size(max(STATUS_DATA_LEN, DEVICE_INFO_DATA_LEN))
+
+
+def _frame_len(buf: memoryview):
+    return _frame_size(buf[5]) if len(buf) > 5 else None
+
+
+def _frame_crc_ok(frame: memoryview):
+    crc = crc16_modbus(frame[1:-4])
+    if crc != frame[-4] | (frame[-3] << 8):
+        logger.warning('CRC16 error: %s != %s (expected)', calc_crc16(frame[1:-4]), list(frame[-4:-2]))
+        return False
+    return True
+
+
+# status frame (0x11) after the cell voltages and temperatures
+ANT_STATUS = Layout('<', dict(
+    mos_temp=Field(0, 'H'),
+    # 2 balancer temperature
+    voltage=Field(4, 'H', .01),
+    current=Field(6, 'h', .1),
+    soc=Field(8, 'H'),
+    # 10 state of health
+    switch_dsg=Field(12, 'B'),  # dsg mos state
+    switch_chg=Field(13, 'B'),  # charge mos state
+    # 14 balance state, 15 reserved
+    capacity=Field(16, 'I', 1e-6),
+    charge=Field(20, 'I', 1e-6),
+    cycle_charge=Field(24, 'I', 1e-3),
+    # 28 power (int32)
+))
+ANT_CELLS = CellArray('<', 'H')
+
+
 class AntCommandFuncs(enum.Enum):
     Status = 0x01
     DeviceInfo = 0x02
@@ -62,43 +109,19 @@ class AntBt(BtBms):
 
     def __init__(self, address, **kwargs):
         super().__init__(address, _uses_pin=False, **kwargs)
-        self._buffer = bytearray()
+        self._frames = FrameReassembler(self._on_frame, header=b'\x7E\xA1', length=_frame_len, terminator=b'\xAA\x55',
+                                        crc=_frame_crc_ok, max_frame=MAX_RESPONSE_SIZE, name=self.name)
         self._switches = None
         self._last_response = None
         self._voltages = []
 
     def _notification_handler(self, sender, data: bytes):
-
-        # MAX_RESPONSE_SIZE = 152
-
         # print("bms msg {0}: {1} {2}".format(sender, to_hex_str(data), data))
+        self._frames.feed(data)
 
-        if data.startswith(b'\x7E\xA1'):
-            self._buffer.clear()
-
-        self._buffer += data
-
-        if self._buffer.endswith(b'\x55'):
-            buf = self._buffer
-            func = buf[2]
-            data_len = buf[5]
-            frame_len = 6 + data_len + 4
-
-            if len(buf) < frame_len:
-                self.logger.warning('Unexpected size: header says %d, got %d bytes', frame_len, len(buf))
-                buf.clear()
-                return
-
-            crc = calc_crc16(buf[1:1 + frame_len - 5])
-            crc_exp = list(buf[frame_len - 4:frame_len - 2])
-
-            self._last_response = buf[:]
-            self._buffer.clear()
-
-            if crc != crc_exp:
-                self.logger.warning('CRC16 error: %s != %s (expected)', crc, crc_exp)
-            else:
-                self._fetch_futures.set_result(func, self._last_response)
+    def _on_frame(self, frame: memoryview):
+        self._last_response = bytearray(frame)
+        self._fetch_futures.set_result(frame[2], self._last_response)
 
     async def connect(self, timeout=20, **kwargs):
         # await super().connect(**kwargs)
@@ -108,6 +131,7 @@ class AntBt(BtBms):
             self.logger.info("normal connect failed (%s), connecting with scanner", str(e) or type(e))
             await self._connect_with_scanner(timeout=timeout)
 
+        self._frames.reset()
         await self.start_notify(self.CHAR_UUID, self._notification_handler)
 
     async def disconnect(self):
@@ -120,7 +144,7 @@ class AntBt(BtBms):
             return await self._fetch_futures.wait_for(resp_code, self.TIMEOUT)
 
     async def fetch_device_info(self) -> DeviceInfo:
-        buf: bytearray = await self._q(AntCommandFuncs.DeviceInfo, 0x026c, 0x20, resp_code=0x12)
+        buf: bytearray = await self._q(AntCommandFuncs.DeviceInfo, 0x026c, DEVICE_INFO_DATA_LEN, resp_code=0x12)
         hw = bytearray.decode(buf[6:6 + 16].strip(b'\0'), 'utf-8')
         dev = DeviceInfo(
             mnf="ANT",
@@ -134,84 +158,36 @@ class AntBt(BtBms):
 
     async def fetch(self) -> BmsSample:
         # data = bytearray(b'~\xa1\x11\x00\x00~\x05\x01\x02\x08\x02\x00\x00\x00\x00\x00\x00\x00\x01\x00B\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xd4\r\xd5\r\xd5\r\xd5\r\xd5\r\xd4\r\xd5\r\xd5\r\xd8\xff\xd8\xff\x1c\x00\x1d\x00\x11\x0b\x00\x00d\x00d\x00\x01\x02\x00\x00\x00\xe1\xf5\x05\x00\xe1\xf5\x05\xa52\x00\x00\x00\x00\x00\x00\xff\x97\x01\x00\x00\x00\x00\x00\xd5\r\x02\x00\xd4\r\x01\x00\x01\x00\xd4\r\xf8\xff\x82\x00\x00\x00\xab\x02\xf2\xfa\x10\x00\x00\x00:e\x00\x00\x1f\x00\x00\x00\xfab\x00\x00\x11\xc3\xaaU')
-        data = await self._q(AntCommandFuncs.Status, 0x0000, 0xbe, resp_code=0x11)
-
-        u16 = lambda i: int.from_bytes(data[i:(i + 2)], byteorder='little', signed=False)
-        i16 = lambda i: int.from_bytes(data[i:(i + 2)], byteorder='little', signed=True)
-        u32 = lambda i: int.from_bytes(data[i:(i + 4)], byteorder='little', signed=False)
-        i32 = lambda i: int.from_bytes(data[i:(i + 4)], byteorder='little', signed=True)
+        data = await self._q(AntCommandFuncs.Status, 0x0000, STATUS_DATA_LEN, resp_code=0x11)
 
         num_temp = data[8]
         num_cell = data[9]
         offset = 34
 
-        self._voltages = [u16(i * 2 + offset) for i in range(num_cell)]
+        self._voltages = ANT_CELLS.decode(data, offset, num_cell).tolist()
         offset += num_cell * 2
 
-        temperatures = [u16(i * 2 + offset) for i in range(num_temp)]
-        temperatures = [t if t != 65496 else math.nan for t in temperatures]
+        temperatures = [t if t != 65496 else math.nan for t in ANT_CELLS.decode(data, offset, num_temp)]
         offset += num_temp * 2
 
-        mos_temp = u16(offset)
-        offset += 2
-
-        # balancer_temp = u16(offset)
-        offset += 2
-
-        voltage = u16(offset) * 0.01
-        offset += 2
-
-        current = i16(offset) * 0.1
-        offset += 2
-
-        soc = u16(offset)
-        offset += 2
-
-        # soh = u16(offset)  # state of health
-        offset += 2
-
-        # dsg mos state
-        switch_dsg = data[offset]
-        offset += 1
-
-        # charge mos state
-        switch_chg = data[offset]
-        offset += 1
-
-        # bal state
-        offset += 1
-
-        # reserved ?
-        offset += 1
-
-        capacity = u32(offset) * 0.000001
-        offset += 4
-
-        charge = u32(offset) * 0.000001
-        offset += 4
-
-        cycle_charge = u32(offset) * 0.001
-        offset += 4
-
-        # power = i32(offset)
-        offset += 4
+        d = ANT_STATUS.decode(data, base=offset)
 
         sample = BmsSample(
-            voltage=voltage,
-            current=current,
+            voltage=d['voltage'],
+            current=d['current'],
             # power=
-            charge=charge,
-            capacity=capacity,
-            cycle_capacity=cycle_charge,
+            charge=d['charge'],
+            capacity=d['capacity'],
+            cycle_capacity=d['cycle_charge'],
             # num_cycles=0,
-            soc=soc,
+            soc=d['soc'],
 
             temperatures=temperatures,
-            mos_temperature=mos_temp,
+            mos_temperature=d['mos_temp'],
 
             switches=dict(
-                discharge=switch_dsg == 1,
-                charge=switch_chg == 1,
+                discharge=d['switch_dsg'] == 1,
+                charge=d['switch_chg'] == 1,
             ),
 
             # charge_enabled
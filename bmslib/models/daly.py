@@ -22,7 +22,8 @@ from typing import Dict
 
 from bmslib.bms import BmsSample
 from bmslib.bt import BtBms, enumerate_services
-from bmslib.cache.mem import mem_cache_deco
+from bmslib.frame import FrameReassembler
+from bmslib.layout import Layout, Field
 
 
 def calc_crc(message_bytes):
@@ -52,7 +53,25 @@ def daly_command_message(command: int, extra=""):
     return message_bytes
 
 
+RESP_LEN = 13
+STATUS_TTL = 30  # seconds to re-use the status (0x93) for
+
+# 0x90 response payload
+DALY_SOC = Layout('>', dict(
+    voltage=Field(0, 'h', .1),
+    # 2 "x_voltage" (acquisition), always 0
+    current=Field(4, 'h', .1, bias=-30000),  # negative=charging, positive=discharging
+    soc=Field(6, 'h', .1),
+))
+
+
+def _frame_crc_ok(frame: memoryview):
+    return calc_crc(frame[0:12]) == frame[12]
+
+
 class DalyBt(BtBms):
+    # 0x95 and 0x96 have multi-frame responses, which are queried separately anyway (fetch_voltages, ..)
+    PIPELINE_SAFE = frozenset({0x90, 0x93, 0x94})
     TIMEOUT = 12
 
     SOC_NOT_FULL_YET = 99.1  # when the gauge reaches 100% but no OV yet
@@ -69,53 +88,51 @@ class DalyBt(BtBms):
         self._fetch_nr: Dict[int, list] = {}
         # self._num_cells = 0
         self._states = None
+        self._status = None
+        self._t_status = 0.
         self._last_response = None
+        self._frames = FrameReassembler(self._on_frame, header=b'\xA5', length=RESP_LEN, crc=_frame_crc_ok,
+                                        name=self.name)
 
     async def get_states_cached(self, key):
+        if not self._states and key in {'num_cells', 'num_temps'} and self.meta.get(key):
+            # from the previous run, re-validated with the next states fetch
+            return self.meta[key]
         if not self._states:
-            self._states = await self.fetch_states()
-            self.logger.debug('got daly states: %s', self._states)
+            self._set_states(await self.fetch_states())
         return self._states.get(key)
 
-    def _notification_callback(self, _sender, data):
-        RESP_LEN = 13
-
-        # split responses into chunks with length RESP_LEN
-        responses = [data[i:i + RESP_LEN] for i in range(0, len(data), RESP_LEN)]
+    def _set_states(self, states):
+        self._states = states
+        self.logger.debug('got daly states: %s', self._states)
+        self.update_meta(num_cells=self._states['num_cells'], num_temps=self._states['num_temps'])
 
-        for response_bytes in responses:
-            self.logger.debug('daly resp: %s', response_bytes)
-
-            if len(response_bytes) < RESP_LEN:
-                self.logger.warning("msg too short: %s", response_bytes)
-                continue
-
-            check_comp = calc_crc(response_bytes[0:12])
-            check_expect = response_bytes[12]
+    def _notification_callback(self, _sender, data):
+        # one notification can hold several responses
+        self._frames.feed(data)
 
-            command = response_bytes[2]
-            response_bytes = response_bytes[4:-1]
+    def _on_frame(self, frame: memoryview):
+        self.logger.debug('daly resp: %s', frame.hex())
 
-            if check_comp != check_expect:
-                self.logger.warning("checksum fail, expected %s, got %s. %s", check_expect, check_comp, response_bytes)
-                continue
+        command = frame[2]
+        response_bytes = bytes(frame[4:-1])
 
-            # buffer for multi-response commands
-            buf = self._fetch_nr.get(command, None)
-            if buf:
-                try:
-                    i = buf.index(None)
-                    buf[i] = response_bytes
-                    if i + 1 == len(buf):  # last item?
-                        response_bytes = buf
-                    else:
-                        continue
-                except ValueError:
-                    # this happens if buf is already full and still receiving messages
-                    continue
-
-            self._last_response = response_bytes
-            self._fetch_futures.set_result(command, response_bytes)
+        # buffer for multi-response commands
+        buf = self._fetch_nr.get(command, None)
+        if buf:
+            try:
+                i = buf.index(None)
+                buf[i] = response_bytes
+                if i + 1 == len(buf):  # last item?
+                    response_bytes = buf
+                else:
+                    return
+            except ValueError:
+                # this happens if buf is already full and still receiving messages
+                return
+
+        self._last_response = response_bytes
+        self._fetch_futures.set_result(command, response_bytes)
 
     async def connect(self, timeout=10, **kwargs):
         try:
@@ -125,11 +142,18 @@ class DalyBt(BtBms):
             await self._connect_with_scanner(timeout=timeout)
 
         CHARACTERISTIC_UUIDS = [
-            (17, 15, 48),  # TODO these should be replaced with the actual UUIDs to avoid conflicts with other BMS
-            ('0000fff1-0000-1000-8000-00805f9b34fb', '0000fff2-0000-1000-8000-00805f9b34fb',
-             '02f00000-0000-0000-0000-00000000ff01'),  # (15,19,31)
+            [17, 15, 48],  # TODO these should be replaced with the actual UUIDs to avoid conflicts with other BMS
+            ['0000fff1-0000-1000-8000-00805f9b34fb', '0000fff2-0000-1000-8000-00805f9b34fb',
+             '02f00000-0000-0000-0000-00000000ff01'],  # (15,19,31)
         ]
 
+        # try the characteristics that worked last time first
+        cached = self.meta.get('char_uuids')
+        if cached in CHARACTERISTIC_UUIDS:
+            CHARACTERISTIC_UUIDS.remove(cached)
+            CHARACTERISTIC_UUIDS.insert(0, cached)
+
+        self._frames.reset()
         for rx, tx, sx in CHARACTERISTIC_UUIDS:
             try:
                 await self.client.start_notify(rx, self._notification_callback)
@@ -137,6 +161,7 @@ class DalyBt(BtBms):
                 self.UUID_RX = rx
                 self.UUID_TX = tx
                 self.logger.debug("found rx uuid to be working: %s (tx %s, sx %s)", rx, tx, sx)
+                self.update_meta(char_uuids=[rx, tx, sx])
                 break
             except Exception as e:
                 self.logger.warning("tried rx/tx/sx uuids %s/%s/%s: %s", rx, tx, sx, e)
@@ -151,16 +176,18 @@ class DalyBt(BtBms):
             await self.client.stop_notify(self.UUID_RX)
         await super().disconnect()
 
-    async def _q(self, command: int, num_responses: int = 1):
-        msg = daly_command_message(command)
+    async def _write_command(self, command: int, num_responses: int = 1):
         if num_responses > 1:
             self._fetch_nr[command] = [None] * num_responses
         else:
             self._fetch_nr.pop(command, None)
+        msg = daly_command_message(command)
+        self.logger.debug("daly send: %s", msg)
+        await self.client.write_gatt_char(self.UUID_TX, msg)
 
+    async def _q(self, command: int, num_responses: int = 1):
         with await self._fetch_futures.acquire_timeout(command, timeout=self.TIMEOUT / 2):
-            self.logger.debug("daly send: %s", msg)
-            await self.client.write_gatt_char(self.UUID_TX, msg)
+            await self._write_command(command, num_responses)
 
             try:
                 sample = await self._fetch_futures.wait_for(command, self.TIMEOUT)
@@ -175,7 +202,6 @@ class DalyBt(BtBms):
         fet_addr = dict(discharge=0xD9, charge=0xDA)
         msg = daly_command_message(fet_addr[switch], extra="01" if state else "00")
         self.logger.info('write %s', msg)
-        self._fetch_status.invalidate(self)
         status = await self._fetch_status()
         await self.client.write_gatt_char(self.UUID_TX, msg)
 
@@ -184,9 +210,22 @@ class DalyBt(BtBms):
         #    await self.client.write_gatt_char(self.UUID_TX, msg)
 
     async def fetch(self) -> BmsSample:
-        status = await self._fetch_status()
+        # soc, the status (if expired) and the states (once) in one round trip
+        commands = [0x90]
+        if time.time() - self._t_status > STATUS_TTL:
+            commands.append(0x93)
+        if not self._states:
+            commands.append(0x94)
 
-        sample = await self.fetch_soc(sample_kwargs=dict(
+        timestamp = time.time()
+        responses = dict(zip(commands, await self._q_pipelined(commands, self._write_command, self.TIMEOUT)))
+        if 0x93 in responses:
+            self._set_status(self._parse_status(responses[0x93]))
+        if 0x94 in responses:
+            self._set_states(self._parse_states(responses[0x94]))
+
+        status = self._status
+        sample = self._soc_sample(responses[0x90], timestamp, sample_kwargs=dict(
             charge=status['capacity_ah'],
             switches=dict(
                 charge=bool(status['charging_mosfet']),
@@ -199,16 +238,17 @@ class DalyBt(BtBms):
     async def fetch_soc(self, sample_kwargs=None):
         timestamp = time.time()
         resp = await self._q(0x90)
+        await self.get_states_cached('num_cycles')
+        return self._soc_sample(resp, timestamp, sample_kwargs or {})
 
-        parts = struct.unpack('>h h h h', resp)
-
-        # x_v =  parts[1] / 10,  # always 0 "x_voltage", acquisition
+    def _soc_sample(self, resp, timestamp, sample_kwargs) -> BmsSample:
+        parts = DALY_SOC.decode(resp)
 
         sample = BmsSample(
-            voltage=parts[0] / 10,
-            current=(parts[2] - 30000) / 10,  # negative=charging, positive=discharging
-            soc=parts[3] / 10,
-            num_cycles=await self.get_states_cached('num_cycles'),
+            voltage=parts['voltage'],
+            current=parts['current'],
+            soc=parts['soc'],
+            num_cycles=self._states['num_cycles'],
             timestamp=timestamp,
             **sample_kwargs,
         )
@@ -219,10 +259,16 @@ class DalyBt(BtBms):
 
         return sample
 
-    @mem_cache_deco(ttl=30)
     async def _fetch_status(self):
-        response_data = await self._q(0x93)
+        status = self._parse_status(await self._q(0x93))
+        self._set_status(status)
+        return status
+
+    def _set_status(self, status):
+        self._status = status
+        self._t_status = time.time()
 
+    def _parse_status(self, response_data):
         # dsgOFF:
         # bytearray(b'\x01\x01\x01]\x00\x03\xda,')    '1 1 1 5d 0 3 da 2c'
         # bytearray(b'\x01\x01\x01k\x00\x03\xe2L')    '1 1 1 6b 0 3 e2 4c'
@@ -256,9 +302,9 @@ class DalyBt(BtBms):
         return status
 
     async def fetch_states(self):
+        return self._parse_states(await self._q(0x94))
 
-        response_data = await self._q(0x94)
-
+    def _parse_states(self, response_data):
         parts = struct.unpack('>b b ? ? b h x', response_data)
 
         state_bits = bin(parts[4])[2:]
@@ -11,6 +11,7 @@ References
 from bmslib import FuturesPool
 from bmslib.bms import BmsSample
 from bmslib.bt import BtBms
+from bmslib.frame import FrameReassembler
 
 
 def _daly_command(command: int):
@@ -24,24 +25,21 @@ class JbdBt(BtBms):
 
     def __init__(self, address, **kwargs):
         super().__init__(address, **kwargs)
-        self._buffer = bytearray()
+        # frames end with 'w', received in a single notification or split with the end in the last one
+        self._frames = FrameReassembler(self._on_frame, terminator=b'w', name=self.name)
         self._fetch_futures = FuturesPool()
         self._switches = None
 
     def _notification_handler(self, _sender, data):
         self.logger.debug("ble data frame %s", data)
-        self._buffer += data
+        self._frames.feed(data)
 
-        if self._buffer.endswith(b'w'):
-            command = self._buffer[1]
-            buf = self._buffer[:]
-            self._buffer.clear()
-
-            # print(command, 'buffer endswith w', self._buffer)
-            self._fetch_futures.set_result(command, buf)
+    def _on_frame(self, frame: memoryview):
+        self._fetch_futures.set_result(frame[1], bytearray(frame))
 
     async def connect(self, **kwargs):
         await super().connect(**kwargs)
+        self._frames.reset()
         await self.client.start_notify(self.UUID_RX, self._notification_handler)
 
     async def disconnect(self):
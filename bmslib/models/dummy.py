@@ -2,18 +2,64 @@
 This is code for a dummy BMS wich doesn't physically exist.
 
 """
+import asyncio
 import math
 import random
 import time
 from functools import partial
 from threading import Thread
-from typing import Callable, Union
+from typing import Callable, Union, Dict, List, Tuple
 
 from bmslib.bms import BmsSample
 from bmslib.bt import BtBms
 from bmslib.util import get_logger, dotdict
 
 
+class DummyCharacteristic(dotdict):
+    """ GATT characteristic, hashed by identity like a BleakGATTCharacteristic """
+    __hash__ = object.__hash__
+    __eq__ = object.__eq__
+
+
+class DummyProfile:
+    """
+    Latency and failure behaviour of a dummy device, used by simulations (see tools/simulate.py).
+    Also records the times of successful fetches.
+    """
+
+    def __init__(self, latency=0., jitter=0., failure_rate=0., timeout=10., outages: List[Tuple[float, float]] = ()):
+        """
+        :param latency: mean duration of a connect and a fetch
+        :param jitter: latency varies uniformly by +-jitter
+        :param failure_rate: probability of a fetch timing out
+        :param timeout: time until a failing connect or fetch raises
+        :param outages: list of (start time, duration), the device is unreachable during these
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.timeout = timeout
+        self.outages = list(outages)
+        self.fetch_times: List[float] = []
+        self.num_failures = 0
+
+    def is_out(self, t):
+        return any(t0 <= t < t0 + dt for t0, dt in self.outages)
+
+    async def delay(self):
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0., self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    async def fail(self, what):
+        self.num_failures += 1
+        await asyncio.sleep(self.timeout)
+        raise asyncio.TimeoutError('dummy %s timeout' % what)
+
+
+# profiles by device address, devices without a profile respond instantly
+dummy_profiles: Dict[str, DummyProfile] = {}
+
+
 class DummyBt(BtBms):
     TEMPERATURE_STEP = .1
 
@@ -23,6 +69,7 @@ class DummyBt(BtBms):
         self._t0 = time.time()
         self._connected = False
         self._seed = random.random() * 2 * math.pi
+        self.profile = dummy_profiles.get(address)
 
         self._cell_r = 5e-3
         self.I = 0
@@ -32,12 +79,27 @@ class DummyBt(BtBms):
         return self._connected
 
     async def connect(self, **kwargs):
+        if self.profile:
+            if self.profile.is_out(time.time()):
+                await self.profile.fail('connect')
+            await self.profile.delay()
         self._connected = True
 
     async def disconnect(self):
         self._connected = False
 
+    def true_charge(self, t0, t1):
+        """ Exact integral of the current [Ah] between t0 and t1 """
+        return -16 * (math.cos(t1 / 16 + self._seed) - math.cos(t0 / 16 + self._seed)) / 3600
+
     async def fetch(self) -> BmsSample:
+        if self.profile:
+            if self.profile.is_out(time.time()) or random.random() < self.profile.failure_rate:
+                self._connected = False
+                await self.profile.fail('fetch')
+            await self.profile.delay()
+            self.profile.fetch_times.append(time.time())
+
         self.I = math.sin(time.time() / 16 + self._seed)
         temp_prec = 1/self.TEMPERATURE_STEP
         sample = BmsSample(
@@ -75,6 +137,7 @@ class BleakDummyClient:
             jbd=JBDDummy,
         )
         self._bms = dummy_classes[address[5:]]()
+        self._profile = dummy_profiles.get(address)
 
     @property
     def is_connected(self):
@@ -82,6 +145,10 @@ class BleakDummyClient:
 
     async def connect(self, timeout=20):
         assert not self._connected
+        if self._profile:
+            if self._profile.is_out(time.time()):
+                await self._profile.fail('connect')
+            await self._profile.delay()
         self._connected = True
 
     async def disconnect(self):
@@ -134,7 +201,7 @@ class JKDummy:
         from bmslib.models.jikong import JKBt
         self.services = [
             dotdict(uuid=JKBt.SERVICE_UUID, characteristics=[
-                dotdict(uuid=JKBt.CHAR_UUID, properties='write,notify', handle=2, descriptors=[])
+                DummyCharacteristic(uuid=JKBt.CHAR_UUID, properties='write,notify', handle=2, descriptors=[])
             ])
         ]
 
@@ -151,7 +218,7 @@ class JKDummy:
         if data.startswith(b'\xaaU\x90\xeb\x97'):
             # device info
             self.logger.info('dummy query device info')
-            self._callbacks['0000ffe1-0000-1000-8000-00805f9b34fb'](self, bytes(self.DEVICE_INFO))
+            self._callbacks[self.services[0].characteristics[0]](self, bytes(self.DEVICE_INFO))
         elif data.startswith(b'\xaaU\x90\xeb\x96'):
             self.logger.info('dummy subscribe')
 
@@ -159,7 +226,7 @@ class JKDummy:
                 while True:
                     time.sleep(1)
                     for msg in self.MSGS:
-                        self._callbacks['0000ffe1-0000-1000-8000-00805f9b34fb'](self, bytes(msg))
+                        self._callbacks[self.services[0].characteristics[0]](self, bytes(msg))
 
             Thread(target=send_data, daemon=True).start()
         else:
@@ -16,12 +16,38 @@ import asyncio
 
 from bmslib.bms import BmsSample
 from bmslib.bt import BtBms
+from bmslib.frame import FrameReassembler
+from bmslib.layout import Layout, Field, CellArray
 
 
 def _jbd_command(command: int):
     return bytes([0xDD, 0xA5, command, 0x00, 0xFF, 0xFF - (command - 1), 0x77])
 
 
+def _frame_len(buf: memoryview):
+    # start, command, status, data length, data, checksum (2), end
+    return (4 + buf[3] + 3) if len(buf) > 3 else None
+
+
+def _frame_crc_ok(frame: memoryview):
+    return (0x10000 - sum(frame[2:-3])) & 0xFFFF == (frame[-3] << 8) | frame[-2]
+
+
+# basic info (0x03) data, after the 4 byte frame header
+JBD_BASIC_INFO = Layout('>', dict(
+    voltage=Field(0, 'H', .01),
+    current=Field(2, 'h', -.01),
+    charge=Field(4, 'H', .01),
+    capacity=Field(6, 'H', .01),
+    num_cycles=Field(8, 'H'),
+    soc=Field(19, 'B'),
+    mos_byte=Field(20, 'B'),
+    num_cell=Field(21, 'B'),
+    num_temp=Field(22, 'B'),
+))
+JBD_UINT16 = CellArray('>', 'H')
+
+
 class JbdBt(BtBms):
     UUID_RX = '0000ff01-0000-1000-8000-00805f9b34fb'
     UUID_TX = '0000ff02-0000-1000-8000-00805f9b34fb'
@@ -31,23 +57,19 @@ class JbdBt(BtBms):
         super().__init__(address, **kwargs)
         if kwargs.get('psk'):
             self.logger.warning('JBD usually does not use a pairing PIN')
-        self._buffer = bytearray()
+        self._frames = FrameReassembler(self._on_frame, header=b'\xDD', length=_frame_len, terminator=b'w',
+                                        crc=_frame_crc_ok, max_frame=4 + 255 + 3, name=self.name)
         self._switches = None
         self._last_response = None
 
     def _notification_handler(self, sender, data):
-
         # print("bms msg {0}: {1}".format(sender, data))
-        self._buffer += data
-
-        if self._buffer.endswith(b'w'):
-            command = self._buffer[1]
-            buf = self._buffer[:]
-            self._buffer.clear()
+        self._frames.feed(data)
 
-            # print(command, 'buffer endswith w', self._buffer)
-            self._last_response = buf
-            self._fetch_futures.set_result(command, buf)
+    def _on_frame(self, frame: memoryview):
+        buf = bytearray(frame)
+        self._last_response = buf
+        self._fetch_futures.set_result(buf[1], buf)
 
     async def connect(self, **kwargs):
         await super().connect(**kwargs)
@@ -57,6 +79,7 @@ class JbdBt(BtBms):
         #    self.logger.info("normal connect failed (%s), connecting with scanner", e)
         #    await self._connect_with_scanner(**kwargs)
 
+        self._frames.reset()
         await self.client.start_notify(self.UUID_RX, self._notification_handler)
 
     async def disconnect(self):
@@ -73,24 +96,20 @@ class JbdBt(BtBms):
         #  https://github.com/NeariX67/SmartBMSUtility/blob/main/Smart%20BMS%20Utility/Smart%20BMS%20Utility/BMSData.swift
 
         buf = await self._q(cmd=0x03)
-        buf = buf[4:]
-
-        num_cell = int.from_bytes(buf[21:22], 'big')
-        num_temp = int.from_bytes(buf[22:23], 'big')
-
-        mos_byte = int.from_bytes(buf[20:21], 'big')
+        d = JBD_BASIC_INFO.decode(buf, base=4)
+        mos_byte = d['mos_byte']
 
         sample = BmsSample(
-            voltage=int.from_bytes(buf[0:2], byteorder='big', signed=False) / 100,
-            current=-int.from_bytes(buf[2:4], byteorder='big', signed=True) / 100,
+            voltage=d['voltage'],
+            current=d['current'],
 
-            charge=int.from_bytes(buf[4:6], byteorder='big', signed=False) / 100,
-            capacity=int.from_bytes(buf[6:8], byteorder='big', signed=False) / 100,
-            soc=buf[19],
+            charge=d['charge'],
+            capacity=d['capacity'],
+            soc=d['soc'],
 
-            num_cycles=int.from_bytes(buf[8:10], byteorder='big', signed=False),
+            num_cycles=d['num_cycles'],
 
-            temperatures=[(int.from_bytes(buf[23 + i * 2:i * 2 + 25], 'big') - 2731) / 10 for i in range(num_temp)],
+            temperatures=[(t - 2731) / 10 for t in JBD_UINT16.decode(buf, 4 + 23, d['num_temp'])],
 
             switches=dict(
                 discharge=mos_byte == 2 or mos_byte == 3,
@@ -108,16 +127,14 @@ class JbdBt(BtBms):
         # self.rawdat['P']=round(self.rawdat['Vbat']*self.rawdat['Ibat'], 1)
         # self.rawdat['Bal'] = int.from_bytes(self.response[12:14], byteorder='big', signed=False)
 
-        product_date = int.from_bytes(buf[10:12], byteorder='big', signed=True)
-        # productDate = convertByteToUInt16(data1: data[14], data2: data[15])
+        # product_date at 10 (int16)
 
         return sample
 
     async def fetch_voltages(self):
         buf = await self._q(cmd=0x04)
         num_cell = int(buf[3] / 2)
-        voltages = [(int.from_bytes(buf[4 + i * 2:i * 2 + 6], 'big')) for i in range(num_cell)]
-        return voltages
+        return JBD_UINT16.decode(buf, 4, num_cell).tolist()
 
     async def set_switch(self, switch: str, state: bool):
 
@@ -19,10 +19,12 @@ fix connection abort:
 import asyncio
 import time
 from collections import defaultdict
-from typing import List, Callable, Dict, Tuple
+from typing import List, Callable, Dict, Tuple, Optional
 
 from bmslib.bms import BmsSample, DeviceInfo
 from bmslib.bt import BtBms
+from bmslib.frame import FrameReassembler
+from bmslib.layout import Layout, Field, CellArray
 from bmslib.util import to_hex_str
 
 
@@ -37,17 +39,48 @@ def read_str(buf, offset, encoding='utf-8'):
 def _jk_command(address, value: list = ()):
     n = len(value)
     assert n <= 13, "val %s too long" % value
-    frame = bytes([0xAA, 0x55, 0x90, 0xEB, address, n])
+    frame = COMMAND_HEADER + bytes([address, n])
     frame += bytes(value)
     frame += bytes([0] * (13 - n))
     frame += bytes([calc_crc(frame)])
     return frame
 
 
+HEADER = bytes([0x55, 0xAA, 0xEB, 0x90])
+COMMAND_HEADER = bytes([0xAA, 0x55, 0x90, 0xEB])
 MIN_RESPONSE_SIZE = 300
+# some firmware appends a 20 byte command echo (COMMAND_HEADER ...) to each frame, the CRC stays at 299
 MAX_RESPONSE_SIZE = 320
 
 
+def _frame_crc_ok(frame: memoryview):
+    return calc_crc(frame[0:MIN_RESPONSE_SIZE - 1]) == frame[MIN_RESPONSE_SIZE - 1]
+
+
+# JK02 cell info frame (0x02). The 32 cell version (new 11.x firmware) has the same fields 32 bytes further
+JK02_CELL_INFO = Layout('<', dict(
+    voltage=Field(118, 'I', 1e-3),
+    current=Field(126, 'i', -1e-3),
+    temp1=Field(130, 'h', .1, nan=-2000),
+    temp2=Field(132, 'h', .1, nan=-2000),
+    mos_temperature=Field(134, 'h', .1),
+    balance_current=Field(138, 'h', 1e-3),
+    soc=Field(141, 'B'),
+    charge=Field(142, 'I', 1e-3),  # "remaining capacity"
+    capacity=Field(146, 'I', 1e-3),  # computed capacity (starts at self.capacity, which is user-defined)
+    num_cycles=Field(150, 'I'),
+    cycle_capacity=Field(154, 'I', 1e-3),  # total charge TODO rename cycle charge
+    # 166 charge FET state, 167 discharge FET state
+    uptime=Field(162, 'I', 1.),  # seconds
+))
+JK02_32_CELL_INFO = JK02_CELL_INFO.variant(
+    mos_temperature=Field(112, 'h', .1),
+    temp3=Field(224, 'h', .1, nan=-2000),
+    temp4=Field(226, 'h', .1, nan=-2000),
+)
+JK02_CELL_VOLTAGES = CellArray('<', 'H')
+
+
 class JKBt(BtBms):
     SERVICE_UUID = "0000ffe0-0000-1000-8000-00805f9b34fb"
     CHAR_UUID = "0000ffe1-0000-1000-8000-00805f9b34fb"
@@ -62,54 +95,46 @@ class JKBt(BtBms):
         super().__init__(address, **kwargs)
         if kwargs.get('psk'):
             self.logger.warning('JK usually does not use a pairing PIN')
-        self._buffer = bytearray()
+        self._frame_size = MIN_RESPONSE_SIZE
+        self._frames = FrameReassembler(self._on_frame, header=HEADER, length=self._frame_len,
+                                        crc=_frame_crc_ok, max_frame=MAX_RESPONSE_SIZE, name=self.name)
         self._resp_table: Dict[int, Tuple[bytearray, float]] = {}
-        self.num_cells = None
-        self._callbacks: Dict[int, List[Callable[[bytes], None]]] = defaultdict(List)
+        self.num_cells = self.meta.get('num_cells')
+        self._is_new_11fw = self.meta.get('is_new_11fw')
+        self._is_new_11fw_checked = False
+        self._callbacks: Dict[int, List[Callable[[bytes], None]]] = defaultdict(list)
         self.char_handle_notify = None
         self.char_handle_write = None
+        self._settings_query: Optional[asyncio.Future] = None
 
-    def _buffer_crc_check(self):
-        crc_comp = calc_crc(self._buffer[0:MIN_RESPONSE_SIZE - 1])
-        crc_expected = self._buffer[MIN_RESPONSE_SIZE - 1]
-        if crc_comp != crc_expected:
-            self.logger.debug("crc check failed, %s != %s, %s", crc_comp, crc_expected, self._buffer)
-        return crc_comp == crc_expected
-
-    def _notification_handler(self, _sender, data):
-        HEADER = bytes([0x55, 0xAA, 0xEB, 0x90])
-
-        if data[0:4] == HEADER:  # and len(self._buffer)
-            self.logger.debug("header, clear buf %s", self._buffer)
-            self._buffer.clear()
+    def _frame_len(self, buf: memoryview):
+        # the firmware variant shows when the bytes after the CRC arrived in the same fragment
+        following = buf[MIN_RESPONSE_SIZE:MIN_RESPONSE_SIZE + 4]
+        if self._frame_size == MIN_RESPONSE_SIZE and following == COMMAND_HEADER:
+            self._set_frame_size(MAX_RESPONSE_SIZE)
+        elif self._frame_size == MAX_RESPONSE_SIZE and following == HEADER:
+            self._set_frame_size(MIN_RESPONSE_SIZE)
+        return self._frame_size
 
-        self._buffer += data
+    def _set_frame_size(self, n: int):
+        self.logger.info('frame size %d', n)
+        self._frame_size = n
 
-        self.logger.debug("bms msg(%d) (buf%d): %s\n", len(data), len(self._buffer), to_hex_str(data))
-
-        if len(self._buffer) >= MIN_RESPONSE_SIZE:
-            if len(self._buffer) > MAX_RESPONSE_SIZE:
-                self.logger.warning('buffer longer than expected %d %s', len(self._buffer), self._buffer)
-
-            crc_ok = self._buffer_crc_check()
-
-            if not crc_ok and HEADER in self._buffer:
-                idx = self._buffer.index(HEADER)
-                self.logger.debug("crc check failed, header at %d, discarding start of %s", idx, self._buffer)
-                self._buffer = self._buffer[idx:]
-                crc_ok = self._buffer_crc_check()
+    def _notification_handler(self, _sender, data):
+        self.logger.debug("bms msg(%d) (buf%d): %s\n", len(data), len(self._frames), to_hex_str(data))
+        if self._frame_size == MIN_RESPONSE_SIZE and not len(self._frames) and data[:4] == COMMAND_HEADER:
+            # command echo in its own fragment right after a frame
+            self._set_frame_size(MAX_RESPONSE_SIZE)
+        self._frames.feed(data)
 
-            if not crc_ok:
-                self.logger.error("crc check failed, discarding buffer %s", self._buffer)
-            else:
-                self._decode_msg(bytearray(self._buffer))
-            self._buffer.clear()
+    def _on_frame(self, frame: memoryview):
+        self._decode_msg(bytearray(frame))
 
     def _decode_msg(self, buf: bytearray):
         resp_type = buf[4]
         self.logger.debug('got response %d (len%d)', resp_type, len(buf))
         self._resp_table[resp_type] = buf, time.time()
-        self._fetch_futures.set_result(resp_type, self._buffer[:])
+        self._fetch_futures.set_result(resp_type, buf[:])
         callbacks = self._callbacks.get(resp_type, None)
         if callbacks:
             for cb in callbacks:
@@ -129,33 +154,41 @@ class JKBt(BtBms):
             self.logger.info("normal connect failed (%s), connecting with scanner", str(e) or type(e))
             await self._connect_with_scanner(timeout=timeout)
 
-        service = self.get_service(self.SERVICE_UUID)
-        self.char_handle_write = self.find_char(self.CHAR_UUID, 'write', service=service)
-
-        if self.char_handle_write and hasattr(self.char_handle_write,
-                                              'handle') and self.char_handle_write.handle == 0x03:
-            # from https://github.com/syssi/esphome-jk-bms/blob/main/components/jk_bms_ble/jk_bms_ble.cpp#L197C17-L197C17
-            self.char_handle_notify = self.find_char(0x05, 'notify')
-
-        if not self.char_handle_notify:
-            # there might be 2 chars with same uuid (weird?), one for notify/read and one for write
-            # https://github.com/fl4p/batmon-ha/issues/83
-            self.char_handle_notify = self.find_char(self.CHAR_UUID, 'notify')
-
-        self.logger.debug('char_handle_notify=%s, char_handle_write=%s', self.char_handle_notify,
-                          self.char_handle_write)
-
+        self._find_chars()
+        self._frames.reset()
         await self.start_notify(self.char_handle_notify, self._notification_handler)
 
-        await self._q(cmd=0x97, resp=0x03)  # device info
+        if not self.meta.get('device_info'):
+            await self._q(cmd=0x97, resp=0x03)  # device info, otherwise queried on fetch_device_info()
         await self._q(cmd=0x96, resp=(0x02, 0x01))  # device state (resp 0x01 & 0x02)
         # after these 2 commands the bms will continuously send 0x02-type messages
 
         buf, _ = self._resp_table[0x01]
         self.num_cells = buf[114]
         assert 0 < self.num_cells <= 24, "num_cells unexpected %s" % self.num_cells
+        self.update_meta(num_cells=self.num_cells)
+        self._is_new_11fw_checked = False
         # self.capacity = int.from_bytes(buf[130:134], byteorder='little', signed=False) * 0.001
 
+    def _find_chars(self):
+        # the gatt map is indexed and persisted, so this is a few dict lookups
+        service = self.get_service(self.SERVICE_UUID)
+        write = self.gatt.find(self.CHAR_UUID, 'write', service=service)
+        notify = None
+
+        if write and write.handle == 0x03:
+            # from https://github.com/syssi/esphome-jk-bms/blob/main/components/jk_bms_ble/jk_bms_ble.cpp#L197C17-L197C17
+            notify = self.gatt.find(0x05, 'notify')
+
+        if not notify:
+            # there might be 2 chars with same uuid (weird?), one for notify/read and one for write
+            # https://github.com/fl4p/batmon-ha/issues/83
+            notify = self.gatt.find(self.CHAR_UUID, 'notify')
+
+        self.char_handle_write = write and write.specifier()
+        self.char_handle_notify = notify and notify.specifier()
+        self.logger.debug('char_handle_notify=%s, char_handle_write=%s', notify, write)
+
     async def disconnect(self):
         await self.client.stop_notify(self.char_handle_notify)
         await super().disconnect()
@@ -176,6 +209,8 @@ class JKBt(BtBms):
     async def fetch_device_info(self):
         # https://github.com/jblance/mpp-solar/blob/master/mppsolar/protocols/jkabstractprotocol.py
         # https://github.com/syssi/esphome-jk-bms/blob/main/components/jk_bms_ble/jk_bms_ble.cpp#L1152
+        if 0x03 not in self._resp_table:
+            await self._q(cmd=0x97, resp=0x03)
         buf, _ = self._resp_table[0x03]
         psk = read_str(buf, 6 + 16 + 8 + 16 + 40 + 11)
         if psk:
@@ -191,46 +226,29 @@ class JKBt(BtBms):
     def _decode_sample(self, buf: bytearray, t_buf: float) -> BmsSample:
         buf_set, t_set = self._resp_table[0x01]
 
-        is_new_11fw = buf[189] in {0x0, 0x1} and buf[189 + 32] > 0  # 32 cell version
-        offset = 0
-        if is_new_11fw:
-            offset = 32
-            self.logger.debug('New 11.x firmware, offset=%s', offset)
-
-        i16 = lambda i: int.from_bytes(buf[i:(i + 2)], byteorder='little', signed=True)
-        u32 = lambda i: int.from_bytes(buf[i:(i + 4)], byteorder='little', signed=False)
-        f32u = lambda i: u32(i) * 1e-3
-        f32s = lambda i: int.from_bytes(buf[i:(i + 4)], byteorder='little', signed=True) * 1e-3
-
-        temp = lambda x: float('nan') if x == -2000 else (x / 10)
-
-        temperatures = [temp(i16(130 + offset)), temp(i16(132 + offset))]
+        is_new_11fw = self._is_new_11fw
+        if is_new_11fw is None or not self._is_new_11fw_checked:
+            # detect the frame layout once per connection instead of on every sample
+            is_new_11fw = buf[189] in {0x0, 0x1} and buf[189 + 32] > 0  # 32 cell version
+            self._is_new_11fw = is_new_11fw
+            self._is_new_11fw_checked = True
+            self.update_meta(is_new_11fw=is_new_11fw)
         if is_new_11fw:
-            temperatures += [temp(i16(224 + offset)), temp(i16(226 + offset))]
+            self.logger.debug('New 11.x firmware, 32 cell layout')
+            d = JK02_32_CELL_INFO.decode(buf, base=32)
+            temperatures = [d.pop('temp1'), d.pop('temp2'), d.pop('temp3'), d.pop('temp4')]
+        else:
+            d = JK02_CELL_INFO.decode(buf)
+            temperatures = [d.pop('temp1'), d.pop('temp2')]
 
         return BmsSample(
-            voltage=f32u(118 + offset),
-            current=-f32s(126 + offset),
-            soc=buf[141 + offset],
-
-            cycle_capacity=f32u(154 + offset),  # total charge TODO rename cycle charge
-            capacity=f32u(146 + offset),  # computed capacity (starts at self.capacity, which is user-defined),
-            charge=f32u(142 + offset),  # "remaining capacity"
-
+            **d,
             temperatures=temperatures,
-            mos_temperature=i16((112 if is_new_11fw else 134) + offset) / 10,
-            balance_current=i16(138 + offset) / 1000,
-
-            # 146 charge_full (see above)
-            num_cycles=u32(150 + offset),
             switches=dict(
                 charge=bool(buf_set[118]),
                 discharge=bool(buf_set[122]),
                 balance=bool(buf_set[126]),
             ),
-            #  #buf[166 + offset]),  charge FET state
-            # buf[167 + offset]), discharge FET state
-            uptime=float(u32(162 + offset)),  # seconds
             timestamp=t_buf,
         )
 
@@ -244,8 +262,8 @@ class JKBt(BtBms):
         """
 
         if wait:
-            with await self._fetch_futures.acquire_timeout(0x02, timeout=self.TIMEOUT / 2):
-                await self._fetch_futures.wait_for(0x02, self.TIMEOUT)
+            # the BMS streams 0x02 frames, wait for the next one along with other consumers
+            await self._fetch_futures.next_result(0x02, self.TIMEOUT)
 
         if 0x01 not in self._resp_table:
             await self._q(cmd=0x96, resp=0x01)  # query settings
@@ -254,7 +272,21 @@ class JKBt(BtBms):
         return self._decode_sample(buf, t_buf)
 
     async def subscribe(self, callback: Callable[[BmsSample], None]):
-        self._callbacks[0x02].append(lambda buf: callback(self._decode_sample(buf, t_buf=time.time())))
+        # the BMS streams 0x02 frames after the 0x96 command (see connect())
+        def on_frame(buf):
+            if 0x01 in self._resp_table:
+                callback(self._decode_sample(buf, t_buf=time.time()))
+            elif not self._settings_query or self._settings_query.done():
+                # set_switch() invalidated the settings frame (switch states), fetch() would re-query it
+                self._settings_query = asyncio.ensure_future(self._query_settings())
+
+        self._callbacks[0x02].append(on_frame)
+
+    async def _query_settings(self):
+        try:
+            await self._q(cmd=0x96, resp=0x01)
+        except Exception as e:
+            self.logger.warning('%s error querying settings: %s', self.name, e)
 
     async def fetch_voltages(self):
         """
@@ -263,9 +295,7 @@ class JKBt(BtBms):
         if self.num_cells is None:
             raise Exception("num_cells not set")
         buf, t_buf = self._resp_table[0x02]
-        voltages = [int.from_bytes(buf[(6 + i * 2):(6 + i * 2 + 2)], byteorder='little') for i in
-                    range(self.num_cells)]
-        return voltages
+        return JK02_CELL_VOLTAGES.decode(buf, 6, self.num_cells).tolist()
 
     async def set_switch(self, switch: str, state: bool):
         # from https://github.com/syssi/esphome-jk-bms/blob/4079c22eaa40786ffa0cabd45d0d98326a1fdd29/components/jk_bms_ble/switch/__init__.py
@@ -25,6 +25,7 @@ import statistics
 from bmslib import FuturesPool
 from bmslib.bms import BmsSample
 from bmslib.bt import BtBms
+from bmslib.frame import FrameReassembler
 
 
 def get_str(ubit, uuid):
@@ -80,30 +81,28 @@ def _sok_command(command: int):
 
 
 class SokBt(BtBms):
+    PIPELINE_SAFE = frozenset({0xC0, 0xC1, 0xC2})
     UUID_RX = '0000ffe1-0000-1000-8000-00805f9b34fb'
     UUID_TX = '0000ffe2-0000-1000-8000-00805f9b34fb'
     TIMEOUT = 10
 
     def __init__(self, address, **kwargs):
         super().__init__(address, **kwargs)
-        self._buffer = bytearray()
+        # frames end with 'w', received in a single notification or split with the end in the last one
+        self._frames = FrameReassembler(self._on_frame, terminator=b'w', name=self.name)
         self._fetch_futures = FuturesPool()
         self._switches = None
 
     def _notification_handler(self, sender, data):
         self.logger.debug("ble data frame %s", data)
-        self._buffer += data
+        self._frames.feed(data)
 
-        if self._buffer.endswith(b'w'):
-            command = self._buffer[1]
-            buf = self._buffer[:]
-            self._buffer.clear()
-
-            # print(command, 'buffer endswith w', self._buffer)
-            self._fetch_futures.set_result(command, buf)
+    def _on_frame(self, frame: memoryview):
+        self._fetch_futures.set_result(frame[1], bytearray(frame))
 
     async def connect(self, **kwargs):
         await super().connect(**kwargs)
+        self._frames.reset()
         await self.client.start_notify(self.UUID_RX, self._notification_handler)
 
     async def disconnect(self):
@@ -111,14 +110,20 @@ class SokBt(BtBms):
         self._fetch_futures.clear()
         await super().disconnect()
 
+    async def _write_command(self, cmd):
+        await self.client.write_gatt_char(self.UUID_TX, data=_sok_command(cmd))
+
     async def _q(self, cmd):
         with self._fetch_futures.acquire(cmd):
-            await self.client.write_gatt_char(self.UUID_TX, data=_sok_command(cmd))
+            await self._write_command(cmd)
             return await self._fetch_futures.wait_for(cmd, self.TIMEOUT)
 
     async def fetch(self) -> BmsSample:
+        # info, name and year/mv/hot are pipelined, the repeated 0xC2 (detail) can only follow after
+        info, name, year_mv, detail = await self._q_pipelined([0xC1, 0xC0, 0xC2, 0xC2], self._write_command,
+                                                             self.TIMEOUT)
 
-        buf = await self._q(cmd=0xC1)  # info
+        buf = info
         logging.debug(f'SOK: Received [{bytes(buf).hex().upper()}]')
         # this is not accurate, find out why
         # self.volts = (getLeInt3(value, 2) * 4) / 1000**2
@@ -128,7 +133,7 @@ class SokBt(BtBms):
         # ema = getLeInt3(buf, 8) / 1000 # not sure what this is
         current = getLeInt3(buf, 11) / 1000
 
-        buf = await self._q(cmd=0xC0)  # name
+        buf = name
         logging.debug(f'SOK: Received [{bytes(buf).hex().upper()}]')
         # name = bytes(buf[2:10]).decode('utf-8').rstrip()
 
@@ -136,13 +141,13 @@ class SokBt(BtBms):
         # logging.debug(f'SOK: Received [{bytes(buf).hex().upper()}]')
         # temp = getLeShort(buf, 5)
 
-        buf = await self._q(cmd=0xC2)  # year, mv, hot
+        buf = year_mv
         logging.debug(f'SOK: Received [{bytes(buf).hex().upper()}]')
         # year = 2000 + buf[2]
         rated = getBeUint3(buf, 5) / 128
         # heater_on = getLeUShort(buf,8)
 
-        buf = await self._q(cmd=0xC2)  # detail
+        buf = detail
         logging.debug(f'SOK: Received [{bytes(buf).hex().upper()}]')
         cells = [0, 0, 0, 0]
         for x in range(0, 4):
@@ -13,6 +13,7 @@ import asyncio
 
 from bmslib.bms import BmsSample
 from bmslib.bt import BtBms
+from bmslib.frame import FrameReassembler
 
 
 class SuperVoltBt(BtBms):
@@ -25,6 +26,7 @@ class SuperVoltBt(BtBms):
         self.notificationReceived = False
 
         self.data = None
+        self._frames = FrameReassembler(self._on_frame, header=b':', terminator=b'~', name=self.name)
         self._switches = None
     
         self.num_cell = 4
@@ -54,20 +56,18 @@ class SuperVoltBt(BtBms):
         if self.verbose_log:
             self.logger.info(f"notification: {data.hex()} {sender}")
         if data is not None:
-            # ':' is the start of a new data set
-            if data[0] == ord(':'):
-                self.data = data
-            else:
-                self.data += data
-            # Check if self.data is complete, it should start with ':' and end with '~'
-            if self.data[0] == ord(':') and data[-1] == ord('~'):
-                self.parseData(self.data)
-                self.lastUpdatetime = time.time()
-                self.notificationReceived = True
+            # a data set starts with ':' and ends with '~'
+            self._frames.feed(data)
         else:
             self.data = None
             self.notificationReceived = True
 
+    def _on_frame(self, frame: memoryview):
+        self.data = bytes(frame)
+        self.parseData(self.data)
+        self.lastUpdatetime = time.time()
+        self.notificationReceived = True
+
     async def waitForNotification(self, timeS: float) -> bool:
         start = time.time()
         await asyncio.sleep(0.1)
@@ -77,6 +77,7 @@ class SuperVoltBt(BtBms):
 
     async def connect(self, **kwargs):
         await super().connect(**kwargs)
+        self._frames.reset()
         await self.client.start_notify(self.UUID_RX, self._notification_handler)
 
     async def disconnect(self):
@@ -7,7 +7,9 @@ import math
 import sys
 import time
 from functools import partial
-from typing import Optional
+from typing import Optional, List, Callable
+
+import bleak.exc
 
 from bmslib.bms import BmsSample, DeviceInfo
 from bmslib.bt import BtBms
@@ -55,6 +57,7 @@ class SmartShuntBt(BtBms):
         self._keep_alive_task: Optional[asyncio.Task] = None
         self._values = {}
         self._values_t = {k: 0 for k in VICTRON_CHARACTERISTICS.keys()}
+        self._push_callbacks: List[Callable[[BmsSample], None]] = []
 
     async def _keep_alive_loop(self):
         interval = 20_000
@@ -68,17 +71,25 @@ class SmartShuntBt(BtBms):
             await asyncio.sleep(interval / 1000 / 2)
 
     async def _fetch_value(self, key: str, reload_services=False):
-        if reload_services:
-            await self.client.get_services()
         char = VICTRON_CHARACTERISTICS[key]
-        data = await asyncio.wait_for(self.client.read_gatt_char(char['uuid']), timeout=self.TIMEOUT)
+        spec = self.find_char(char['uuid'], 'read') or char['uuid']
+        try:
+            data = await asyncio.wait_for(self.client.read_gatt_char(spec), timeout=self.TIMEOUT)
+        except (bleak.exc.BleakError, KeyError, ValueError) as e:
+            if not reload_services:
+                raise
+            # the gatt map might be stale, re-discover services only now
+            self.logger.info('%s read %s failed (%s), reloading services', self.name, key, e)
+            await self.refresh_gatt()
+            data = await asyncio.wait_for(self.client.read_gatt_char(char['uuid']), timeout=self.TIMEOUT)
         return parse_value(data, char)
 
     async def _subscribe(self, key: str, val=None):
         char = VICTRON_CHARACTERISTICS[key]
         self._values[key] = val or await self._fetch_value(key)
         self._values_t[key] = time.time()
-        await self.start_notify(char['uuid'], partial(self._handle_notification, key))
+        await self.start_notify(self.find_char(char['uuid'], 'notify') or char['uuid'],
+                                partial(self._handle_notification, key))
 
     async def connect(self, timeout=8):
         await super().connect(timeout=timeout)
@@ -101,6 +112,20 @@ class SmartShuntBt(BtBms):
         self._values[key] = val
         self._values_t[key] = time.time()
         self.logger.debug('msg %s %s', key, val)
+        if self._push_callbacks and len(self._values) == len(VICTRON_CHARACTERISTICS):
+            sample = self._sample()
+            for callback in self._push_callbacks:
+                callback(sample)
+
+    async def subscribe(self, callback: Callable[[BmsSample], None]):
+        # each characteristic notification yields a sample with the latest values
+        self._push_callbacks.append(callback)
+
+    def _sample(self) -> BmsSample:
+        values = self._values
+        # all values n/a (e.g. no battery connected) time stamps the sample with the current time
+        return BmsSample(**values, timestamp=max((v for k, v in self._values_t.items() if not math.isnan(values[k])),
+                                                 default=time.time()))
 
     async def fetch(self) -> BmsSample:
 
@@ -112,9 +137,7 @@ class SmartShuntBt(BtBms):
                 if val != self._values.get(k):
                     self.logger.warning('value for %s expired %s, re-sub', k, t)
                     await self._subscribe(k, val)
-        values = self._values
-        sample = BmsSample(**values, timestamp=max(v for k, v in self._values_t.items() if not math.isnan(values[k])))
-        return sample
+        return self._sample()
 
     async def fetch_voltages(self):
         return []
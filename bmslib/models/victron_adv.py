@@ -0,0 +1,206 @@
+"""
+Victron devices (SmartShunt, BMV) read from their BLE advertisements ("Instant Readout"), without a connection.
+
+Enable Instant Readout in the VictronConnect app (Product info -> Instant readout via Bluetooth) and copy the
+encryption key ("Show encryption data") to the device's `adv_key` option.
+The advertisements are received by the shared scanner (see bmslib/scanner.py). Decryption needs the `cryptography`
+package (installed on start-up by install_bleak.py if a `victron_adv` device is configured).
+
+ https://community.victronenergy.com/questions/187303/victron-bluetooth-advertising-protocol.html
+ https://github.com/keshavdv/victron-ble
+"""
+import asyncio
+import math
+import time
+from typing import Optional, List, Callable
+
+from bmslib.bms import BmsSample, DeviceInfo
+from bmslib.bt import BtBms
+from bmslib.scanner import get_scanner
+
+VICTRON_MANUFACTURER_ID = 0x02E1
+INSTANT_READOUT_PREFIX = 0x10
+RECORD_BATTERY_MONITOR = 0x02
+
+AUX_STARTER_VOLTAGE = 0
+AUX_MIDPOINT_VOLTAGE = 1
+AUX_TEMPERATURE = 2
+
+MODEL_NAMES = {
+    0xA389: 'SmartShunt 500A/50mV',
+}
+
+
+class AdvertisementKeyMismatch(Exception):
+    pass
+
+
+class _Bits:
+    """ Reads little-endian bit fields, least significant bit first """
+
+    def __init__(self, data: bytes):
+        self._value = int.from_bytes(data, 'little')
+
+    def unsigned(self, n: int, na: Optional[int] = None) -> float:
+        v = self._value & ((1 << n) - 1)
+        self._value >>= n
+        return math.nan if v == na else v
+
+    def signed(self, n: int, na: Optional[int] = None) -> float:
+        v = self.unsigned(n)
+        if v == na:
+            return math.nan
+        return v - (1 << n) if v >= 1 << (n - 1) else v
+
+
+def decrypt(data: bytes, key: bytes) -> (int, bytes):
+    """
+    Decrypt an Instant Readout record (the manufacturer data of company 0x02E1).
+    :return: (record type, plain text)
+    """
+    if len(data) < 9 or data[0] != INSTANT_READOUT_PREFIX:
+        raise ValueError('not an instant readout record: %s' % data.hex())
+    record_type = data[4]
+    iv = int.from_bytes(data[5:7], 'little')
+    if data[7] != key[0]:
+        raise AdvertisementKeyMismatch('advertisement key mismatch (0x%02x)' % data[7])
+    encrypted = data[8:]
+
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    # AES-CTR with a little-endian counter starting at iv
+    ecb = Cipher(algorithms.AES(key), modes.ECB()).encryptor()
+    key_stream = b''.join(ecb.update((iv + i).to_bytes(16, 'little')) for i in range((len(encrypted) + 15) // 16))
+    return record_type, bytes(a ^ b for a, b in zip(encrypted, key_stream))
+
+
+def parse_battery_monitor(plain: bytes) -> dict:
+    bits = _Bits(plain)
+    values = dict(
+        remaining_mins=bits.unsigned(16, na=0xFFFF),
+        voltage=bits.signed(16, na=0x7FFF) * .01,
+        alarm=bits.unsigned(16),
+    )
+    aux = bits.unsigned(16)
+    aux_mode = bits.unsigned(2)
+    values.update(
+        current=bits.signed(22, na=0x3FFFFF) * .001,
+        consumed_ah=-bits.unsigned(20, na=0xFFFFF) * .1,
+        soc=bits.unsigned(10, na=0x3FF) * .1,
+    )
+    if aux_mode == AUX_STARTER_VOLTAGE:
+        values['starter_voltage'] = (aux - 0x10000 if aux >= 0x8000 else aux) * .01
+    elif aux_mode == AUX_MIDPOINT_VOLTAGE:
+        values['midpoint_voltage'] = aux * .01
+    elif aux_mode == AUX_TEMPERATURE:
+        values['temperature'] = round(aux * .01 - 273.15, 2)
+    return values
+
+
+class VictronAdvBt(BtBms):
+    TIMEOUT = 10  # Victron devices advertise about once a second
+
+    def __init__(self, address, adv_key: str = None, **kwargs):
+        super().__init__(address, **kwargs)
+        if not adv_key:
+            raise ValueError('%s: victron_adv requires the `adv_key` option (encryption key from VictronConnect)'
+                             % self.name)
+        self._key = bytes.fromhex(adv_key.strip())
+        self._scanner = get_scanner(self._adapter)
+        self._listening = False
+        self._last_iv = None
+        self._model_id = None
+        self._values = None
+        self._t_values = 0.
+        self._t_fetched = 0.
+        self._new_values = asyncio.Event()
+        self._push_callbacks: List[Callable[[BmsSample], None]] = []
+
+    @property
+    def is_connected(self):
+        return self._listening
+
+    async def connect(self, timeout=None):
+        await self._scanner.start()
+        self._scanner.add_listener(self._on_advertisement)
+        self._listening = True
+
+    async def disconnect(self):
+        self._scanner.remove_listener(self._on_advertisement)
+        self._listening = False
+
+    async def __aenter__(self):
+        # no connection, doesn't take a connection slot
+        if not self._listening:
+            await self.connect()
+
+    async def __aexit__(self, *args):
+        pass
+
+    def _on_advertisement(self, device, adv_data):
+        if device.address != self.address:
+            return
+        data = adv_data.manufacturer_data.get(VICTRON_MANUFACTURER_ID)
+        if not data or len(data) < 9 or data[0] != INSTANT_READOUT_PREFIX:
+            return
+        iv = data[5:7]
+        if iv == self._last_iv:
+            return  # repeated advertisement
+        try:
+            record_type, plain = decrypt(data, self._key)
+        except AdvertisementKeyMismatch as e:
+            self.logger.error('%s: %s, check the adv_key option', self.name, e)
+            return
+        if record_type != RECORD_BATTERY_MONITOR:
+            self.logger.debug('%s: ignore record type 0x%02x', self.name, record_type)
+            return
+        self._last_iv = iv
+        self._model_id = int.from_bytes(data[2:4], 'little')
+        self._values = parse_battery_monitor(plain)
+        self._t_values = time.time()
+        self._new_values.set()
+        for callback in self._push_callbacks:
+            callback(self._sample())
+
+    async def subscribe(self, callback: Callable[[BmsSample], None]):
+        self._push_callbacks.append(callback)
+
+    @property
+    def supports_push(self) -> bool:
+        return True  # no connection to keep alive
+
+    async def fetch(self) -> BmsSample:
+        if self._t_values <= self._t_fetched:
+            self._new_values.clear()
+            await asyncio.wait_for(self._new_values.wait(), timeout=self.TIMEOUT)
+        self._t_fetched = self._t_values
+        return self._sample()
+
+    def _sample(self) -> BmsSample:
+        v = self._values
+        temp = v.get('temperature')
+        return BmsSample(
+            voltage=v['voltage'],
+            current=-v['current'],  # positive current is discharge
+            charge=v['consumed_ah'],
+            soc=v['soc'],
+            temperatures=[temp] if temp is not None else None,
+            timestamp=self._t_values,
+        )
+
+    async def fetch_voltages(self):
+        return []
+
+    async def fetch_temperatures(self):
+        temp = self._values and self._values.get('temperature')
+        return [temp] if temp is not None else []
+
+    async def fetch_device_info(self) -> DeviceInfo:
+        model = MODEL_NAMES.get(self._model_id) or (self._model_id and 'Victron 0x%04X' % self._model_id)
+        return DeviceInfo(
+            mnf="Victron",
+            model=model or 'SmartShunt',
+            hw_version=None,
+            sw_version=None,
+            name=None,
+            sn=None,
+        )
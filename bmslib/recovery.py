@@ -0,0 +1,98 @@
+"""
+Tiered in-process recovery.
+
+Instead of exiting the process when sampling or publishing stalls, escalate through recovery actions of increasing
+cost (reconnect MQTT, recreate a device's BleakClient, power-cycle the bluetooth adapter) and check after each one
+whether things are healthy again. Only when all tiers failed the caller should exit the process.
+
+"""
+import asyncio
+import math
+import time
+from typing import Callable, Awaitable, List, Dict, Optional
+
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+
+class RecoveryTier:
+    def __init__(self, name: str, action: Callable[[], Awaitable], settle_time: float):
+        """
+        :param name:
+        :param action: coroutine function performing the recovery action
+        :param settle_time: time to wait for the health check to pass after the action
+        """
+        self.name = name
+        self.action = action
+        self.settle_time = settle_time
+
+
+class TierStats:
+    def __init__(self):
+        self.num_attempts = 0
+        self.num_recovered = 0
+        self.ttr_sum = 0.
+        self.ttr_max = 0.
+
+    def add(self, ttr: float):
+        self.num_recovered += 1
+        self.ttr_sum += ttr
+        self.ttr_max = max(self.ttr_max, ttr)
+
+    def __repr__(self):
+        ttr_mean = self.ttr_sum / self.num_recovered if self.num_recovered else math.nan
+        return 'attempts=%d recovered=%d ttr_mean=%.1fs ttr_max=%.1fs' % (
+            self.num_attempts, self.num_recovered, ttr_mean, self.ttr_max)
+
+
+# time-to-recover by tier name, over all TieredRecovery instances
+recovery_stats: Dict[str, TierStats] = {}
+
+
+class TieredRecovery:
+    """
+    Runs the recovery tiers in order until `is_healthy()` returns True.
+    Time-to-recover is measured from the start of the recovery (or the given stall detection time) to the first
+    successful health check.
+    """
+
+    def __init__(self, name: str, tiers: List[RecoveryTier], poll_interval=1.):
+        self.name = name
+        self.tiers = tiers
+        self.poll_interval = poll_interval
+        self.running = False
+        self.last_ttr: Optional[float] = None
+
+    async def recover(self, is_healthy: Callable[[], bool], t_stall: Optional[float] = None) -> bool:
+        """
+        :param is_healthy: health check, polled after each tier's action
+        :param t_stall: time the stall was detected, defaults to now
+        :return: True if a tier recovered, False if all tiers failed
+        """
+        self.running = True
+        t_stall = t_stall or time.time()
+        try:
+            for tier in self.tiers:
+                stats = recovery_stats.setdefault(tier.name, TierStats())
+                stats.num_attempts += 1
+                logger.warning('%s: recovery tier %s', self.name, tier.name)
+                try:
+                    await tier.action()
+                except Exception as e:
+                    logger.error('%s: recovery tier %s error: %s', self.name, tier.name, e)
+
+                t_end = time.time() + tier.settle_time
+                while time.time() < t_end:
+                    if is_healthy():
+                        self.last_ttr = time.time() - t_stall
+                        stats.add(self.last_ttr)
+                        logger.info('%s: recovered by tier %s after %.1fs (%s)', self.name, tier.name,
+                                    self.last_ttr, stats)
+                        return True
+                    await asyncio.sleep(self.poll_interval)
+
+            logger.error('%s: all recovery tiers failed after %.1fs', self.name, time.time() - t_stall)
+            return False
+        finally:
+            self.running = False
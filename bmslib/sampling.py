@@ -6,7 +6,7 @@ import sys
 import time
 from collections import defaultdict
 from copy import copy
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Callable
 
 import paho.mqtt.client
 
@@ -14,14 +14,19 @@ import bmslib.bt
 from bmslib.algorithm import create_algorithm, BatterySwitches
 from bmslib.bms import DeviceInfo, BmsSample, MIN_VALUE_EXPIRY
 from bmslib.cache.mem import mem_cache_deco
+from bmslib.connection import CircuitOpenError
 from bmslib.group import BmsGroup, GroupNotReady
 from bmslib.pwmath import Integrator, DiffAbsSum, LHQ
+from bmslib.scanner import get_scanner
 from bmslib.util import get_logger
 from mqtt_util import publish_sample, publish_cell_voltages, publish_temperatures, publish_hass_discovery, \
     subscribe_switches, mqtt_single_out, round_to_n
 
 logger = get_logger(verbose=False)
 
+ACTIVITY_HOLD = 30  # keep sampling at the fast rate for this many seconds after a power change or switch command
+PUSH_POLL_FALLBACK = 5.  # in push mode, poll fetch() if the stream was silent this long after the sample was due
+
 
 class SampleExpiredError(Exception):
     pass
@@ -83,7 +88,10 @@ class BmsSampler:
                  algorithms: Optional[list] = None,
                  current_calibration_factor=1.0,
                  over_power=None,
-                 bms_group: Optional[BmsGroup] = None
+                 bms_group: Optional[BmsGroup] = None,
+                 period_min: Optional[float] = None,
+                 period_max: Optional[float] = None,
+                 freshness: Optional[float] = None,
                  ):
 
         self.bms = bms
@@ -111,8 +119,33 @@ class BmsSampler:
         self._last_power = 0
         self._t_last_power_jump = 0
 
+        # activity-adaptive sample period
+        self.period_min = period_min
+        self.period_max = period_max
+        self._period = period_min or 0
+        self._t_last_activity = 0
+        self._t_last_sample = 0
+        self.on_activity: Optional[Callable[[], None]] = None  # called to wake up the scheduler
+
+        # freshness target (max data age in seconds), the scheduler serves the devices furthest from it first
+        self.freshness = freshness
+        self.num_freshness_missed = 0
+
         self._num_errors = 0
         self._time_next_retry = 0
+        self._t_not_found = 0.
+
+        # push mode (see enable_push())
+        self._push_period: Optional[Callable[[], float]] = None
+        self._push_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._push_event: Optional[asyncio.Event] = None
+        self._pushed: Optional[BmsSample] = None
+        self._subscribed = False
+        self.num_pushed = 0
+        self.num_push_fallbacks = 0
+
+        self._device_info_cached = False
+        self.t_first_publish: Optional[float] = None  # time of the first MQTT publish after start-up
 
         self.algorithm = None
         if algorithms:
@@ -144,6 +177,101 @@ class BmsSampler:
         temp_smooth = getattr(bms, 'TEMPERATURE_SMOOTH', 10)
         self._lhq_temp = defaultdict(lambda: LHQ(span=temp_smooth, inp_q=temp_step)) if temp_step else None
 
+    def notify_activity(self):
+        """ Switch to the fast sample rate, e.g. when a switch command is pending """
+        self._t_last_activity = time.time()
+        if self.period_max and self._period > (self.period_min or 0):
+            self._period = 0
+            self.on_activity and self.on_activity()
+
+    def next_period(self, default: float) -> float:
+        """
+        Sample period for the next sample. With `period_max` set, the period backs off from `period_min` to
+        `period_max` while the battery is idle and drops back to `period_min` on activity.
+        :param default: the global sample period
+        :return:
+        """
+        if not self.period_max:
+            return default
+        p_min = self.period_min or default
+        if time.time() - self._t_last_activity < ACTIVITY_HOLD:
+            self._period = p_min
+        else:
+            self._period = min(self.period_max, max(p_min, self._period * 1.5))
+        return self._period
+
+    def is_due(self, default: float, tolerance: float = 0) -> bool:
+        """ For serial sampling, whether this sampler's period has elapsed since the last sample """
+        if not self.period_max:
+            return True
+        return time.time() + tolerance >= self._t_last_sample + self.next_period(default)
+
+    @property
+    def t_last_sample(self) -> float:
+        """ Time of the last successful sample, 0 if none yet """
+        return self._t_last_sample
+
+    def urgency(self, default: float) -> float:
+        """
+        Age of the last sample relative to the freshness target. Without a target the current sample period is
+        the target.
+        :param default: the global sample period
+        """
+        target = self.freshness or self._period or default
+        return (time.time() - self._t_last_sample) / target
+
+    def enable_push(self, sample_period: float):
+        """
+        Push mode: process the samples the BMS streams (see `BtBms.subscribe()`) as they arrive, instead of polling
+        `fetch()`. Samples arriving faster than the sample period are coalesced, the most recent one is processed.
+        Call `self()` in a loop, each call returns after processing the next sample.
+        :param sample_period: the global sample period (rate limit), 0 processes every sample
+        """
+        self._push_period = lambda: self.next_period(sample_period)
+
+    @property
+    def is_push(self) -> bool:
+        return self._push_period is not None
+
+    def _on_push(self, sample: BmsSample):
+        # bleak calls back on the event loop thread, the dummy clients from a thread
+        self._pushed = sample
+        self.num_pushed += 1
+        try:
+            in_loop = asyncio.get_running_loop() is self._push_loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            self._push_event.set()
+        else:
+            self._push_loop.call_soon_threadsafe(self._push_event.set)
+
+    async def _fetch_pushed(self) -> BmsSample:
+        bms = self.bms
+        if not self._subscribed:
+            self._push_loop = asyncio.get_running_loop()
+            self._push_event = asyncio.Event()
+            await bms.subscribe(self._on_push)
+            self._subscribed = True
+
+        # rate limit
+        t_due = self._t_last_sample + self._push_period()
+        if t_due > time.time():
+            await asyncio.sleep(t_due - time.time())
+
+        if self._pushed is None:
+            self._push_event.clear()
+            try:
+                await asyncio.wait_for(self._push_event.wait(), timeout=PUSH_POLL_FALLBACK)
+            except asyncio.TimeoutError:
+                # stream stalled (or the values didn't change), poll
+                self.num_push_fallbacks += 1
+                logger.debug('%s no sample pushed for %.0fs, polling', bms.name, PUSH_POLL_FALLBACK)
+                return await bms.fetch()
+
+        sample, self._pushed = self._pushed, None
+        return sample
+
     def get_meter_state(self):
         return {meter.name: dict(reading=meter.get()) for meter in self.meters}
 
@@ -159,7 +287,14 @@ class BmsSampler:
         except bmslib.bt.BleakDeviceNotFoundError:
             t_wait = min(1.5 ** self._num_errors, 120)
             logger.error("%s device not found, retry in %d seconds", self.bms, t_wait)
-            self._time_next_retry = time.time() + t_wait
+            self._t_not_found = time.time()
+            self._time_next_retry = self._t_not_found + t_wait
+            return None
+
+        except CircuitOpenError as e:
+            if t_now - self._last_time_log >= 60 or self.bms.verbose_log:
+                self._last_time_log = t_now
+                logger.warning("%s", e)
             return None
 
         except SampleExpiredError as e:
@@ -218,8 +353,15 @@ class BmsSampler:
 
         if not was_connected and t_conn < self._time_next_retry:
             logger.debug('retry in %.0f sec', self._time_next_retry - t_conn)
-            await asyncio.sleep(4)
-            return None
+            # retry as soon as the shared scanner sees the device again
+            adv = await get_scanner(bms.adapter).wait_for(
+                bms.address, timeout=4, since=max(self._t_not_found, t_conn - bmslib.bt.SCAN_MAX_AGE))
+            if adv is None:
+                return None
+            logger.info('%s advertised again (%s), retry now', bms.name, adv)
+            self._time_next_retry = 0
+            if not bms.is_virtual:
+                bms.circuit_breaker.probe_now()
 
         if not was_connected and not bms.is_virtual:
             logger.info('connecting bms %s', bms)
@@ -229,12 +371,16 @@ class BmsSampler:
                 logger.info('connected bms %s!', bms)
 
             if self.device_info is None and self.num_samples == 0:
-                # try to fetch device info first. if bms.fetch() fails we might have at least some details
-                await self._try_fetch_device_info()
+                # use device info from the previous run, it is re-validated with the next HA discovery
+                self.device_info = bms.cached_device_info()
+                self._device_info_cached = self.device_info is not None
+                if self.device_info is None:
+                    # try to fetch device info first. if bms.fetch() fails we might have at least some details
+                    await self._try_fetch_device_info()
 
             t_fetch = time.time()
 
-            sample = await bms.fetch()
+            sample = await (self._fetch_pushed() if self._push_period else bms.fetch())
 
             t_now = time.time()
             t_hour = t_now * (1 / 3600)
@@ -289,6 +435,7 @@ class BmsSampler:
                         store_algorithm_state(bms.name, algorithm_name=self.algorithm.name, state=state.__dict__)
 
                 if res and res.switches:
+                    self.notify_activity()
                     for swk in sample.switches.keys():
                         if res.switches[swk] is not None:
                             logger.info('%s algo set %s switch -> %s', bms.name, swk, res.switches[swk])
@@ -297,7 +444,7 @@ class BmsSampler:
             if self.num_samples == 0 and sample.switches and mqtt_client:
                 logger.info("%s subscribing for %s switch change", bms.name, sample.switches)
                 subscribe_switches(mqtt_client, device_topic=self.mqtt_topic_prefix, bms=bms,
-                                   switches=sample.switches.keys())
+                                   switches=sample.switches.keys(), on_command=self.notify_activity)
 
             for sink in self.sinks:
                 try:
@@ -348,6 +495,8 @@ class BmsSampler:
                     logger.info('%s Power jump %.0f %% (prev=%.0f last=%.0f, REG=%.0f)', bms.name, power_chg * 100,
                                 self._last_power, sample.power, PWR_CHG_REG)
                 self._t_last_power_jump = t_now
+            if abs(power_chg) > 0.15:
+                self._t_last_activity = t_now
             self._last_power = sample.power
 
             if self.period_discov or self.period_pub or \
@@ -358,6 +507,8 @@ class BmsSampler:
 
                 publish_sample(mqtt_client, device_topic=self.mqtt_topic_prefix, sample=sample)
                 log_data and logger.info('%s: %s', bms.name, sample)
+                if self.t_first_publish is None:
+                    self.t_first_publish = t_now
 
                 voltages = await cached_fetch_voltages()
                 publish_cell_voltages(mqtt_client, device_topic=self.mqtt_topic_prefix, voltages=voltages)
@@ -377,10 +528,16 @@ class BmsSampler:
             if self.period_discov or self.period_30s:
                 self.publish_meters()
 
+            if self.period_discov and self.freshness and self.num_samples:
+                logger.info('%s freshness target %.1fs missed %d times in %d samples', bms.name, self.freshness,
+                            self.num_freshness_missed, self.num_samples)
+                mqtt_single_out(mqtt_client, f"{self.mqtt_topic_prefix}/stats/freshness_missed",
+                                self.num_freshness_missed)
+
             # publish home assistant discovery every 60 samples
             if self.period_discov:
                 logger.info("Sending HA discovery for %s (num_samples=%d)", bms.name, self.num_samples)
-                if self.device_info is None:
+                if self.device_info is None or (self._device_info_cached and self.num_samples > 0):
                     await self._try_fetch_device_info()
                 publish_hass_discovery(
                     mqtt_client, device_topic=self.mqtt_topic_prefix,
@@ -398,6 +555,9 @@ class BmsSampler:
 
         self.num_samples += 1
         t_disc = time.time()
+        if self.freshness and self._t_last_sample and t_now - self._t_last_sample > self.freshness:
+            self.num_freshness_missed += 1
+        self._t_last_sample = t_now
         self._t_wd_reset = sample.timestamp or t_disc
 
         self.period_pub.set_time(t_now)
@@ -434,6 +594,9 @@ class BmsSampler:
     async def _try_fetch_device_info(self):
         try:
             self.device_info = await self.bms.fetch_device_info()
+            self._device_info_cached = False
+            if self.device_info:
+                self.bms.update_meta(device_info=self.device_info.__dict__)
         except NotImplementedError:
             pass
         except Exception as e:
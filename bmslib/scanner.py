@@ -0,0 +1,170 @@
+"""
+Shared always-on bluetooth scanner.
+
+One BleakScanner per adapter runs for the lifetime of the process and maintains an advertisement cache (address,
+name, RSSI, last seen time and advertisement interval). Discovery, name resolution, the scan before connecting (JK,
+Daly, ANT) and the not-found back-off consult the cache instantly instead of starting a scan of their own.
+
+"""
+import asyncio
+import time
+from typing import Dict, Optional, List, Callable
+
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+INTERVAL_SMOOTHING = .2  # EWMA weight of the last advertisement interval
+
+
+class Advertisement:
+    def __init__(self, address: str):
+        self.address = address
+        self.name: Optional[str] = None
+        self.rssi: Optional[int] = None
+        self.t_first_seen = 0.
+        self.t_last_seen = 0.
+        self.num_seen = 0
+        self.interval: Optional[float] = None  # mean time between advertisements
+
+    def update(self, name: Optional[str], rssi: Optional[int], now: float):
+        if self.num_seen:
+            dt = now - self.t_last_seen
+            self.interval = dt if self.interval is None else \
+                (1 - INTERVAL_SMOOTHING) * self.interval + INTERVAL_SMOOTHING * dt
+        else:
+            self.t_first_seen = now
+        self.name = name or self.name
+        self.rssi = rssi
+        self.t_last_seen = now
+        self.num_seen += 1
+
+    def __repr__(self):
+        return 'Advertisement(%s,%s,rssi=%s,age=%.1fs,interval=%s)' % (
+            self.address, self.name, self.rssi, time.time() - self.t_last_seen,
+            self.interval and round(self.interval, 2))
+
+
+class SharedScanner:
+    def __init__(self, adapter: Optional[str] = None):
+        self.adapter = adapter
+        self.advertisements: Dict[str, Advertisement] = {}
+        self.t_start = 0.
+        self._scanner = None
+        self._start_task: Optional[asyncio.Future] = None
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        self._listeners: List[Callable] = []
+
+    @property
+    def running(self) -> bool:
+        return self._scanner is not None
+
+    async def start(self):
+        """ Start scanning, if not already running """
+        if self._scanner:
+            return
+        if self._start_task is None:
+            self._start_task = asyncio.ensure_future(self._start())
+        try:
+            await asyncio.shield(self._start_task)
+        except Exception:
+            self._start_task = None
+            raise
+
+    async def _start(self):
+        import bleak
+        kwargs = dict(detection_callback=self._on_detection)
+        if self.adapter:
+            kwargs['adapter'] = self.adapter
+        scanner = bleak.BleakScanner(**kwargs)
+        await scanner.start()
+        self._scanner = scanner
+        self.t_start = time.time()
+        logger.info('Shared scanner started on adapter %s', self.adapter or 'default')
+
+    async def stop(self):
+        scanner, self._scanner, self._start_task = self._scanner, None, None
+        if scanner:
+            await scanner.stop()
+
+    def add_listener(self, callback: Callable):
+        """ :param callback: called with (BLEDevice, AdvertisementData) for every advertisement """
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback: Callable):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _on_detection(self, device, adv_data):
+        adv = self.advertisements.get(device.address)
+        if adv is None:
+            adv = self.advertisements[device.address] = Advertisement(device.address)
+        adv.update(getattr(adv_data, 'local_name', None) or device.name, getattr(adv_data, 'rssi', None),
+                   time.time())
+
+        for fut in self._waiters.pop(device.address, []):
+            if not fut.done():
+                fut.set_result(adv)
+
+        for callback in self._listeners:
+            try:
+                callback(device, adv_data)
+            except Exception as e:
+                logger.error('Advertisement listener %s error: %s', callback, e)
+
+    def get(self, address: str, max_age: Optional[float] = None) -> Optional[Advertisement]:
+        adv = self.advertisements.get(address)
+        if adv and max_age is not None and time.time() - adv.t_last_seen > max_age:
+            return None
+        return adv
+
+    async def wait_for(self, address: str, timeout: float, since: float = 0.) -> Optional[Advertisement]:
+        """ Wait until `address` advertised after `since` """
+        adv = self.advertisements.get(address)
+        if adv and adv.t_last_seen > since:
+            return adv
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(address, []).append(fut)
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self._waiters.get(address)
+            if waiters and fut in waiters:
+                waiters.remove(fut)
+
+    async def discover(self, duration: float = 5.) -> List[Advertisement]:
+        """ Devices seen, after scanning for at least `duration` """
+        await self.start()
+        remaining = self.t_start + duration - time.time()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        return list(self.advertisements.values())
+
+
+_scanners: Dict[Optional[str], SharedScanner] = {}
+
+
+def get_scanner(adapter: Optional[str] = None) -> SharedScanner:
+    if adapter == 'default':
+        adapter = None
+    scanner = _scanners.get(adapter)
+    if scanner is None:
+        scanner = _scanners[adapter] = SharedScanner(adapter)
+    return scanner
+
+
+def find_advertisement(address: str = None, name: str = None) -> Optional[Advertisement]:
+    """ Most recent advertisement of a device (by address or name) on any adapter """
+    found = [adv for scanner in _scanners.values() for adv in scanner.advertisements.values()
+             if (address and adv.address == address) or (name and (adv.name or '').strip() == name.strip())]
+    return max(found, key=lambda adv: adv.t_last_seen, default=None)
+
+
+async def stop_scanners():
+    for scanner in _scanners.values():
+        try:
+            await scanner.stop()
+        except Exception as e:
+            logger.warning('Error stopping scanner %s: %s', scanner.adapter, e)
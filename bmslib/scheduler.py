@@ -0,0 +1,422 @@
+"""
+Deadline scheduler for periodic sampling jobs.
+
+Every job keeps an absolute next deadline (`deadline + period`) instead of sleeping `period` after each run, so the
+effective period does not grow with the fetch duration. All jobs share a single heap and a single runner coroutine,
+a job only occupies an asyncio task while it is actually running.
+
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import traceback
+from contextlib import asynccontextmanager
+from typing import Callable, Awaitable, Optional, Union, List, Dict, Tuple
+
+from bmslib.util import get_logger
+
+logger = get_logger()
+
+PeriodType = Union[float, Callable[[], float]]
+
+GOLDEN_RATIO_FRAC = 0.6180339887
+
+
+def _zero():
+    return 0.
+
+
+def parse_adapter_limits(s: Union[str, int, None]) -> Tuple[Dict[str, int], int]:
+    """
+    Parse a per-adapter limit option such as `hci0=3,hci1=5` or `3` (applies to all adapters).
+    :return: (limits by adapter, default limit)
+    """
+    limits = {}
+    default = 0
+    for part in filter(bool, str(s or '').replace(' ', '').split(',')):
+        if '=' in part:
+            adapter, n = part.split('=', 1)
+            limits[adapter] = int(n)
+        else:
+            default = int(part)
+    return limits, default
+
+
+class PrioritySlots:
+    """
+    Semaphore that grants a free slot to the waiter with the highest urgency (evaluated when the slot is granted).
+    Waiters with equal urgency are served in arrival order.
+    """
+
+    def __init__(self, n: int):
+        self.free = n
+        self._waiters: List[Tuple[Callable[[], float], asyncio.Future]] = []
+
+    async def acquire(self, urgency: Callable[[], float]):
+        if self.free > 0 and not self._waiters:
+            self.free -= 1
+            return
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters.append((urgency, fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # granted, but cancelled before we could use it
+            else:
+                self._waiters = [w for w in self._waiters if w[1] is not fut]
+            raise
+
+    def release(self):
+        self.free += 1
+        while self.free > 0 and self._waiters:
+            i = max(range(len(self._waiters)), key=lambda j: (self._waiters[j][0](), -j))
+            _, fut = self._waiters.pop(i)
+            if not fut.done():
+                self.free -= 1
+                fut.set_result(None)
+
+
+class AdapterLimiter:
+    """
+    Bounds the number of in-flight jobs per bluetooth adapter (hci0, hci1, ..).
+    A limit of 0 means unbounded. Jobs without an adapter (virtual devices) are never limited.
+    Under contention, the most urgent waiting job gets the next free slot.
+    """
+
+    def __init__(self, limits: Dict[str, int] = None, default=0):
+        self.limits = limits or {}
+        self.default = default
+        self._slots: Dict[str, PrioritySlots] = {}
+
+    def limit(self, adapter: str) -> int:
+        return self.limits.get(adapter, self.default)
+
+    @asynccontextmanager
+    async def slot(self, adapter: Optional[str], urgency: Optional[Callable[[], float]] = None):
+        """
+        :param adapter:
+        :param urgency: priority of the waiter, higher is served first
+        """
+        if adapter is None or not self.limit(adapter):
+            yield
+            return
+
+        slots = self._slots.get(adapter)
+        if slots is None:
+            slots = self._slots[adapter] = PrioritySlots(self.limit(adapter))
+
+        await slots.acquire(urgency or _zero)
+        try:
+            yield
+        finally:
+            slots.release()
+
+    def __str__(self):
+        return 'AdapterLimiter(%s,default=%s)' % (self.limits, self.default or 'unbounded')
+
+
+class ScheduledJob:
+    def __init__(self, fn: Callable[[], Awaitable], period: PeriodType, name: str, max_errors=0,
+                 adapter: Optional[str] = None, urgency: Optional[Callable[[], float]] = None):
+        self.fn = fn
+        self.period = period
+        self.name = name
+        self.max_errors = max_errors
+        self.adapter = adapter
+        self.urgency = urgency
+
+        self.deadline = math.nan
+        self.running = False
+        self.removed = False
+        self._gen = 0  # invalidates stale heap entries
+
+        self.num_errors_row = 0
+        self.num_runs = 0
+        self.num_missed = 0
+        self.t_last_start = math.nan
+        self.period_sum = 0.
+        self.period_max = 0.
+        self.lateness_max = 0.
+        self._t_last_missed_log = 0.
+
+    def get_period(self) -> float:
+        return float(self.period() if callable(self.period) else self.period)
+
+    def stats(self) -> dict:
+        n = max(1, self.num_runs - 1)
+        return dict(runs=self.num_runs, missed=self.num_missed,
+                    period_mean=round(self.period_sum / n, 3), period_max=round(self.period_max, 3),
+                    lateness_max=round(self.lateness_max, 3))
+
+    def __str__(self):
+        return 'Job(%s)' % self.name
+
+
+class DeadlineScheduler:
+    """
+    Runs coroutine functions periodically at absolute deadlines.
+    Jobs are spread over phase offsets within their period so they don't all hit the radio at the same time.
+    A job is never started again while it is still running, the deadlines it missed are counted and skipped.
+    """
+
+    def __init__(self, limiter: Optional[AdapterLimiter] = None):
+        self.limiter = limiter or AdapterLimiter()
+        self.jobs: List[ScheduledJob] = []
+        self.aborted: Optional[ScheduledJob] = None
+        self._heap = []
+        self._seq = itertools.count()
+        self._num_added = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks = set()
+        self._t_last_stats_log = math.nan
+
+    @staticmethod
+    def time():
+        return asyncio.get_event_loop().time()
+
+    def add(self, fn: Callable[[], Awaitable], period: PeriodType, name: str = None, max_errors=0,
+            phase: Optional[float] = None, adapter: Optional[str] = None,
+            urgency: Optional[Callable[[], float]] = None) -> ScheduledJob:
+        """
+        Add a periodic job.
+        :param fn: coroutine function, returns True on success and can raise
+        :param period: period in seconds or a callable returning the period (evaluated after each run)
+        :param name:
+        :param max_errors: number of consecutive errors after which the scheduler aborts (0 to never abort)
+        :param phase: delay of the first run in seconds. defaults to a golden-ratio spread within the period
+        :param adapter: bluetooth adapter the job uses, to apply the limiter's concurrency bound
+        :param urgency: priority when waiting for an adapter slot, e.g. data age relative to the freshness target
+        :return:
+        """
+        job = ScheduledJob(fn, period=period, name=name or getattr(fn, '__name__', str(fn)), max_errors=max_errors,
+                           adapter=adapter, urgency=urgency)
+        if phase is None:
+            phase = ((self._num_added * GOLDEN_RATIO_FRAC) % 1.) * job.get_period()
+        self._num_added += 1
+        self.jobs.append(job)
+        self._push(job, self.time() + phase)
+        return job
+
+    def remove(self, job: ScheduledJob):
+        job.removed = True
+        job._gen += 1
+        if job in self.jobs:
+            self.jobs.remove(job)
+
+    def wake(self, job: ScheduledJob):
+        """ Move the next deadline of a job to now """
+        if job.removed or job.running:
+            return
+        self._push(job, self.time())
+
+    def _push(self, job: ScheduledJob, deadline: float):
+        job._gen += 1
+        job.deadline = deadline
+        heapq.heappush(self._heap, (deadline, next(self._seq), job._gen, job))
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _sleep(self, timeout):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self, is_shutdown: Callable[[], bool]) -> Optional[ScheduledJob]:
+        """
+        Run the jobs until `is_shutdown()` or a job exceeds its `max_errors`.
+        :return: the job that caused the abort, or None
+        """
+        self._wakeup = asyncio.Event()
+        self.aborted = None
+
+        try:
+            await self._run_loop(is_shutdown)
+        finally:
+            # don't leave jobs running without a scheduler, they resume at the next run()
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.aborted:
+            logger.warning('scheduler aborted by %s', self.aborted)
+
+        return self.aborted
+
+    async def _run_loop(self, is_shutdown: Callable[[], bool]):
+        while not is_shutdown() and not self.aborted:
+            now = self.time()
+
+            if now - self._t_last_stats_log > 300:
+                self.log_stats()
+            if math.isnan(self._t_last_stats_log):
+                self._t_last_stats_log = now
+
+            if not self._heap:
+                await self._sleep(1)
+                continue
+
+            deadline, _, gen, job = self._heap[0]
+            if gen != job._gen or job.removed:
+                heapq.heappop(self._heap)
+                continue
+
+            if deadline > now:
+                await self._sleep(min(deadline - now, 1))
+                continue
+
+            heapq.heappop(self._heap)
+            job.running = True
+            task = asyncio.create_task(self._run_job(job, deadline))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_job(self, job: ScheduledJob, deadline: float):
+        try:
+            async with self.limiter.slot(job.adapter, job.urgency):
+                await self._run_job_inner(job, deadline)
+        except asyncio.CancelledError:
+            if not job.removed:
+                self._push(job, self.time())
+            raise
+        finally:
+            job.running = False
+
+        if job.removed:
+            return
+
+        period = job.get_period()
+        t_end = self.time()
+        next_deadline = deadline + period
+        if next_deadline < t_end:
+            missed = math.ceil((t_end - next_deadline) / period) if period > 0 else 1
+            job.num_missed += missed
+            next_deadline = max(next_deadline + missed * period, t_end)
+            if t_end - job._t_last_missed_log > 60:
+                job._t_last_missed_log = t_end
+                logger.warning('%s missed %d deadline(s) (run took %.2fs, period %.2fs, total missed %d)',
+                               job, missed, t_end - job.t_last_start, period, job.num_missed)
+
+        self._push(job, next_deadline)
+
+    async def _run_job_inner(self, job: ScheduledJob, deadline: float):
+        t_start = self.time()
+
+        if job.num_runs:
+            dt = t_start - job.t_last_start
+            job.period_sum += dt
+            job.period_max = max(job.period_max, dt)
+        job.lateness_max = max(job.lateness_max, t_start - deadline)
+        job.t_last_start = t_start
+        job.num_runs += 1
+
+        try:
+            if await job.fn():
+                job.num_errors_row = 0
+        except (Exception, asyncio.CancelledError) as e:
+            if isinstance(e, asyncio.CancelledError) and asyncio.current_task().cancelling():
+                raise
+            # bleak sometimes cancels pending futures when a device disconnects, treat this as an error
+            job.num_errors_row += 1
+            logger.error('Error (num %d, max %d) in %s: %s', job.num_errors_row, job.max_errors, job, e)
+            logger.error('Stack: %s', traceback.format_exc())
+            if job.max_errors and job.num_errors_row > job.max_errors:
+                logger.warning('%s too many errors, abort', job)
+                self.aborted = job
+
+    def log_stats(self):
+        self._t_last_stats_log = self.time()
+        for job in self.jobs:
+            if job.num_runs > 1:
+                logger.info('%s period=%.2fs %s', job, job.get_period(), job.stats())
+
+
+def _collect_exception(task: asyncio.Task, exceptions: List[BaseException]):
+    if not task.cancelled() and task.exception():
+        exceptions.append(task.exception())
+
+
+class BudgetedRound:
+    """
+    Runs coroutine functions one after another (a serial sampling round) within a time budget.
+    Each call may take the rest of the round's budget, but at least an equal share of it. A call that takes longer is
+    not cancelled (that can leave bleak in a bad state), it moves to a background lane and keeps running there. Later
+    rounds skip it until it has completed.
+    """
+
+    def __init__(self, budget: float, name: Callable[[Callable], str] = str):
+        self.budget = budget
+        self.name = name
+        self.lane: Dict[Callable, asyncio.Task] = {}
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.num_rounds = 0
+        self.time_sum = 0.
+        self.time_max = 0.
+        self.num_deferred = 0
+        self.num_skipped = 0
+
+    async def run(self, fns: List[Callable[[], Awaitable]], should_run: Callable[[Callable], bool] = None) \
+            -> List[BaseException]:
+        """
+        :param fns: calls of this round, in order
+        :param should_run: checked right before each call (e.g. the device was removed meanwhile)
+        :return: exceptions raised by the calls of this round and by background calls that completed meanwhile
+        """
+        loop = asyncio.get_event_loop()
+        t_start = loop.time()
+        deadline = t_start + self.budget
+        min_share = self.budget / max(1, len(fns))
+        exceptions = []
+
+        for fn, task in list(self.lane.items()):
+            if task.done():
+                del self.lane[fn]
+                _collect_exception(task, exceptions)
+
+        for fn in fns:
+            if fn in self.lane:
+                self.num_skipped += 1
+                continue
+            if should_run and not should_run(fn):
+                continue
+
+            task = asyncio.ensure_future(fn())
+            try:
+                await asyncio.wait_for(asyncio.shield(task), timeout=max(deadline - loop.time(), min_share))
+            except asyncio.TimeoutError:
+                if task.done():
+                    # completed just as the budget ran out
+                    _collect_exception(task, exceptions)
+                    continue
+                self.num_deferred += 1
+                self.lane[fn] = task
+                logger.warning('%s exceeded the round budget (%.1fs), continues in background', self.name(fn),
+                               self.budget)
+            except Exception as e:
+                exceptions.append(e)
+
+        dt = loop.time() - t_start
+        self.num_rounds += 1
+        self.time_sum += dt
+        self.time_max = max(self.time_max, dt)
+        return exceptions
+
+    def cancel(self):
+        for task in self.lane.values():
+            task.cancel()
+        self.lane.clear()
+
+    def pop_stats(self) -> dict:
+        """ Round stats since the last call """
+        stats = dict(rounds=self.num_rounds, time_mean=round(self.time_sum / max(1, self.num_rounds), 3),
+                     time_max=round(self.time_max, 3), deferred=self.num_deferred, skipped=self.num_skipped,
+                     in_background=len(self.lane))
+        self._reset_stats()
+        return stats
@@ -0,0 +1,244 @@
+"""
+Multi-process sharding: one worker process per bluetooth adapter.
+
+Workers own the BtBms instances and BmsSamplers of their shard. The parent process owns the MQTT client and the sinks.
+Workers stream everything they would publish to the parent over a pipe, the parent forwards MQTT switch commands
+back to the worker that subscribed the topic. A stuck bleak call only stalls the worker of its shard, the parent
+restarts workers that die or go silent.
+
+Messages are tuples `(kind, *args)`:
+ worker -> parent: pub, sub, sample, voltages, meters, meter_states, devices
+ parent -> worker: msg
+"""
+import multiprocessing
+import threading
+import time
+from typing import Dict, List, Optional, Callable
+
+import paho.mqtt.client as paho
+
+from bmslib.bms import BmsSample
+from bmslib.sampling import BmsSampleSink
+from bmslib.util import get_logger, dotdict
+
+logger = get_logger()
+
+
+def assign_shards(devices: List[dict]) -> Dict[str, List[dict]]:
+    """
+    Group device configs by bluetooth adapter. Virtual groups and their members always end up in the same shard,
+    because group samples are aggregated in-process.
+    :param devices: `devices` from the user config
+    :return: device configs by shard name
+    """
+    shard_of = {}
+    for dev in devices:
+        if not dev.get('type', '').startswith('group_'):
+            shard_of[dev['address']] = dev.get('adapter') or 'default'
+            if dev.get('alias'):
+                shard_of[dev['alias']] = shard_of[dev['address']]
+
+    group_shard = {}
+    for dev in devices:
+        if dev.get('type', '').startswith('group_'):
+            member_refs = [r for r in dev['address'].split(',') if r]
+            target = next((shard_of[r] for r in member_refs if r in shard_of), 'default')
+            for ref in member_refs:
+                if shard_of.get(ref, target) != target:
+                    logger.warning('group %s members span multiple adapters, sampling %s in shard %s',
+                                   dev.get('alias'), ref, target)
+                group_shard[ref] = target
+            group_shard[dev['address']] = target
+
+    shards: Dict[str, List[dict]] = {}
+    for dev in devices:
+        shard = group_shard.get(dev['address']) or group_shard.get(dev.get('alias')) or shard_of.get(dev['address'])
+        shards.setdefault(shard or 'default', []).append(dev)
+    return shards
+
+
+class _PublishResult:
+    rc = paho.MQTT_ERR_SUCCESS
+
+
+class ShardMqttClient:
+    """ Stand-in for the paho client inside a worker process, forwards publish and subscribe to the parent """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()
+
+    def send(self, *msg):
+        with self._lock:
+            self._conn.send(msg)
+
+    def publish(self, topic, payload=None, retain=False, **kwargs):
+        self.send('pub', topic, payload, retain)
+        return _PublishResult()
+
+    def subscribe(self, topic, qos=0):
+        self.send('sub', topic, qos)
+
+    def send_meter_states(self, meter_states: dict):
+        self.send('meter_states', meter_states)
+
+    def read_commands(self, on_message: Callable):
+        """ Blocking loop receiving messages from the parent, run this in a daemon thread """
+        while True:
+            try:
+                kind, *args = self._conn.recv()
+            except (EOFError, OSError):
+                logger.error('shard pipe closed')
+                return
+            if kind == 'msg':
+                topic, payload = args
+                on_message(None, None, dotdict(topic=topic, payload=payload))
+
+
+class ShardSink(BmsSampleSink):
+    """ Sink inside a worker process that forwards to the sinks of the parent process """
+
+    def __init__(self, client: ShardMqttClient):
+        self.client = client
+
+    def publish_sample(self, bms_name: str, sample: BmsSample):
+        self.client.send('sample', bms_name, sample)
+
+    def publish_voltages(self, bms_name: str, voltages: List[int]):
+        self.client.send('voltages', bms_name, voltages)
+
+    def publish_meters(self, bms_name: str, readings: Dict[str, float]):
+        self.client.send('meters', bms_name, readings)
+
+
+class Shard:
+    def __init__(self, name: str, devices: List[dict]):
+        self.name = name
+        self.devices = devices
+        self.process: Optional[multiprocessing.Process] = None
+        self.conn = None
+        self.t_last_msg = 0.
+        self.num_starts = 0
+        self._send_lock = threading.Lock()
+
+    def send(self, *msg):
+        with self._send_lock:
+            self.conn.send(msg)
+
+    @property
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def __str__(self):
+        return 'Shard(%s,%d devices,pid=%s)' % (self.name, len(self.devices), self.process and self.process.pid)
+
+
+class ShardHost:
+    """
+    Parent side of the sharded mode. Starts a worker process per shard and dispatches their messages to the MQTT
+    client and the sinks.
+    """
+
+    def __init__(self, mqtt_client: Optional[paho.Client], sinks: List[BmsSampleSink], target: Callable,
+                 worker_config: dict, silence_timeout: float = 0):
+        """
+        :param target: worker entry point, called as target(shard_name, devices, worker_config, conn, meter_states)
+        :param worker_config: user config for the workers
+        :param silence_timeout: restart a worker that hasn't sent anything for this many seconds (0 to disable)
+        """
+        self.mqtt_client = mqtt_client
+        self.sinks = sinks
+        self.target = target
+        self.worker_config = worker_config
+        self.silence_timeout = silence_timeout
+        self.shards: Dict[str, Shard] = {}
+        self.meter_states: Dict[str, dict] = {}
+        self.bms_by_name: Dict[str, dotdict] = {}  # name -> dotdict(address=..), reported by the workers
+        self._topics: Dict[str, Shard] = {}
+        self._sink_lock = threading.Lock()
+        self._ctx = multiprocessing.get_context('spawn')
+
+    def start(self, name: str, devices: List[dict]):
+        shard = self.shards.get(name) or Shard(name, devices)
+        self.shards[name] = shard
+        parent_conn, child_conn = self._ctx.Pipe(duplex=True)
+        shard.conn = parent_conn
+        # a restarted worker continues with the latest meter states it sent, not the ones last stored to the file
+        shard.process = self._ctx.Process(target=self.target,
+                                          args=(name, devices, self.worker_config, child_conn, dict(self.meter_states)),
+                                          name='batmon-%s' % name, daemon=True)
+        shard.process.start()
+        child_conn.close()
+        shard.t_last_msg = time.time()
+        shard.num_starts += 1
+        logger.info('started %s', shard)
+        threading.Thread(target=lambda: self._reader(shard, parent_conn), daemon=True).start()
+
+    def _reader(self, shard: Shard, conn):
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                logger.warning('%s pipe closed', shard)
+                return
+            shard.t_last_msg = time.time()
+            try:
+                self._handle(shard, msg)
+            except Exception as e:
+                logger.error('error handling %s message %s: %s', shard, msg[0], e, exc_info=True)
+
+    def _handle(self, shard: Shard, msg: tuple):
+        import mqtt_util
+        kind, *args = msg
+        if kind == 'pub':
+            topic, payload, retain = args
+            mqtt_util.mqtt_single_out(self.mqtt_client, topic, payload, retain=retain)
+        elif kind == 'sub':
+            topic, qos = args
+            self._topics[topic] = shard
+            self.mqtt_client and self.mqtt_client.subscribe(topic, qos=qos)
+        elif kind in {'sample', 'voltages', 'meters'}:
+            with self._sink_lock:
+                for sink in self.sinks:
+                    try:
+                        getattr(sink, 'publish_' + kind)(*args)
+                    except NotImplementedError:
+                        pass
+        elif kind == 'meter_states':
+            self.meter_states.update(args[0])
+        elif kind == 'devices':
+            self.bms_by_name.update({n: dotdict(address=a) for n, a in args[0].items()})
+        else:
+            logger.warning('%s unknown message %s', shard, kind)
+
+    def on_mqtt_message(self, client, userdata, message: paho.MQTTMessage):
+        shard = self._topics.get(message.topic)
+        if not shard:
+            logger.warning("No shard subscribed topic %s", message.topic)
+            return
+        try:
+            shard.send('msg', message.topic, bytes(message.payload))
+        except Exception as e:
+            logger.error('error forwarding %s to %s: %s', message.topic, shard, e)
+
+    def check(self):
+        """ Restart dead or silent workers """
+        now = time.time()
+        for name, shard in self.shards.items():
+            silent = self.silence_timeout and now - shard.t_last_msg > self.silence_timeout
+            if shard.is_alive and not silent:
+                continue
+            if silent and shard.is_alive:
+                logger.error('%s silent for %.0fs, terminate', shard, now - shard.t_last_msg)
+                shard.process.terminate()
+                shard.process.join(5)
+            else:
+                logger.error('%s died (exitcode %s), restart', shard, shard.process and shard.process.exitcode)
+            self.start(name, shard.devices)
+
+    def stop(self):
+        for shard in self.shards.values():
+            if shard.is_alive:
+                shard.process.terminate()
+        for shard in self.shards.values():
+            shard.process and shard.process.join(5)
@@ -0,0 +1,99 @@
+"""
+Virtual time for simulations of the sampling loop (see tools/simulate.py).
+
+`VirtualTimeLoop` is an asyncio event loop that doesn't wait for timers: when there is nothing to do until the next
+timer, the clock jumps forward. Together with `patch_time()` (time.time and time.monotonic return the virtual clock)
+the whole add-on runs a day of operation in a fraction of the time, deterministically as long as no threads are
+involved. Threads (executor, MQTT) still run in real time.
+
+"""
+import asyncio
+import selectors
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+# how long to really wait if the loop has no timers (waiting for a thread)
+REAL_IDLE_WAIT = .01
+# minimum clock step of a loop iteration. asyncio runs a timer only once the clock is past it, and at ~1.7e9 (epoch
+# seconds) a float can't resolve much smaller steps
+MIN_STEP = 1e-6
+
+
+class VirtualClock:
+    def __init__(self, t0: float = None):
+        self.t = time.time() if t0 is None else t0
+
+    def time(self) -> float:
+        return self.t
+
+    def advance(self, dt: float):
+        self.t += dt
+
+
+class _VirtualSelector:
+    """ Wraps the loop's selector, instead of blocking until the next timer it advances the clock """
+
+    def __init__(self, selector: selectors.BaseSelector, clock: VirtualClock):
+        self._selector = selector
+        self._clock = clock
+
+    def select(self, timeout=None):
+        events = self._selector.select(0)
+        if events:
+            return events
+        if timeout is None:
+            return self._selector.select(REAL_IDLE_WAIT)
+        self._clock.advance(timeout + MIN_STEP)
+        return []
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock: VirtualClock):
+        super().__init__()
+        self.clock = clock
+        self._selector = _VirtualSelector(self._selector, clock)
+
+    def time(self):
+        return self.clock.time()
+
+
+@contextmanager
+def patch_time(clock: VirtualClock):
+    """ Let time.time() and time.monotonic() return the virtual clock """
+    orig = time.time, time.monotonic
+    time.time = clock.time
+    time.monotonic = clock.time
+    try:
+        yield clock
+    finally:
+        time.time, time.monotonic = orig
+
+
+class _PublishResult:
+    rc = 0
+
+
+class RecordingMqttClient:
+    """ Stand-in for the paho client, counts the published messages by topic """
+
+    def __init__(self):
+        self.num_published: Dict[str, int] = {}
+        self.last_values: Dict[str, object] = {}
+
+    def publish(self, topic, payload=None, retain=False, **kwargs):
+        self.num_published[topic] = self.num_published.get(topic, 0) + 1
+        self.last_values[topic] = payload
+        return _PublishResult()
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+    def unsubscribe(self, topic):
+        pass
+
+    def count(self, prefix: str) -> int:
+        return sum(n for t, n in self.num_published.items() if t.startswith(prefix))
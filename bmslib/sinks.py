@@ -215,22 +215,30 @@ class TelemetrySink(InfluxDBSink):
         except:
             self.did = None
 
+        # in sharded mode `bms_by_name` is populated after construction, so hash addresses lazily
+        self.bms_by_name = bms_by_name
         self.addrh_by_name = {n: hash_urlsafe(bms.address) for n, bms in bms_by_name.items()}
 
         logger.info("tele started, uid='%s' did='%s' addr=%s", self.uid, self.did, self.addrh_by_name)
         self.silent = True
 
+    def _addrh(self, bms_name):
+        addrh = self.addrh_by_name.get(bms_name)
+        if addrh is None:
+            addrh = self.addrh_by_name[bms_name] = hash_urlsafe(self.bms_by_name[bms_name].address)
+        return addrh
+
     def publish_sample(self, bms_name, sample: BmsSample, tags=None):
         tags_ = dict(uid=self.uid, did=self.did)
         tags and tags_.update(tags)
         try:
-            super().publish_sample(self.addrh_by_name[bms_name], sample, tags=tags_)
+            super().publish_sample(self._addrh(bms_name), sample, tags=tags_)
         except:
             pass
 
     def publish_voltages(self, bms_name, voltages: List[int], short=True):
         # tags_ = dict(uid=self.uid, did=self.did)
-        super().publish_voltages(self.addrh_by_name[bms_name], voltages, short=short)
+        super().publish_voltages(self._addrh(bms_name), voltages, short=short)
 
     def publish_meters(self, bms_name, readings: Dict[str, float]):
         raise NotImplementedError()
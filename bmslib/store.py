@@ -4,6 +4,7 @@ import re
 from os import access, R_OK
 from os.path import isfile
 from threading import Lock
+from typing import Optional, Dict, List, Tuple
 
 from bmslib.cache import random_str
 from bmslib.util import dotdict, get_logger
@@ -17,9 +18,12 @@ def is_readable(file):
 
 root_dir = '/data/' if is_readable('/data/options.json') else ''
 bms_meter_states_fn = root_dir + 'bms_meter_states.json'
+bms_device_meta_fn = root_dir + 'bms_device_meta.json'
 
 lock = Lock()
 
+_device_meta: Optional[Dict[str, dict]] = None
+
 
 def store_file(fn):
     return root_dir + fn
@@ -40,6 +44,50 @@ def store_meter_states(meter_states):
         os.replace(bms_meter_states_fn + s, bms_meter_states_fn)
 
 
+def _load_device_meta() -> Dict[str, dict]:
+    global _device_meta
+    if _device_meta is None:
+        try:
+            with open(bms_device_meta_fn) as f:
+                _device_meta = json.load(f)
+        except FileNotFoundError:
+            _device_meta = {}
+        except Exception as e:
+            logger.warning('error reading %s: %s', bms_device_meta_fn, e)
+            _device_meta = {}
+    return _device_meta
+
+
+def load_device_meta(address: str) -> dict:
+    """
+    Metadata of a device persisted across restarts (characteristic handles, num_cells, device info, ..)
+    :param address: device address
+    :return: a copy of the metadata, empty if the device is unknown
+    """
+    with lock:
+        return dict(_load_device_meta().get(address) or {})
+
+
+def find_device_address(name: str) -> Optional[str]:
+    """ Address of a device that was previously resolved from its bluetooth name """
+    with lock:
+        return next((a for a, m in _load_device_meta().items() if m.get('name') == name), None)
+
+
+def store_device_meta(address: str, **meta):
+    """ Merge `meta` into the stored metadata of a device. Writes the file only if something changed. """
+    with lock:
+        device_meta = _load_device_meta()
+        current = device_meta.setdefault(address, {})
+        if all(current.get(k) == v for k, v in meta.items()):
+            return
+        current.update(meta)
+        s = f'.{random_str(6)}.tmp'
+        with open(bms_device_meta_fn + s, 'w') as f:
+            json.dump(device_meta, f, indent=2)
+        os.replace(bms_device_meta_fn + s, bms_device_meta_fn)
+
+
 def store_algorithm_state(bms_name, algorithm_name, state=None):
     fn = root_dir + 'bat_state_' + re.sub(r'[^\w_. -]', '_', bms_name) + '.json'
     with lock:
@@ -59,6 +107,10 @@ def store_algorithm_state(bms_name, algorithm_name, state=None):
             return bms_state['algorithm_state'].get(algorithm_name, None)
 
 
+def user_config_file():
+    return '/data/options.json' if is_readable('/data/options.json') else 'options.json'
+
+
 def load_user_config():
     try:
         with open('/data/options.json') as f:
@@ -94,3 +146,31 @@ def _user_config_migrate_addresses(conf):
             changed = True
     if changed:
         logger.info('Please update add-on configuration manually.')
+
+
+def diff_device_confs(old: List[dict], new: List[dict]) -> Tuple[List[dict], List[dict]]:
+    """
+    Compare two `devices` lists of the user config. A changed entry is both removed and added. Groups are restarted
+    together with their members, so if a group or any of its members changed, all of them are in both lists.
+    :return: removed entries (from `old`), added entries (from `new`)
+    """
+    key = lambda d: json.dumps(d, sort_keys=True)
+    old_keys = set(map(key, old))
+    new_keys = set(map(key, new))
+    removed = [d for d in old if key(d) not in new_keys]
+    added = [d for d in new if key(d) not in old_keys]
+
+    refs = lambda d: {d.get('address'), d.get('alias')} - {None, ''}
+    changed_refs = set().union(*map(refs, removed + added))
+
+    for confs, changed in ((old, removed), (new, added)):
+        for group in confs:
+            if not group.get('type', '').startswith('group_'):
+                continue
+            members = set(filter(bool, group['address'].split(',')))
+            if group in changed or members & changed_refs:
+                for d in [group] + [d for d in confs if refs(d) & members]:
+                    if d not in changed:
+                        changed.append(d)
+
+    return removed, added
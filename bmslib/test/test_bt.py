@@ -0,0 +1,61 @@
+import asyncio
+import struct
+
+import bmslib.store as store
+from bmslib.bt import is_device_address
+from bmslib.models.daly import DalyBt
+
+
+def test_is_device_address():
+    assert is_device_address('C8:47:8C:E4:54:0E')
+    assert is_device_address('c8:47:8c:e4:54:0e ')
+    assert is_device_address('3D7394B1-BCFD-4CDC-A10D-3D113E2317A6')
+    assert not is_device_address('JK-B2A24S15P')
+    assert not is_device_address('C8:47:8C:E4:54')
+    assert not is_device_address('daly_bms')
+
+
+def test_q_pipelined(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'bms_device_meta_fn', str(tmp_path / 'bms_device_meta.json'))
+    monkeypatch.setattr(store, '_device_meta', None)
+
+    responses = {
+        0x90: struct.pack('>hhhh', 532, 0, 29950, 873),
+        0x93: struct.pack('>b??Bl', 1, True, False, 0, 105000),
+        0x94: struct.pack('>bb??bhx', 16, 2, True, True, 0, 42),
+    }
+
+    class PipelineClient:
+        def __init__(self, bms):
+            self.bms = bms
+            self.writes = []
+            self.max_in_flight = 0
+
+        async def write_gatt_char(self, _char, data):
+            cmd = data[2]
+            self.writes.append(cmd)
+            self.max_in_flight = max(self.max_in_flight, len(self.bms._fetch_futures._futures))
+            frame = bytearray(b'\xa5\x01' + bytes([cmd, 8]) + responses[cmd])
+            frame.append(sum(frame) & 0xFF)
+            # answered in reverse order
+            delay = .05 - .01 * len(self.writes)
+            asyncio.get_running_loop().call_later(delay, self.bms._notification_callback, None, bytes(frame))
+
+    async def run():
+        bms = DalyBt('pipeline_daly', name='pipeline_daly')
+        bms.client = client = PipelineClient(bms)
+        sample = await bms.fetch()
+        assert client.writes == [0x90, 0x93, 0x94] and client.max_in_flight == 3
+        assert sample.soc == 87.3 and sample.current == -5 and sample.charge == 105 and sample.num_cycles == 42
+
+        # status and states are cached
+        await bms.fetch()
+        assert client.writes[3:] == [0x90]
+
+        # not pipeline-safe, one at a time
+        client.max_in_flight = 0
+        bms.PIPELINE_SAFE = frozenset()
+        assert len(await bms._q_pipelined([0x93, 0x90], bms._write_command, bms.TIMEOUT)) == 2
+        assert client.max_in_flight == 1
+
+    asyncio.run(run())
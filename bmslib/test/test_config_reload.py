@@ -0,0 +1,35 @@
+from bmslib.store import diff_device_confs
+
+DEVICES = [
+    dict(address='C8:47:8C:00:00:01', type='jk', alias='jk1'),
+    dict(address='C8:47:8C:00:00:02', type='jk', alias='jk2'),
+    dict(address='C8:47:8C:00:00:03', type='daly', alias='daly1'),
+    dict(address='jk1,jk2', type='group_parallel', alias='bank'),
+]
+
+
+def test_add_device():
+    new = DEVICES + [dict(address='C8:47:8C:00:00:04', type='jbd', alias='jbd1')]
+    removed, added = diff_device_confs(DEVICES, new)
+    assert removed == []
+    assert [d['alias'] for d in added] == ['jbd1']
+
+
+def test_change_device():
+    new = [dict(d) for d in DEVICES]
+    new[2]['alias'] = 'daly_house'
+    removed, added = diff_device_confs(DEVICES, new)
+    assert [d['alias'] for d in removed] == ['daly1']
+    assert [d['alias'] for d in added] == ['daly_house']
+
+
+def test_group_member_change_restarts_group():
+    new = [dict(d) for d in DEVICES]
+    new[1]['pin'] = '1234'
+    removed, added = diff_device_confs(DEVICES, new)
+    assert sorted(d['alias'] for d in removed) == ['bank', 'jk1', 'jk2']
+    assert sorted(d['alias'] for d in added) == ['bank', 'jk1', 'jk2']
+
+
+def test_unchanged():
+    assert diff_device_confs(DEVICES, [dict(d) for d in DEVICES]) == ([], [])
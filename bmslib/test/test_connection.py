@@ -0,0 +1,112 @@
+import asyncio
+
+import time
+
+import pytest
+
+from bmslib.connection import AdapterSlots, ConnectArbiter, CircuitBreaker, CircuitOpenError, ConnectionManager
+
+
+class FakeBms:
+    def __init__(self, name):
+        self.name = name
+        self.is_connected = False
+        self.num_connects = 0
+
+    async def connect(self):
+        await asyncio.sleep(.01)
+        self.is_connected = True
+        self.num_connects += 1
+
+    async def disconnect(self):
+        self.is_connected = False
+
+
+async def poll(slots: AdapterSlots, bms: FakeBms, connected_max: list):
+    await slots.acquire(bms)
+    try:
+        if not bms.is_connected:
+            await bms.connect()
+            slots.connected(bms, .01)
+        connected_max[0] = max(connected_max[0], sum(s.bms.is_connected for s in slots.slots.values()))
+    finally:
+        slots.release(bms)
+
+
+def test_slots_rotate_and_pin():
+    async def run():
+        slots = AdapterSlots('hci0', 2)
+        fast = FakeBms('fast')
+        slow = [FakeBms('slow%d' % i) for i in range(3)]
+        connected_max = [0]
+        for i in range(40):
+            await poll(slots, fast, connected_max)
+            if i % 4 == 0:
+                for bms in slow:
+                    await poll(slots, bms, connected_max)
+            await asyncio.sleep(.05)
+        return slots, fast, slow, connected_max[0]
+
+    slots, fast, slow, connected_max = asyncio.run(run())
+    assert connected_max <= 2
+    # the most frequently polled device stays connected, the others rotate through the second slot
+    assert fast.num_connects == 1
+    assert all(b.num_connects >= 9 for b in slow)
+    stats = slots.stats()
+    assert stats['evictions'] > 0 and stats['hit_rate'] > .5, stats
+
+
+def test_arbiter_serializes_connects():
+    async def run():
+        arbiter = ConnectArbiter('hci0')
+        active = [0, 0]  # current, max
+
+        async def connect():
+            async with arbiter.turn():
+                active[0] += 1
+                active[1] = max(active)
+                await asyncio.sleep(.01)
+                active[0] -= 1
+
+        await asyncio.gather(*(connect() for _ in range(5)))
+        assert active[1] == 1
+        assert arbiter.num_connects == 5 and arbiter.wait_max >= .03
+
+    asyncio.run(run())
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=3, probe_interval=10, max_probe_interval=15)
+    for _ in range(2):
+        breaker.failure('dev')
+        breaker.check('dev')
+    breaker.failure('dev')
+    assert breaker.is_open
+    with pytest.raises(CircuitOpenError) as e:
+        breaker.check('dev')
+    assert 9 < e.value.retry_in <= 10
+
+    breaker.probe_now()
+    breaker.check('dev')  # probe allowed
+    breaker.failure('dev')  # probe failed, back off
+    assert breaker.interval == 15 and breaker.t_next_probe > time.time() + 14
+
+    breaker.success()
+    assert not breaker.is_open and breaker.interval == 10
+    breaker.check('dev')
+
+
+def test_forget_removed_device():
+    async def run():
+        manager = ConnectionManager()
+        manager.configure(({}, 1))
+        removed, other = FakeBms('removed'), FakeBms('other')
+        removed.adapter = other.adapter = 'hci0'
+        await poll(manager.get('hci0'), removed, [0])
+        manager.breaker(removed).failure('removed')
+
+        manager.forget(removed)
+        assert removed not in manager.breakers and removed not in manager.get('hci0').slots
+        await asyncio.wait_for(poll(manager.get('hci0'), other, [0]), 1)
+
+    asyncio.run(run())
@@ -0,0 +1,22 @@
+import json
+
+import bmslib.store as store
+
+
+def test_device_meta_roundtrip(tmp_path, monkeypatch):
+    fn = str(tmp_path / 'bms_device_meta.json')
+    monkeypatch.setattr(store, 'bms_device_meta_fn', fn)
+    monkeypatch.setattr(store, '_device_meta', None)
+
+    store.store_device_meta('AA:BB:CC:DD:EE:FF', name='JK-B2A24S', num_cells=16)
+    store.store_device_meta('AA:BB:CC:DD:EE:FF', char_handles=[3, 5])
+
+    with open(fn) as f:
+        assert json.load(f)['AA:BB:CC:DD:EE:FF'] == dict(name='JK-B2A24S', num_cells=16, char_handles=[3, 5])
+
+    # simulate a restart
+    monkeypatch.setattr(store, '_device_meta', None)
+    assert store.load_device_meta('AA:BB:CC:DD:EE:FF')['num_cells'] == 16
+    assert store.find_device_address('JK-B2A24S') == 'AA:BB:CC:DD:EE:FF'
+    assert store.find_device_address('unknown') is None
+    assert store.load_device_meta('11:22:33:44:55:66') == {}
@@ -0,0 +1,108 @@
+from bmslib.frame import FrameReassembler
+from bmslib.models import ant, jbd, jikong
+
+JBD_FRAME = bytes.fromhex('dd03001b0a50fda4b717dac000002cf300000000000016540308020b7d0b77f8e277')
+
+
+def _jk_frame(resp_type=0x02):
+    frame = bytearray(jikong.HEADER) + bytes([resp_type]) + bytes(i & 0xFF for i in range(jikong.MIN_RESPONSE_SIZE - 6))
+    frame.append(jikong.calc_crc(frame))
+    return bytes(frame)
+
+
+def _ant_frame(func=0x11, data_len=ant.STATUS_DATA_LEN):
+    frame = bytes([0x7e, 0xa1, func, 0, 0, data_len]) + bytes(i & 0xFF for i in range(data_len))
+    return frame + bytes(ant.calc_crc16(frame[1:])) + b'\xaa\x55'
+
+
+def _reassembler(**kwargs):
+    frames = []
+    r = FrameReassembler(lambda f: frames.append(bytes(f)), **kwargs)
+    return r, frames
+
+
+def test_fragments_and_resync():
+    r, frames = _reassembler(header=jikong.HEADER, length=jikong.MIN_RESPONSE_SIZE, crc=jikong._frame_crc_ok,
+                             max_frame=jikong.MAX_RESPONSE_SIZE)
+    frame = _jk_frame()
+
+    # garbage before the header, then MTU-sized fragments
+    stream = b'\x00\x55\xaa' + frame + frame
+    for i in range(0, len(stream), 20):
+        r.feed(stream[i:i + 20])
+    assert frames == [frame, frame]
+    assert r.num_resyncs == 1 and r.num_discarded == 3 and len(r) == 0
+
+    # corrupt frame is dropped, the following one is found
+    bad = bytearray(frame)
+    bad[100] ^= 0xFF
+    r.feed(bytes(bad) + frame)
+    assert frames == [frame] * 3 and r.num_crc_errors == 1
+
+    # header split across fragments
+    r.feed(frame[:2])
+    r.feed(frame[2:])
+    assert len(frames) == 4
+
+    # a stalled partial frame is discarded once the buffer is full
+    r.feed(frame[:150])
+    for _ in range(3):
+        r.feed(bytes(300))
+    r.feed(frame)
+    assert len(frames) == 5
+
+
+def test_length_and_terminator():
+    r, frames = _reassembler(header=b'\xDD', length=jbd._frame_len, terminator=b'w', crc=jbd._frame_crc_ok)
+    for b in JBD_FRAME + JBD_FRAME[:-1] + b'x' + JBD_FRAME:
+        r.feed(bytes([b]))
+    assert frames == [JBD_FRAME, JBD_FRAME]
+    assert r.num_crc_errors == 1
+
+    # terminator at the end of a fragment only
+    r, frames = _reassembler(terminator=b'w')
+    r.feed(b'\xdd\x03w\x00')
+    r.feed(b'\x01w')
+    assert frames == [b'\xdd\x03w\x00\x01w']
+
+    # header and terminator
+    r, frames = _reassembler(header=b':', terminator=b'~')
+    r.feed(b'~:0102~:03')
+    r.feed(b'04~')
+    assert frames == [b':0102~', b':0304~']
+
+
+def test_ant_status_frame():
+    r, frames = _reassembler(header=b'\x7E\xA1', length=ant._frame_len, terminator=b'\xAA\x55',
+                             crc=ant._frame_crc_ok, max_frame=ant.MAX_RESPONSE_SIZE)
+    frame = _ant_frame()
+    assert len(frame) == ant.MAX_RESPONSE_SIZE
+    for _ in range(3):
+        for i in range(0, len(frame), 20):
+            r.feed(frame[i:i + 20])
+    assert frames == [frame] * 3 and r.num_discarded == 0
+
+
+def test_jk_frame_with_command_echo():
+    echo = jikong._jk_command(0x96)
+    frame = _jk_frame()
+
+    for mtu in (20, 128):
+        bms = jikong.JKBt('frame_jk', name='frame_jk')
+        frames = []
+        bms._on_frame = lambda f: frames.append(bytes(f))
+        bms._frames.on_frame = bms._on_frame
+        stream = (frame + echo) * 3
+        for i in range(0, len(stream), mtu):
+            bms._notification_handler(None, stream[i:i + mtu])
+        assert bms._frame_size == jikong.MAX_RESPONSE_SIZE
+        assert [f[:jikong.MIN_RESPONSE_SIZE] for f in frames] == [frame] * 3
+        # at most the echo of the first frame is dropped before the variant is known
+        assert bms._frames.num_discarded <= len(echo)
+
+        # back to 300 byte frames
+        stream = frame * 3
+        for i in range(0, len(stream), mtu):
+            bms._notification_handler(None, stream[i:i + mtu])
+        assert frames[3:] == [frame] * 3
+        assert bms._frame_size == jikong.MIN_RESPONSE_SIZE
@@ -1,28 +1,98 @@
 import asyncio
+import time
+
+import pytest
 
 from bmslib import FuturesPool
 
-pool = FuturesPool()
 
+def test1():
+    async def run():
+        pool = FuturesPool()
+
+        try:
+            with pool.acquire(1):
+                await pool.wait_for(1, 0.01)
+        except asyncio.exceptions.TimeoutError:
+            pass
 
-async def test1():
-    try:
         with pool.acquire(1):
-            await pool.wait_for(1, 0.01)
-    except asyncio.exceptions.TimeoutError:
-        pass
+            try:
+                await pool.wait_for(1, 0.01)
+            except asyncio.exceptions.TimeoutError:
+                pass
 
-    with pool.acquire(1):
         try:
-            await pool.wait_for(1, 0.01)
+            with pool.acquire(1):
+                await pool.wait_for(1, 0.01)
         except asyncio.exceptions.TimeoutError:
             pass
 
-    try:
-        with pool.acquire(1):
-            await pool.wait_for(1, 0.01)
-    except asyncio.exceptions.TimeoutError:
-        pass
+    asyncio.run(run())
+
+
+def test_acquire_chained():
+    async def run():
+        pool = FuturesPool()
+        order = []
+
+        async def query(name, result):
+            with await pool.acquire_timeout(name, timeout=1):
+                asyncio.get_running_loop().call_later(.02, pool.set_result, name, result)
+                order.append(await pool.wait_for(name, 1))
+
+        t0 = time.time()
+        await asyncio.gather(*(query(1, i) for i in range(5)))
+        # each waiter continues when the previous result arrives, not on a 100 ms polling tick
+        assert time.time() - t0 < .3
+        assert sorted(order) == list(range(5))
+
+        stats = pool.pop_stats()
+        assert stats['acquired'] == 5 and stats['contended'] == 4 and stats['wait_max'] > 0
 
+        # released without a result
+        with pool.acquire(2):
+            waiter = asyncio.create_task(pool.acquire_timeout(2, timeout=1))
+            await asyncio.sleep(.01)
+            assert not waiter.done()
+        with await waiter:
+            pass
+
+        with pool.acquire(3):
+            with pytest.raises(Exception, match='still waiting'):
+                await pool.acquire_timeout(3, timeout=.02)
+        assert pool.pop_stats()['acquire_timeouts'] == 1
+
+    asyncio.run(run())
+
+
+def test_broadcast():
+    async def run():
+        pool = FuturesPool()
+        consumers = [asyncio.create_task(pool.next_result(0x02, 1)) for _ in range(3)]
+        await asyncio.sleep(0)
+        with pool.acquire(0x02):
+            pool.set_result(0x02, b'frame')
+            assert await pool.wait_for(0x02, 1) == b'frame'
+        assert await asyncio.gather(*consumers) == [b'frame'] * 3
+        assert pool.pop_stats()['broadcast'] == 3
+
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.next_result(0x02, .01)
+
+    asyncio.run(run())
+
+
+def test_acquire_tuple_partial_timeout():
+    async def run():
+        pool = FuturesPool()
+        with pool.acquire(2):
+            with pytest.raises(Exception, match="still waiting for future named '2'"):
+                await pool.acquire_timeout((1, 2), timeout=.05)
+            # 1 was released again
+            with await pool.acquire_timeout((1,), timeout=.05):
+                pass
+        with await pool.acquire_timeout((1, 2), timeout=.05):
+            pass
 
-asyncio.run(test1())
\ No newline at end of file
+    asyncio.run(run())
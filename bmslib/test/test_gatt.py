@@ -0,0 +1,43 @@
+from bmslib.gatt import GattMap
+from bmslib.models.dummy import DummyCharacteristic
+from bmslib.util import dotdict
+
+JK_SERVICE = '0000ffe0-0000-1000-8000-00805f9b34fb'
+JK_CHAR = '0000ffe1-0000-1000-8000-00805f9b34fb'
+
+
+def _services():
+    return [
+        dotdict(uuid='00001800-0000-1000-8000-00805f9b34fb', characteristics=[
+            DummyCharacteristic(uuid='00002a00-0000-1000-8000-00805f9b34fb', properties=['read'], handle=1),
+        ]),
+        dotdict(uuid=JK_SERVICE, characteristics=[
+            DummyCharacteristic(uuid=JK_CHAR, properties=['write', 'write-without-response'], handle=3),
+            DummyCharacteristic(uuid=JK_CHAR, properties=['read', 'notify'], handle=5),
+        ]),
+    ]
+
+
+def _chars(gatt):
+    return [c.char for c in gatt.chars]
+
+
+def test_gatt_map():
+    gatt = GattMap.from_services(_services())
+    assert gatt.discovered and len(gatt) == 3
+
+    assert gatt.find(JK_CHAR, 'write').handle == 3
+    assert gatt.find(JK_CHAR, 'notify').handle == 5
+    assert gatt.find(5, 'notify').uuid == JK_CHAR
+    assert gatt.find(5, 'write') is None
+    assert gatt.find(JK_CHAR, 'notify', service='00001800-0000-1000-8000-00805f9b34fb') is None
+    assert gatt.service('0000ffe0').uuid == JK_SERVICE
+    # the characteristic object, the uuid is the same for write and notify
+    assert gatt.find(JK_CHAR, 'write').specifier() is _chars(gatt)[1]
+    assert gatt.find(JK_CHAR, 'notify').specifier() is _chars(gatt)[2]
+
+    # persisted map resolves to handles
+    loaded = GattMap.from_meta(gatt.to_meta())
+    assert not loaded.discovered
+    assert loaded.to_meta() == gatt.to_meta()
+    assert loaded.find(JK_CHAR, 'notify', service=loaded.service(JK_SERVICE)).specifier() == 5
@@ -0,0 +1,21 @@
+from tools.import_profile import import_times
+
+# generous, imports take ~0.2s on x86 and a few times that on armv7. this catches heavy accidental imports (pandas..)
+IMPORT_BUDGET_S = 1.5
+
+
+def test_main_import_budget():
+    times = import_times()
+    modules = {t[0] for t in times}
+
+    # drivers and their dependencies are loaded on demand
+    assert not modules & {'pandas', 'numpy', 'crcmod', 'bmslib.models.ant', 'bmslib.models.jikong'}, modules
+
+    total = sum(t[1] for t in times) * 1e-6
+    assert total < IMPORT_BUDGET_S, 'importing main took %.2fs' % total
+
+
+def test_lazy_driver_import():
+    modules = {t[0] for t in import_times(['dummy'])}
+    assert 'bmslib.models.dummy' in modules
+    assert 'bmslib.models.ant' not in modules and 'crcmod' not in modules
@@ -0,0 +1,41 @@
+import math
+import struct
+
+import pytest
+
+from bmslib.layout import CellArray, Field, Layout
+from bmslib.models import jikong
+from bmslib.models.dummy import JKDummy
+
+
+def test_layout():
+    layout = Layout('>', dict(
+        voltage=Field(0, 'H', .01),
+        current=Field(4, 'h', .1, bias=-30000),
+        temp=Field(6, 'h', .1, nan=-2000),
+        num=Field(8, 'B'),
+    ))
+    buf = b'\xff' + struct.pack('>HHhhB', 2640, 0, 29950, -2000, 7)
+    d = layout.decode(buf, base=1)
+    assert d['voltage'] == 26.4 and d['current'] == -5.0 and math.isnan(d['temp']) and d['num'] == 7
+
+    shifted = layout.variant(num=None, extra=Field(10, 'I'))
+    assert shifted.names == ('voltage', 'current', 'temp', 'extra')
+
+    with pytest.raises(ValueError):
+        Layout('<', dict(a=Field(0, 'I'), b=Field(2, 'H')))
+
+    assert CellArray('>').decode(b'\x0d\x05\x0d\x06', 0, 2).tolist() == [3333, 3334]
+    assert CellArray('<').decode(b'\x00\x05\x0d\x06\x0d', 1, 2).tolist() == [3333, 3334]
+
+
+def test_jk_layouts():
+    for is_new_11x, mos_temperature, temperatures in ((False, 28.3, [26.8, 24.8]), (True, 17.6, [17, 17, 0, 0])):
+        settings, cell_info = map(bytearray, JKDummy(is_new_11x=is_new_11x).MSGS)
+        bms = jikong.JKBt('test_jk', name='test')
+        bms._resp_table[0x01] = settings, 0.
+        bms._is_new_11fw, bms._is_new_11fw_checked = is_new_11x, True
+        sample = bms._decode_sample(cell_info, 0.)
+        assert sample.mos_temperature == mos_temperature
+        assert sample.temperatures == temperatures
+        assert sample.switches == dict(charge=True, discharge=True, balance=True)
@@ -0,0 +1,40 @@
+import asyncio
+import threading
+import time
+
+from bmslib.loopmon import LoopMonitor
+
+
+def blocking_store_call():
+    time.sleep(0.5)
+
+
+def test_blocked_loop_dumps_stack():
+    mon = LoopMonitor(interval=.02, dump_threshold=.2)
+    dumps = []
+    format_stacks = mon.format_stacks
+    mon.format_stacks = lambda: dumps.append(format_stacks()) or dumps[-1]
+
+    async def run():
+        mon.start()
+        stop = threading.Event()
+
+        def watch():
+            while not stop.is_set():
+                mon.check()
+                time.sleep(.02)
+
+        th = threading.Thread(target=watch)
+        th.start()
+        await asyncio.sleep(.2)
+        blocking_store_call()
+        await asyncio.sleep(.2)
+        stop.set()
+        th.join()
+
+    asyncio.run(run())
+
+    assert len(dumps) == 1
+    assert 'blocking_store_call' in dumps[0]
+    stats = mon.pop_stats()
+    assert stats['max'] >= 400 and stats['p50'] < 100 and stats['dumps'] == 1, stats
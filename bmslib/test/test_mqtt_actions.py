@@ -0,0 +1,71 @@
+import asyncio
+import threading
+
+import mqtt_util
+from bmslib.util import dotdict
+
+
+def test_switch_commands_coalesce():
+    executed = []
+
+    async def set_switch(payload):
+        executed.append(payload)
+        await asyncio.sleep(0.05)
+
+    async def run():
+        mqtt_util.set_action_loop(asyncio.get_running_loop())
+        mqtt_util._switch_callbacks['test/switch/charge/set'] = set_switch
+
+        def burst():
+            for p in [b'ON', b'OFF', b'ON', b'OFF']:
+                mqtt_util.mqtt_message_handler(None, None, dotdict(topic='test/switch/charge/set', payload=p))
+
+        th = threading.Thread(target=burst)
+        th.start()
+        th.join()
+        await asyncio.sleep(0.3)
+
+    try:
+        asyncio.run(run())
+    finally:
+        mqtt_util._switch_callbacks.pop('test/switch/charge/set', None)
+        mqtt_util.set_action_loop(None)
+
+    # the first command may run before the rest of the burst arrives, the last state is always applied
+    assert 1 <= len(executed) <= 2
+    assert executed[-1] == 'OFF'
+
+
+def test_early_commands_and_errors():
+    executed = []
+
+    async def set_switch(payload):
+        executed.append(payload)
+
+    async def failing(payload):
+        raise ValueError(payload)
+
+    async def run():
+        # arrive before the event loop is set
+        mqtt_util.mqtt_message_handler(None, None, dotdict(topic='test/switch/discharge/set', payload=b'OFF'))
+        mqtt_util.mqtt_message_handler(None, None, dotdict(topic='test/fail', payload=b'ON'))
+        stats = dict(mqtt_util.action_stats)
+        mqtt_util.set_action_loop(asyncio.get_running_loop())
+        await asyncio.sleep(1.2)
+        return stats
+
+    mqtt_util._switch_callbacks['test/switch/discharge/set'] = set_switch
+    mqtt_util._switch_callbacks['test/fail'] = failing
+    try:
+        stats = asyncio.run(run())
+    finally:
+        mqtt_util._switch_callbacks.pop('test/switch/discharge/set', None)
+        mqtt_util._switch_callbacks.pop('test/fail', None)
+        mqtt_util.set_action_loop(None)
+
+    assert executed == ['OFF']
+    assert mqtt_util.action_stats['num_executed'] == stats['num_executed'] + 1
+    assert mqtt_util.action_stats['num_errors'] == stats['num_errors'] + 1
+    stats = mqtt_util.pop_action_stats()
+    assert stats['num_errors'] >= 1 and stats['exec_time_max'] >= stats['exec_time_mean'] > 0
+    assert mqtt_util.action_stats['num_errors'] == 0 and not mqtt_util._action_tasks
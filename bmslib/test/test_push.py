@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+import bmslib.sampling
+import bmslib.store as store
+from bmslib.models.dummy import DummyBt
+from bmslib.sampling import BmsSampler
+from bmslib.sim import RecordingMqttClient
+
+
+class StreamingDummy(DummyBt):
+    """ Pushes a sample every `interval` seconds while streaming """
+
+    def __init__(self, address, interval, **kwargs):
+        super().__init__(address, **kwargs)
+        self.interval = interval
+        self.streaming = True
+        self.num_fetches = 0
+        self._callbacks = []
+        self._task = None
+
+    async def _stream(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.streaming:
+                sample = await super().fetch()
+                sample.timestamp = time.time()
+                for callback in self._callbacks:
+                    callback(sample)
+
+    async def subscribe(self, callback):
+        self._callbacks.append(callback)
+        self._task = self._task or asyncio.create_task(self._stream())
+
+    async def fetch(self):
+        self.num_fetches += 1
+        return await super().fetch()
+
+
+def test_push_sampling(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'bms_device_meta_fn', str(tmp_path / 'bms_device_meta.json'))
+    monkeypatch.setattr(store, '_device_meta', None)
+    monkeypatch.setattr(bmslib.sampling, 'PUSH_POLL_FALLBACK', .1)
+
+    async def run():
+        bms = StreamingDummy('stream', interval=.01, name='stream', keep_alive=True)
+        assert bms.supports_push
+        sampler = BmsSampler(bms, mqtt_client=RecordingMqttClient(), dt_max_seconds=60, expire_after_seconds=20)
+
+        # every pushed sample
+        sampler.enable_push(0)
+        for _ in range(5):
+            assert await sampler()
+        assert bms.num_fetches == 0 and sampler.num_samples == 5
+
+        # rate limited, the pushed samples in between are coalesced
+        sampler.enable_push(.05)
+        t0 = time.time()
+        for _ in range(4):
+            await sampler()
+        assert time.time() - t0 >= .15
+        assert sampler.num_pushed > sampler.num_samples
+
+        # stream stalled, falls back to polling
+        bms.streaming = False
+        await asyncio.sleep(.02)
+        sampler._pushed = None
+        assert await sampler()
+        assert bms.num_fetches == 1 and sampler.num_push_fallbacks == 1
+
+        bms._task.cancel()
+
+    asyncio.run(run())
@@ -0,0 +1,34 @@
+import asyncio
+
+from bmslib.recovery import TieredRecovery, RecoveryTier
+
+
+def test_escalates_until_healthy():
+    actions = []
+    healthy = [False]
+
+    def make_action(name, heals):
+        async def action():
+            actions.append(name)
+            healthy[0] = heals
+
+        return action
+
+    rec = TieredRecovery('test', [
+        RecoveryTier('mqtt', make_action('mqtt', False), settle_time=0.05),
+        RecoveryTier('client', make_action('client', True), settle_time=0.05),
+        RecoveryTier('power', make_action('power', True), settle_time=0.05),
+    ], poll_interval=0.01)
+
+    assert asyncio.run(rec.recover(lambda: healthy[0]))
+    assert actions == ['mqtt', 'client']
+    assert 0.05 <= rec.last_ttr < 1
+
+
+def test_all_tiers_fail():
+    async def fail():
+        raise RuntimeError("no adapter")
+
+    rec = TieredRecovery('test', [RecoveryTier('power', fail, settle_time=0.02)], poll_interval=0.01)
+    assert not asyncio.run(rec.recover(lambda: False))
+    assert not rec.running
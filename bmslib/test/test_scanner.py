@@ -0,0 +1,71 @@
+import asyncio
+import time
+
+from bmslib.bt import BtBms, SCAN_MAX_AGE
+from bmslib.scanner import get_scanner, find_advertisement, _scanners
+from bmslib.util import dotdict
+
+
+def test_advertisement_cache():
+    async def run():
+        scanner = get_scanner('hci9')
+        seen = []
+        scanner.add_listener(lambda device, adv_data: seen.append(device.address))
+
+        device = dotdict(address='C8:47:8C:00:00:01', name=None)
+        waiter = asyncio.ensure_future(scanner.wait_for(device.address, timeout=1))
+        await asyncio.sleep(.01)
+        for i in range(3):
+            scanner._on_detection(device, dotdict(local_name='JK-B2A24S', rssi=-70 - i))
+            await asyncio.sleep(.05)
+
+        adv = await waiter
+        assert adv.name == 'JK-B2A24S' and adv.rssi == -72 and adv.num_seen == 3
+        assert 0.04 < adv.interval < 0.1
+        assert seen == [device.address] * 3
+
+        assert find_advertisement(name='JK-B2A24S') is adv
+        assert find_advertisement(address=device.address) is adv
+        assert scanner.get(device.address, max_age=10) is adv
+        # not advertised since
+        assert await scanner.wait_for(device.address, timeout=.05, since=adv.t_last_seen) is None
+
+    try:
+        asyncio.run(run())
+    finally:
+        _scanners.pop('hci9', None)
+
+
+def test_stale_advertisement():
+    async def run():
+        scanner = get_scanner('hci8')
+        scanner.start = lambda: asyncio.sleep(0)
+        device = dotdict(address='C8:47:8C:00:00:02', name=None)
+        scanner._on_detection(device, dotdict(local_name='JK-B2A24S', rssi=-70))
+        scanner.advertisements[device.address].t_last_seen = time.time() - SCAN_MAX_AGE - 1
+
+        assert scanner.get(device.address, max_age=SCAN_MAX_AGE) is None
+        assert await scanner.wait_for(device.address, timeout=.05, since=time.time() - SCAN_MAX_AGE) is None
+
+        # the cached advertisement doesn't count as "in range", so no connect attempt is made
+        bms = BtBms(device.address, name='stale', adapter='hci8')
+        connects = []
+        bms._connect_client = lambda timeout: connects.append(timeout)
+        bms.client.disconnect = lambda: asyncio.sleep(0)
+        wait_for = scanner.wait_for
+        scanner.wait_for = lambda address, timeout, since=0.: wait_for(address, timeout=.01, since=since)
+        _sleep = asyncio.sleep
+        asyncio.sleep = lambda t: _sleep(0)
+        try:
+            await bms._connect_with_scanner()
+            assert False, 'should raise'
+        except Exception as e:
+            assert 'not discovered' in str(e)
+        finally:
+            asyncio.sleep = _sleep
+        assert connects == []
+
+    try:
+        asyncio.run(run())
+    finally:
+        _scanners.pop('hci8', None)
@@ -0,0 +1,220 @@
+import asyncio
+from collections import defaultdict
+
+from bmslib.scheduler import DeadlineScheduler, AdapterLimiter, parse_adapter_limits, BudgetedRound
+
+
+def test_no_drift():
+    async def run():
+        sched = DeadlineScheduler()
+
+        async def fetch():
+            await asyncio.sleep(0.03)
+            return True
+
+        job = sched.add(fetch, period=0.05, phase=0)
+        t0 = sched.time()
+        await sched.run(lambda: sched.time() - t0 > 0.52)
+        return job
+
+    job = asyncio.run(run())
+    # sleep-after-fetch would give ~6 runs, absolute deadlines give ~11
+    assert job.num_runs >= 9, job.stats()
+    assert job.num_missed == 0, job.stats()
+
+
+def test_missed_deadlines():
+    async def run():
+        sched = DeadlineScheduler()
+
+        async def slow_fetch():
+            await asyncio.sleep(0.12)
+            return True
+
+        job = sched.add(slow_fetch, period=0.05, phase=0)
+        t0 = sched.time()
+        await sched.run(lambda: sched.time() - t0 > 0.5)
+        return job
+
+    job = asyncio.run(run())
+    assert job.num_missed >= 4, job.stats()
+    assert job.num_runs <= 5, job.stats()
+
+
+def test_abort_on_errors():
+    async def run():
+        sched = DeadlineScheduler()
+
+        async def failing():
+            raise ValueError("fail")
+
+        sched.add(failing, period=0.01, max_errors=2, phase=0)
+        return await asyncio.wait_for(sched.run(lambda: False), 2)
+
+    job = asyncio.run(run())
+    assert job is not None and job.num_errors_row == 3
+
+
+def test_cancel_on_exit():
+    async def run():
+        sched = DeadlineScheduler()
+        cancelled = []
+
+        async def stray_cancel():
+            # bleak cancelling a pending future counts as an error
+            raise asyncio.CancelledError()
+
+        async def long_fetch():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        stray = sched.add(stray_cancel, period=0.01, phase=0)
+        job = sched.add(long_fetch, period=0.01, phase=0)
+        t0 = sched.time()
+        await sched.run(lambda: sched.time() - t0 > 0.1)
+        assert cancelled == [True] and not sched._tasks and not job.running
+        assert stray.num_errors_row > 1
+
+        # the cancelled job resumes at the next run
+        await sched.run(lambda: sched.time() - t0 > 0.2)
+        return job
+
+    job = asyncio.run(run())
+    assert job.num_runs == 2, job.stats()
+
+
+def test_adapter_limits():
+    async def run():
+        sched = DeadlineScheduler(limiter=AdapterLimiter(*parse_adapter_limits('hci0=1,hci1=2')))
+        in_flight = defaultdict(int)
+        peak = defaultdict(int)
+
+        def make_fetch(adapter):
+            async def fetch():
+                in_flight[adapter] += 1
+                peak[adapter] = max(peak[adapter], in_flight[adapter])
+                await asyncio.sleep(0.02)
+                in_flight[adapter] -= 1
+                return True
+
+            return fetch
+
+        for i in range(6):
+            adapter = 'hci%d' % (i % 2)
+            sched.add(make_fetch(adapter), period=0.01, phase=0, adapter=adapter)
+        t0 = sched.time()
+        await sched.run(lambda: sched.time() - t0 > 0.3)
+        return peak
+
+    peak = asyncio.run(run())
+    assert peak['hci0'] == 1
+    assert peak['hci1'] == 2
+
+
+def test_parse_adapter_limits():
+    assert parse_adapter_limits('hci0=3, hci1=5') == (dict(hci0=3, hci1=5), 0)
+    assert parse_adapter_limits('2') == ({}, 2)
+    assert parse_adapter_limits(None) == ({}, 0)
+
+
+def test_priority_slots():
+    async def run():
+        limiter = AdapterLimiter(*parse_adapter_limits('1'))
+        order = []
+
+        async def use(name, urgency):
+            async with limiter.slot('hci0', lambda: urgency):
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        # the first one gets the free slot, the others queue and are served by urgency
+        await asyncio.gather(use('first', 0), use('low', 0.5), use('high', 3), use('mid', 1))
+        return order
+
+    assert asyncio.run(run()) == ['first', 'high', 'mid', 'low']
+
+
+def test_urgent_job_not_starved():
+    async def run():
+        sched = DeadlineScheduler(limiter=AdapterLimiter(*parse_adapter_limits('1')))
+        t_last = defaultdict(float)
+
+        def make_fetch(name):
+            async def fetch():
+                t_last[name] = sched.time()
+                await asyncio.sleep(0.02)
+                return True
+
+            return fetch
+
+        t0 = sched.time()
+        # 6 low-value jobs saturate the adapter, the pack with a short freshness target must still get its slot
+        for i in range(6):
+            sched.add(make_fetch('shunt%d' % i), period=0.01, phase=0, adapter='hci0',
+                      urgency=lambda n='shunt%d' % i: (sched.time() - (t_last[n] or t0)) / 1.0)
+        job = sched.add(make_fetch('pack'), period=0.05, phase=0, adapter='hci0',
+                        urgency=lambda: (sched.time() - (t_last['pack'] or t0)) / 0.05)
+        await sched.run(lambda: sched.time() - t0 > 0.6)
+        return job
+
+    job = asyncio.run(run())
+    # fifo would give it roughly every 7th slot (~4 runs)
+    assert job.num_runs >= 8, job.stats()
+
+
+def test_budgeted_round_defers_slow_device():
+    async def run():
+        calls = defaultdict(int)
+
+        def make_fetch(name, dt):
+            async def fetch():
+                calls[name] += 1
+                await asyncio.sleep(dt)
+
+            return fetch
+
+        slow, fast1, fast2 = make_fetch('slow', 0.5), make_fetch('fast1', 0.01), make_fetch('fast2', 0.01)
+        rnd = BudgetedRound(budget=0.1)
+        loop = asyncio.get_running_loop()
+        durations = []
+        for _ in range(5):
+            t0 = loop.time()
+            await rnd.run([slow, fast1, fast2])
+            durations.append(loop.time() - t0)
+            await asyncio.sleep(0.05)
+        stats = rnd.pop_stats()
+        rnd.cancel()
+        return calls, durations, stats
+
+    calls, durations, stats = asyncio.run(run())
+    # the slow device only costs its budget once, then runs in background and is skipped until done
+    assert max(durations) < 0.2, durations
+    assert calls['fast1'] == calls['fast2'] == 5
+    assert calls['slow'] == 1
+    assert stats['rounds'] == 5 and stats['deferred'] == 1 and stats['skipped'] == 4 and stats['in_background'] == 1
+
+
+def test_budgeted_round_completed_at_timeout(monkeypatch):
+    async def wait_for_late(aw, timeout):
+        # the call completes in the same loop iteration the budget runs out
+        try:
+            await aw
+        except Exception:
+            pass
+        raise asyncio.TimeoutError()
+
+    async def failing():
+        raise ValueError("fail")
+
+    async def run():
+        monkeypatch.setattr(asyncio, 'wait_for', wait_for_late)
+        rnd = BudgetedRound(budget=0.1)
+        exceptions = await rnd.run([failing])
+        return rnd, exceptions
+
+    rnd, exceptions = asyncio.run(run())
+    assert [str(e) for e in exceptions] == ['fail']
+    assert not rnd.lane and rnd.pop_stats()['deferred'] == 0
@@ -0,0 +1,55 @@
+import time
+
+from bmslib.shard import assign_shards, ShardHost
+
+
+def test_assign_shards():
+    devices = [
+        dict(address='AA:01', type='jk', alias='a', adapter='hci0'),
+        dict(address='AA:02', type='jk', alias='b', adapter='hci1'),
+        dict(address='AA:03', type='daly', alias='c', adapter='hci1'),
+        dict(address='AA:04', type='daly', alias='d'),
+        dict(address='b,c', type='group_parallel', alias='g'),
+    ]
+    shards = assign_shards(devices)
+    names = {k: [d['alias'] for d in v] for k, v in shards.items()}
+    assert names == dict(hci0=['a'], hci1=['b', 'c', 'g'], default=['d'])
+
+
+def test_assign_shards_group_spans_adapters():
+    devices = [
+        dict(address='AA:01', type='jk', alias='a', adapter='hci0'),
+        dict(address='AA:02', type='jk', alias='b', adapter='hci1'),
+        dict(address='a,b', type='group_parallel', alias='g'),
+    ]
+    shards = assign_shards(devices)
+    assert [d['alias'] for d in shards['hci0']] == ['a', 'b', 'g']
+
+
+def _echo_worker(shard_name, devices, worker_config, conn, meter_states):
+    conn.send(('meter_states', dict(echo=meter_states)))
+
+
+def _wait_for(cond, timeout=20):
+    t_end = time.time() + timeout
+    while not cond() and time.time() < t_end:
+        time.sleep(.05)
+    return cond()
+
+
+def test_restart_with_parent_meter_states():
+    host = ShardHost(mqtt_client=None, sinks=[], target=_echo_worker, worker_config={})
+    host.meter_states = dict(a=dict(charge=1.))
+    try:
+        host.start('hci0', [])
+        assert _wait_for(lambda: 'echo' in host.meter_states)
+        assert host.meter_states['echo'] == dict(a=dict(charge=1.))
+
+        # meter states received after the start, the restarted worker continues with them
+        host.meter_states['a'] = dict(charge=2.)
+        assert _wait_for(lambda: not host.shards['hci0'].is_alive)
+        host.check()
+        assert _wait_for(lambda: host.meter_states['echo'].get('a') == dict(charge=2.))
+        assert host.shards['hci0'].num_starts == 2
+    finally:
+        host.stop()
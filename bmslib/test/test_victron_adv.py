@@ -0,0 +1,42 @@
+import asyncio
+import math
+
+import pytest
+
+from bmslib.models.victron_adv import parse_battery_monitor, decrypt, VictronAdvBt, VICTRON_MANUFACTURER_ID
+from bmslib.util import dotdict
+
+# recorded SmartShunt advertisement and its key
+ADV_DATA = bytes.fromhex('100289a302b040af925d09a4d89aa0128bdef48c6298a9')
+ADV_KEY = 'aff4d0995b7d1e176c0c33ecb9e70dcd'
+
+
+def test_parse_battery_monitor():
+    values = parse_battery_monitor(bytes.fromhex('ffffe50400000000030000f40140df'))
+    assert math.isnan(values['remaining_mins'])
+    assert values['voltage'] == pytest.approx(12.53)
+    assert values['current'] == 0
+    assert values['consumed_ah'] == pytest.approx(-50.0)
+    assert values['soc'] == pytest.approx(50.0)
+    assert 'temperature' not in values
+
+
+def test_decrypt_and_fetch():
+    pytest.importorskip('cryptography')
+
+    record_type, plain = decrypt(ADV_DATA, bytes.fromhex(ADV_KEY))
+    assert record_type == 0x02
+    assert plain[:4] == bytes.fromhex('ffffe504')
+
+    async def run():
+        bms = VictronAdvBt('C0:3B:98:00:00:01', adv_key=ADV_KEY, name='shunt')
+        device = dotdict(address=bms.address)
+        adv_data = dotdict(manufacturer_data={VICTRON_MANUFACTURER_ID: ADV_DATA})
+        asyncio.get_running_loop().call_later(.05, bms._on_advertisement, device, adv_data)
+        sample = await bms.fetch()
+        assert sample.voltage == pytest.approx(12.53) and sample.soc == pytest.approx(50.0)
+        assert sample.charge == pytest.approx(-50.0)
+        info = await bms.fetch_device_info()
+        assert info.model == 'SmartShunt 500A/50mV'
+
+    asyncio.run(run())
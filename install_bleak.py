@@ -26,8 +26,21 @@ need_influxdb = bool(user_config.get('influxdb_host') or user_config.get('teleme
 if need_influxdb:
     args.append('influxdb')
 
+try:
+    import cryptography
+
+    cryptography_installed = True
+except ImportError:
+    cryptography_installed = False
+
+# victron_adv decrypts advertisements
+need_cryptography = any(dev.get('type') == 'victron_adv' for dev in user_config.get('devices', []))
+if need_cryptography and not cryptography_installed:
+    args.append('cryptography')
+
 installed_ver = bleak_version()
-if installed_ver == ver and (influxdb_installed or not need_influxdb):
+if installed_ver == ver and (influxdb_installed or not need_influxdb) and \
+        (cryptography_installed or not need_cryptography):
     sys.exit(0)
 
 logger.info(f'bleak {installed_ver} installed, want {ver}, running pip3 ' + ' '.join(args))
@@ -1,5 +1,6 @@
 import asyncio
 import atexit
+import json
 import os
 import random
 import signal
@@ -7,69 +8,78 @@ import sys
 import threading
 import time
 import traceback
-from typing import List, Dict
+from typing import List, Dict, Optional, Callable, Tuple
 
 import paho.mqtt.client as paho
 
 import bmslib.bt
 import mqtt_util
 from bmslib.bms import MIN_VALUE_EXPIRY
+from bmslib.connection import connection_manager
 from bmslib.group import BmsGroup, VirtualGroupBms
+from bmslib.loopmon import LoopMonitor
 from bmslib.models import construct_bms
+from bmslib.recovery import TieredRecovery, RecoveryTier
 from bmslib.sampling import BmsSampler
-from bmslib.store import load_user_config
+from bmslib.scanner import stop_scanners
+from bmslib.scheduler import DeadlineScheduler, AdapterLimiter, parse_adapter_limits, ScheduledJob, \
+    BudgetedRound
+from bmslib.store import load_user_config, user_config_file, diff_device_confs
 from bmslib.util import get_logger, exit_process
-from mqtt_util import mqtt_last_publish_time, mqtt_message_handler, mqtt_process_action_queue
+from mqtt_util import mqtt_last_publish_time, mqtt_message_handler
 
 logger = get_logger(verbose=False)
 
+INITIAL_CONNECT_CONCURRENCY = 2  # per adapter, if `adapter_concurrency` is not set
+RECOVERY_SETTLE_TIME = 60  # time to wait for data after each recovery action
+CONFIG_POLL_PERIOD = 5  # check the config file for changes
+MIN_ROUND_BUDGET = 5.  # serial sampling, default `serial_round_budget` for short sample periods
+STATS_PERIOD = 300  # log and publish serial round and event loop lag stats
+LOOP_LAG_DUMP_THRESHOLD = 2.  # dump the task stacks if the event loop is blocked longer
+
 user_config: Dict[str, any] = load_user_config()
+user_config_loaded = json.loads(json.dumps(user_config))  # as in the file, to detect option changes on reload
 
 shutdown = False
 t_last_store = 0
+t_process_start = time.time()
+t_last_power_cycle = 0
+meter_state_forward: Optional[Callable[[dict], None]] = None  # shard workers send meter states to the parent
 
 
 async def fetch_loop(fn, period, max_errors):
-    num_errors_row = 0
+    scheduler = DeadlineScheduler()
+    scheduler.add(fn, period=period, max_errors=max_errors, phase=0)
+    await scheduler.run(lambda: shutdown)
+    logger.info("fetch_loop %s ends", fn)
+
+
+async def push_loop(sampler: BmsSampler, sample_period: float):
+    """ Push mode, each call of the sampler processes the next sample the BMS streams """
+    logger.info('%s push mode (streamed samples)', sampler.bms.name)
     while not shutdown:
         try:
-            if await fn():
-                num_errors_row = 0
-        except Exception as e:
-            num_errors_row += 1
-            logger.error('Error (num %d, max %d) reading BMS: %s', num_errors_row, max_errors, e)
-            logger.error('Stack: %s', traceback.format_exc())
-            if max_errors and num_errors_row > max_errors:
-                logger.warning('too many errors, abort')
-                break
-        await asyncio.sleep(period)
-    logger.info("fetch_loop %s ends", fn)
+            sample = await sampler()
+        except Exception:
+            sample = None  # logged by the sampler
+        if sample is None and not shutdown:
+            # connect failed or device not found
+            await asyncio.sleep(max(sample_period, 1))
 
 
 def store_states(samplers: List[BmsSampler]):
     meter_states = {s.bms.name: s.get_meter_state() for s in samplers}
+    if meter_state_forward:
+        meter_state_forward(meter_states)
+        return
     from bmslib.store import store_meter_states
     store_meter_states(meter_states)
 
 
-def bg_checks(sampler_list, timeout, t_start):
-    global shutdown
-
-    now = time.time()
-
-    if timeout:
-        # compute time since last successful publish
-        pdt = now - (mqtt_last_publish_time() or t_start)
-        if pdt > timeout:
-            if mqtt_last_publish_time():
-                logger.error("MQTT message publish timeout (last %.0fs ago), exit", pdt)
-            else:
-                logger.error("MQTT never published a message after %.0fs, exit", timeout)
-            shutdown = True
-            return False
-
+def store_states_periodically(sampler_list, t_start):
     global t_last_store
     # store persistent states (metering) every 30s
+    now = time.time()
     if now - (t_last_store or t_start) > 30:
         t_last_store = now
         try:
@@ -77,74 +87,268 @@ def bg_checks(sampler_list, timeout, t_start):
         except Exception as e:
             logger.error('Error storing states: %s', e)
 
-    return True
 
-
-def background_thread(timeout: float, sampler_list: List[BmsSampler]):
+def background_thread(timeout: float, loop_monitor: LoopMonitor):
+    """
+    Checks the event loop heartbeat (and dumps the stacks if the loop is blocked).
+    Last resort if the event loop is stuck, `timeout` must include the time in-process recovery can take
+    """
+    global shutdown
     t_start = time.time()
     while not shutdown:
-        if not bg_checks(sampler_list, timeout, t_start):
-            break
-        time.sleep(4)
+        stall = loop_monitor.check()
+        if timeout:
+            if stall > timeout:
+                logger.error("Event loop blocked for %.0fs, exit", stall)
+                shutdown = True
+            # background_loop recovers publishing, this only triggers if it is gone
+            pdt = time.time() - (mqtt_last_publish_time() or t_start)
+            if pdt > timeout:
+                logger.error("MQTT message publish timeout (last %.0fs ago) and no recovery, exit", pdt)
+                shutdown = True
+        time.sleep(.5)
     logger.info("Background thread ends. shutdown=%s", shutdown)
     time.sleep(10)
     logger.info("Process still alive, suicide")
     exit_process(True, True)
 
 
-async def background_loop(timeout: float, sampler_list: List[BmsSampler]):
+def report_first_publish(sampler_list: List[BmsSampler], reported: set):
+    """
+    Log and publish the time from process start to the first MQTT publish of each device, and of the whole
+    process once every real device has published.
+    """
+    real = [s for s in sampler_list if not s.bms.is_virtual]
+    all_before = all(s in reported for s in real)
+
+    for s in sampler_list:
+        if s.t_first_publish is None or s in reported:
+            continue
+        reported.add(s)
+        ttfp = s.t_first_publish - t_process_start
+        logger.info('%s time to first publish %.1fs', s.bms.name, ttfp)
+        mqtt_util.mqtt_single_out(s.mqtt_client, f"{s.mqtt_topic_prefix}/stats/time_to_first_publish",
+                                  round(ttfp, 2), retain=True)
+
+    if real and not all_before and all(s in reported for s in real):
+        ttfp = max(s.t_first_publish for s in real) - t_process_start
+        logger.info('All %d devices published, time to first publish %.1fs (first %.1fs)', len(real), ttfp,
+                    min(s.t_first_publish for s in real) - t_process_start)
+        mqtt_util.mqtt_single_out(real[0].mqtt_client, "batmon/stats/time_to_first_publish", round(ttfp, 2),
+                                  retain=True)
+
+
+async def background_loop(timeout: float, sampler_list: List[BmsSampler], loop_monitor: LoopMonitor):
     global shutdown
 
     t_start = time.time()
+    t_last_stats = t_start
+    first_published = set()
 
     if timeout:
         logger.info("mqtt watchdog loop started with timeout %.1fs", timeout)
 
+    mqtt_client = next((s.mqtt_client for s in sampler_list), None)
+    publish_recovery = TieredRecovery('publish', [
+        RecoveryTier('mqtt_reconnect', lambda: mqtt_reconnect(mqtt_client), RECOVERY_SETTLE_TIME),
+        RecoveryTier('bt_client', lambda: recreate_stale_clients(sampler_list, timeout), RECOVERY_SETTLE_TIME),
+        RecoveryTier('bt_power', recovery_power_cycle, RECOVERY_SETTLE_TIME),
+    ])
+    device_recoveries: Dict[BmsSampler, TieredRecovery] = {}
+    adapter_recoveries: Dict[str, TieredRecovery] = {}
+    recovery_tasks = set()
+
+    async def recover_publish(t_stall):
+        global shutdown
+        if not await publish_recovery.recover(lambda: (mqtt_last_publish_time() or 0) > t_stall, t_stall):
+            logger.error("MQTT publishing did not recover, exit")
+            shutdown = True
+
+    async def recover_device(s: BmsSampler, t_stall):
+        # a single device doesn't stop the others, its sampler keeps retrying (with the circuit breaker)
+        rec = device_recoveries[s]
+        if await rec.recover(lambda: s.t_last_sample > t_stall, t_stall):
+            mqtt_util.mqtt_single_out(s.mqtt_client, f"{s.mqtt_topic_prefix}/stats/time_to_recover",
+                                      round(rec.last_ttr, 1))
+
+    async def recover_adapter(adapter, samplers: List[BmsSampler], t_stall):
+        await adapter_recoveries[adapter].recover(lambda: any(s.t_last_sample > t_stall for s in samplers), t_stall)
+
+    def start_recovery(coro):
+        task = asyncio.create_task(coro)
+        recovery_tasks.add(task)
+        task.add_done_callback(recovery_tasks.discard)
+
     while not shutdown:
 
-        await mqtt_process_action_queue()
-        if not bg_checks(sampler_list, timeout, t_start):
-            break
+        store_states_periodically(sampler_list, t_start)
+
+        if time.time() - t_last_stats > STATS_PERIOD:
+            t_last_stats = time.time()
+            stats = loop_monitor.pop_stats()
+            logger.info('Event loop lag [ms]: %s', stats)
+            for k, v in stats.items():
+                mqtt_util.mqtt_single_out(mqtt_client, f"batmon/stats/loop_lag/{k}", v)
+            for adapter, stats in connection_manager.stats().items():
+                logger.info('Connections %s: %s', adapter, stats)
+                for k, v in stats.items():
+                    mqtt_util.mqtt_single_out(mqtt_client, f"batmon/stats/connections/{adapter}/{k}", v)
+            stats = mqtt_util.pop_action_stats()
+            if stats['num_received']:
+                logger.info('Switch commands: %s', stats)
+                for k, v in stats.items():
+                    mqtt_util.mqtt_single_out(mqtt_client, f"batmon/stats/actions/{k}", v)
+            for s in sampler_list:
+                stats = s.bms.pop_response_stats() if hasattr(s.bms, 'pop_response_stats') else None
+                if stats and (stats['acquired'] or stats['broadcast']):
+                    logger.info('Responses %s: %s', s.bms.name, stats)
+                    for k, v in stats.items():
+                        mqtt_util.mqtt_single_out(s.mqtt_client, f"{s.mqtt_topic_prefix}/stats/responses/{k}", v)
+
+        if len(first_published) < len(sampler_list):
+            report_first_publish(sampler_list, first_published)
+
+        now = time.time()
+        if timeout and not publish_recovery.running:
+            # compute time since last successful publish
+            pdt = now - (mqtt_last_publish_time() or t_start)
+            if pdt > timeout:
+                if mqtt_last_publish_time():
+                    logger.error("MQTT message publish timeout (last %.0fs ago), recovering", pdt)
+                else:
+                    logger.error("MQTT never published a message after %.0fs, recovering", timeout)
+                start_recovery(recover_publish(now))
+
+        if timeout:
+            # adapter -> (samplers expected to work, whether each of them is stalled)
+            by_adapter: Dict[str, List[Tuple[BmsSampler, bool]]] = {}
+            for s in sampler_list:
+                if s.bms.is_virtual or not s.t_last_sample or s.bms.circuit_breaker.is_open:
+                    # never sampled (switched off, out of range) or backing off after connect failures
+                    continue
+                stalled = now - s.t_last_sample > timeout
+                by_adapter.setdefault(s.bms.adapter, []).append((s, stalled))
+                if not stalled:
+                    continue
+                rec = device_recoveries.get(s)
+                if rec is None:
+                    rec = device_recoveries[s] = TieredRecovery(s.bms.name, [
+                        RecoveryTier('bt_client', s.bms.recreate_client, RECOVERY_SETTLE_TIME),
+                    ])
+                if not rec.running:
+                    logger.error("%s no sample for %.0fs, recovering", s.bms.name, now - s.t_last_sample)
+                    start_recovery(recover_device(s, now))
+
+            # power-cycling interrupts all devices of the adapter, only if none of them is sampling
+            for adapter, entries in by_adapter.items():
+                if not all(stalled for _, stalled in entries):
+                    continue
+                rec = adapter_recoveries.get(adapter)
+                if rec is None:
+                    rec = adapter_recoveries[adapter] = TieredRecovery('adapter %s' % (adapter or 'default'), [
+                        RecoveryTier('bt_power', recovery_power_cycle, RECOVERY_SETTLE_TIME),
+                    ])
+                if not rec.running:
+                    logger.error("all %d devices on adapter %s stalled, recovering", len(entries), adapter or 'default')
+                    start_recovery(recover_adapter(adapter, [s for s, _ in entries], now))
+
+        await asyncio.sleep(1)
+
+    for task in recovery_tasks:
+        task.cancel()
+
+
+async def mqtt_reconnect(mqtt_client):
+    if not hasattr(mqtt_client, 'reconnect'):
+        return  # no broker configured, or a shard worker which publishes through the parent
+    logger.info('Reconnecting MQTT')
+    await asyncio.get_running_loop().run_in_executor(None, mqtt_client.reconnect)
+
+
+async def recreate_stale_clients(sampler_list: List[BmsSampler], timeout):
+    now = time.time()
+    for s in sampler_list:
+        if not s.bms.is_virtual and now - s.t_last_sample > timeout:
+            await s.bms.recreate_client()
 
-        await asyncio.sleep(.1)
 
+async def recovery_power_cycle():
+    # recoveries of multiple devices share the adapter, power-cycle at most once per settle time
+    global t_last_power_cycle
+    if time.time() - t_last_power_cycle < RECOVERY_SETTLE_TIME:
+        logger.info('Bluetooth power cycled %.0fs ago, skip', time.time() - t_last_power_cycle)
+        return
+    t_last_power_cycle = time.time()
+    await bt_power_cycle()
+    connection_manager.reset_breakers()
 
-async def main():
-    global shutdown
 
-    bms_list: List[bmslib.bt.BtBms] = []
-    extra_tasks = []  # currently unused, add custom coroutines here. must return True on success and can raise
+async def bt_power_cycle():
+    try:
+        logger.info('Power cycle bluetooth hardware')
+        bmslib.bt.bt_power(False)
+        await asyncio.sleep(1)
+        bmslib.bt.bt_power(True)
+        await asyncio.sleep(2)
+    except Exception as e:
+        logger.warning("Error power cycling BT: %s", e)
 
-    if user_config.get('bt_power_cycle'):
-        try:
-            logger.info('Power cycle bluetooth hardware')
-            bmslib.bt.bt_power(False)
-            await asyncio.sleep(1)
-            bmslib.bt.bt_power(True)
-            await asyncio.sleep(2)
-        except Exception as e:
-            logger.warning("Error power cycling BT: %s", e)
 
+def discovery_needed(device_confs: List[dict]) -> bool:
+    """
+    Whether a device needs a bluetooth discovery before it can be constructed: its address is a bluetooth name, or it
+    has no alias and needs its bluetooth name. Names resolved by previous runs are taken from the device meta store.
+    """
+    from bmslib.store import find_device_address, load_device_meta
+
+    for dev in device_confs:
+        addr: str = dev.get('address') or ''
+        if not addr or addr.startswith('#') or addr.startswith('test_') or dev.get('type', '').startswith('group_') \
+                or dev.get('type') == 'dummy':
+            continue
+        if not bmslib.bt.is_device_address(addr):
+            if not find_device_address(addr.strip()):
+                logger.info('discovery needed to resolve address of %s', addr)
+                return True
+        elif not dev.get('alias') and not load_device_meta(addr).get('name'):
+            logger.info('discovery needed to resolve name of %s', addr)
+            return True
+    return False
+
+
+async def discover_devices(store_names=False):
+    """
+    :param store_names: store the names of the discovered devices for later name lookups
+    :return: discovered devices, empty on error
+    """
     try:
-        if len(sys.argv) > 1 and sys.argv[1] == "skip-discovery":
-            raise Exception("skip-discovery")
         devices = await asyncio.wait_for(bmslib.bt.bt_discovery(logger), 30)
     except Exception as e:
-        devices = []
         logger.error('Error discovering devices: %s', e)
+        return []
 
-    verbose_log = user_config.get('verbose_log', False)
-    if verbose_log:
-        logger.info('Verbose logging enabled')
+    if store_names:
+        from bmslib.store import store_device_meta
+        configured = {(dev.get('address') or '').strip() for dev in user_config.get('devices', [])}
+        for d in devices:
+            if d.name and d.address in configured:
+                store_device_meta(d.address, name=d.name.strip())
+
+    return devices
 
-    logger.info('Bleak version %s, BtBackend version %s', bmslib.bt.bleak_version(), bmslib.bt.bt_stack_version())
 
+def construct_devices(device_confs: List[dict], discovered_devices, verbose_log: bool):
+    """
+    Construct BMS instances and groups from device configs.
+    :return: bms_list, dev_args, groups_by_bms, bms_by_name
+    """
+    bms_list: List[bmslib.bt.BtBms] = []
     names = set()
     dev_args: Dict[str, dict] = {}
 
-    for dev in user_config.get('devices', []):
+    for dev in device_confs:
 
-        bms = construct_bms(dev, verbose_log, devices)
+        bms = construct_bms(dev, verbose_log, discovered_devices)
 
         if bms is None:
             logger.info("Skip %s", dev)
@@ -176,56 +380,61 @@ async def main():
                 if member_name in groups_by_bms:
                     raise Exception("can't add bms %s to multiple groups %s %s", member_name,
                                     groups_by_bms[member_name], group_bms)
-                
+
                 groups_by_bms[member_name] = group_bms.group
                 bms.add_member(bms_by_name[member_ref])
 
+    return bms_list, dev_args, groups_by_bms, bms_by_name
+
+
+def connect_mqtt(on_message):
     # import env vars from addon_main.sh
     for k, en in dict(mqtt_broker='MQTT_HOST', mqtt_user='MQTT_USER', mqtt_password='MQTT_PASSWORD').items():
         if not user_config.get(k) and os.environ.get(en):
             user_config[k] = os.environ[en]
 
-    if user_config.get('mqtt_broker'):
-        port_idx = user_config.mqtt_broker.rfind(':')
-        if port_idx > 0:
-            user_config.mqtt_port = user_config.get('mqtt_port', int(user_config.mqtt_broker[(port_idx + 1):]))
-            user_config.mqtt_broker = user_config.mqtt_broker[:port_idx]
+    if not user_config.get('mqtt_broker'):
+        return None
 
-        logger.info('connecting mqtt %s@%s', user_config.mqtt_user, user_config.mqtt_broker)
-        # paho_monkey_patch()
-        mqtt_client = paho.Client(paho.CallbackAPIVersion.VERSION1)
-        mqtt_client.enable_logger(logger)
-        if user_config.get('mqtt_user', None):
-            mqtt_client.username_pw_set(user_config.mqtt_user, user_config.mqtt_password)
+    port_idx = user_config.mqtt_broker.rfind(':')
+    if port_idx > 0:
+        user_config.mqtt_port = user_config.get('mqtt_port', int(user_config.mqtt_broker[(port_idx + 1):]))
+        user_config.mqtt_broker = user_config.mqtt_broker[:port_idx]
 
-        mqtt_client.on_message = mqtt_message_handler
+    logger.info('connecting mqtt %s@%s', user_config.mqtt_user, user_config.mqtt_broker)
+    # paho_monkey_patch()
+    mqtt_client = paho.Client(paho.CallbackAPIVersion.VERSION1)
+    mqtt_client.enable_logger(logger)
+    if user_config.get('mqtt_user', None):
+        mqtt_client.username_pw_set(user_config.mqtt_user, user_config.mqtt_password)
 
-        try:
-            mqtt_client.connect(user_config.mqtt_broker, port=user_config.get('mqtt_port', 1883))
-            mqtt_client.loop_start()
-        except Exception as ex:
-            logger.error('mqtt connection error %s', ex)
+    mqtt_client.on_message = on_message
+
+    try:
+        mqtt_client.connect(user_config.mqtt_broker, port=user_config.get('mqtt_port', 1883))
+        mqtt_client.loop_start()
+    except Exception as ex:
+        logger.error('mqtt connection error %s', ex)
+
+    if not user_config.mqtt_broker:
+        mqtt_util.disable_warnings()
+
+    return mqtt_client
 
-        if not user_config.mqtt_broker:
-            mqtt_util.disable_warnings()
-    else:
-        mqtt_client = None
 
+def load_meter_states_or_init():
     from bmslib.store import load_meter_states
     try:
-        meter_states = load_meter_states()
+        return load_meter_states()
     except FileNotFoundError:
         logger.info("Initialize meter states file")
-        meter_states = {}
+        return {}
     except Exception as e:
         logger.warning('Failed to load meter states: %s', e)
-        meter_states = {}
+        return {}
 
-    sample_period = float(user_config.get('sample_period', 1.0))
-    publish_period = float(user_config.get('publish_period', sample_period))
-    expire_values_after = float(user_config.get('expire_values_after', MIN_VALUE_EXPIRY))
-    ic = user_config.get('invert_current', False)
 
+def create_sinks(bms_by_name):
     sinks = []
     if user_config.get('influxdb_host', None):
         from bmslib.sinks import InfluxDBSink
@@ -238,11 +447,25 @@ async def main():
         except:
             logger.warning("failed to init telemetry", exc_info=True)
 
+    return sinks
+
+
+def create_samplers(bms_list, dev_args, groups_by_bms, mqtt_client, sinks, meter_states) -> List[BmsSampler]:
+    sample_period = float(user_config.get('sample_period', 1.0))
+    publish_period = float(user_config.get('publish_period', sample_period))
+    expire_values_after = float(user_config.get('expire_values_after', MIN_VALUE_EXPIRY))
+    ic = user_config.get('invert_current', False)
+
+    def device_period_max(name):
+        # idle sample period of activity-adaptive sampling
+        return float(dev_args[name].get('sample_period_max') or 0)
+
     sampler_list = [BmsSampler(
         bms, mqtt_client=mqtt_client,
-        dt_max_seconds=max(60. * 10, sample_period * 2),
+        dt_max_seconds=max(60. * 10, sample_period * 2, device_period_max(bms.name) * 2),
         expire_after_seconds=expire_values_after and max(expire_values_after, int(sample_period * 2 + .5),
-                                                         int(publish_period * 2 + .5)),
+                                                         int(publish_period * 2 + .5),
+                                                         int(device_period_max(bms.name) * 2 + .5)),
         invert_current=ic,
         meter_state=meter_states.get(bms.name),
         publish_period=publish_period,
@@ -250,75 +473,196 @@ async def main():
         current_calibration_factor=float(dev_args[bms.name].get('current_calibration', 1.0)),
         bms_group=groups_by_bms.get(bms.name),
         sinks=sinks,
+        period_min=float(dev_args[bms.name].get('sample_period_min') or 0) or None,
+        period_max=device_period_max(bms.name) or None,
+        freshness=float(dev_args[bms.name].get('freshness') or 0) or None,
     ) for bms in bms_list]
 
     # move groups to the end
-    sampler_list = sorted(sampler_list, key=lambda s: bms.is_virtual)
+    return sorted(sampler_list, key=lambda s: s.bms.is_virtual)
 
+
+async def run_samplers(sampler_list: List[BmsSampler], sinks, extra_tasks, dev_args: Optional[dict] = None,
+                       bms_by_name: Optional[dict] = None):
+    """
+    Connect and sample the BMSs until shutdown. Disconnects all devices before returning.
+    :param dev_args: device configs by name, enables reloading the devices from the config file
+    :param bms_by_name: updated on config reload (the sinks hold a reference)
+    """
+    global shutdown
+
+    bms_list = [s.bms for s in sampler_list]
+    sample_period = float(user_config.get('sample_period', 1.0))
     parallel_fetch = user_config.get('concurrent_sampling', False)
+    adapter_limiter = AdapterLimiter(*parse_adapter_limits(user_config.get('adapter_concurrency')))
+    connection_manager.configure(parse_adapter_limits(user_config.get('connection_slots')))
 
     logger.info('Fetching %d BMS + %d virtual + %d others %s, period=%.2fs, keep_alive=%s',
                 sum(not bms.is_virtual for bms in bms_list),
                 sum(bms.is_virtual for bms in bms_list), len(extra_tasks),
-                'concurrently' if parallel_fetch else 'serially', sample_period, user_config.get('keep_alive', False))
+                ('concurrently (%s)' % adapter_limiter) if parallel_fetch else 'serially', sample_period,
+                user_config.get('keep_alive', False))
 
     watchdog_en = user_config.get('watchdog', False)
     max_errors = 200 if watchdog_en else 0
 
-    wd_timeout = max(5 * 60., sample_period * 4) if watchdog_en else 0
+    # switch commands from the MQTT thread are dispatched to this loop
+    mqtt_util.set_action_loop(asyncio.get_running_loop())
+
+    period_max = max([s.period_max or 0 for s in sampler_list] + [sample_period])
+    wd_timeout = max(5 * 60., period_max * 4) if watchdog_en else 0
+    loop_monitor = LoopMonitor(dump_threshold=LOOP_LAG_DUMP_THRESHOLD)
+    loop_monitor.start()
     asyncio.create_task(background_loop(
         timeout=wd_timeout,
-        sampler_list=sampler_list
+        sampler_list=sampler_list,
+        loop_monitor=loop_monitor,
     ))
 
-    # add another daemon thread, asyncio can dead-lock with bleak TODO bug?
-    threading.Thread(target=lambda: background_thread(wd_timeout, sampler_list), daemon=True).start()
+    # watch the event loop from a thread, asyncio can dead-lock with bleak TODO bug?
+    # this thread gives in-process recovery (see background_loop) time to complete before it exits the process
+    thread_timeout = wd_timeout and wd_timeout + 3 * RECOVERY_SETTLE_TIME + 60
+    threading.Thread(target=lambda: background_thread(thread_timeout, loop_monitor), daemon=True,
+                     name='loop_watchdog').start()
 
     tasks = sampler_list + extra_tasks
 
-    # before we start the loops connect to each bms in random order
-    tasks_shuffle = list(tasks)
-    random.shuffle(tasks_shuffle)
-    for t in tasks_shuffle:
-        if isinstance(t, BmsSampler) and t.bms.is_virtual:
-            continue
-        try:
-            await t()
-        except:
-            pass
+    # connect to the BMSs concurrently (bounded per adapter), each device starts sampling as soon as it is up
+    ready = set()
+    connect_limiter = AdapterLimiter(adapter_limiter.limits, adapter_limiter.default or INITIAL_CONNECT_CONCURRENCY)
+    connect_tasks = set()
+
+    # parallel_fetch uses a deadline scheduler, each BMS is sampled at its own phase so they don't delay each other
+    # with `adapter_concurrency` the number of in-flight fetches is bounded for each bluetooth adapter
+    scheduler = DeadlineScheduler(limiter=adapter_limiter) if parallel_fetch else None
+    jobs: Dict[object, ScheduledJob] = {}
+
+    # devices that stream samples (with keep_alive) are sampled as the samples arrive, the others are polled
+    push_sampling = user_config.get('push_sampling', True)
+    push_tasks: Dict[BmsSampler, asyncio.Task] = {}
+
+    def start_sampling(t):
+        if push_sampling and isinstance(t, BmsSampler) and not t.bms.is_virtual and t.bms.supports_push:
+            t.enable_push(sample_period)
+            push_tasks[t] = asyncio.create_task(push_loop(t, sample_period))
+            return
+        ready.add(t)
+        if scheduler is None:
+            return
+        if isinstance(t, BmsSampler):
+            job = scheduler.add(t, period=lambda s=t: s.next_period(sample_period), max_errors=max_errors,
+                                name=t.bms.name, adapter=None if t.bms.is_virtual else t.bms.adapter,
+                                urgency=lambda s=t: s.urgency(sample_period))
+            t.on_activity = lambda j=job: scheduler.wake(j)
+        else:
+            job = scheduler.add(t, period=sample_period, max_errors=max_errors)
+        jobs[t] = job
+
+    async def initial_connect(t: BmsSampler):
+        async with connect_limiter.slot(t.bms.adapter):
+            try:
+                await t()
+            except:
+                pass
+        if t in tasks:  # might have been removed by a config reload meanwhile
+            start_sampling(t)
+
+    def start(new_tasks):
+        new_tasks = list(new_tasks)
+        random.shuffle(new_tasks)
+        for t in new_tasks:
+            if not isinstance(t, BmsSampler) or t.bms.is_virtual:
+                start_sampling(t)
+            else:
+                task = asyncio.create_task(initial_connect(t))
+                connect_tasks.add(task)
+                task.add_done_callback(connect_tasks.discard)
+
+    async def add_samplers(samplers: List[BmsSampler]):
+        sampler_list.extend(samplers)
+        tasks.extend(samplers)
+        start(samplers)
+
+    async def remove_samplers(samplers: List[BmsSampler]):
+        store_states(sampler_list)  # keep the meter readings of the removed samplers
+        for s in samplers:
+            sampler_list.remove(s)
+            tasks.remove(s)
+            ready.discard(s)
+        for s in samplers:
+            push_task = push_tasks.pop(s, None)
+            if push_task:
+                push_task.cancel()
+            job = jobs.pop(s, None)
+            if job:
+                scheduler.remove(job)
+                for _ in range(100):
+                    if not job.running:
+                        break
+                    await asyncio.sleep(.1)
+            try:
+                logger.info("Disconnecting %s", s.bms)
+                await s.bms.disconnect()
+            except:
+                pass
+
+    if dev_args is not None:
+        asyncio.create_task(config_reload_loop(sampler_list, dev_args, bms_by_name, sinks,
+                                               add_samplers, remove_samplers))
+
+    start(tasks)
+
+    if scheduler:
+        while not shutdown:
+            aborted = await scheduler.run(lambda: shutdown)
+            if aborted:
+                # recover the job, it will continue at its next deadline
+                aborted.num_errors_row = 0
 
-    if parallel_fetch:
-        # parallel_fetch now uses a loop for each BMS, so they don't delay each other
+    else:
+        # a device that takes longer than its share of the round budget continues in background, so a single
+        # unresponsive BMS doesn't delay the others
+        round_budget = float(user_config.get('serial_round_budget') or max(sample_period * 2, MIN_ROUND_BUDGET))
+        budgeted_round = BudgetedRound(round_budget,
+                                       name=lambda t: t.bms.name if isinstance(t, BmsSampler) else str(t))
+        t_round_stats = time.time()
+
+        def publish_round_stats():
+            stats = budgeted_round.pop_stats()
+            logger.info('Serial rounds (budget %.1fs): %s', round_budget, stats)
+            mqtt_client = next((s.mqtt_client for s in sampler_list), None)
+            for k, v in stats.items():
+                mqtt_util.mqtt_single_out(mqtt_client, f"batmon/stats/serial_round/{k}", v)
+
+        async def fn():
+            nonlocal t_round_stats
+            round_tasks = [t for t in tasks if t in ready]
+            random.shuffle(round_tasks)
+            # devices furthest from their freshness target first, groups last (they aggregate the members)
+            round_tasks.sort(key=lambda t: (t.bms.is_virtual, -t.urgency(sample_period))
+                             if isinstance(t, BmsSampler) else (True, 0))
+            # skip idle devices with a longer sample period
+            round_tasks = [t for t in round_tasks if not isinstance(t, BmsSampler)
+                           or t.is_due(sample_period, tolerance=sample_period / 2)]
+            # removed by a config reload during the round?
+            exceptions = await budgeted_round.run(round_tasks, should_run=lambda t: t in ready)
+
+            if time.time() - t_round_stats > STATS_PERIOD:
+                t_round_stats = time.time()
+                publish_round_stats()
+
+            if exceptions:
+                logger.error('%d exceptions occurred fetching BMSs', len(exceptions))
+                raise exceptions[0]
 
-        # this outer while loop recovers from a cancelled task. this happens when a device disconnects (bleak bug?)
         while not shutdown:
-            loops = [asyncio.create_task(fetch_loop(fn, period=sample_period, max_errors=max_errors)) for fn in tasks]
-            done, pending = await asyncio.wait(loops, return_when='FIRST_COMPLETED')
+            # devices that keep failing are recovered by background_loop, keep sampling the others
+            await fetch_loop(fn, period=sample_period, max_errors=max_errors)
 
-            logger.debug('Done= %s, Pending=%s', done, pending)
-            for task in loops:
-                logger.debug('Task %s is done=%s', task, task.done())
-                task.done() or task.cancel()
+        budgeted_round.cancel()
 
-    else:
-        async def fn():
-            if parallel_fetch:
-                # concurrent synchronised fetch
-                # this branch is currently not reachable!
-                await asyncio.gather(*[t() for t in tasks], return_exceptions=False)
-            else:
-                random.shuffle(tasks)
-                exceptions = []
-                for t in tasks:
-                    try:
-                        await t()
-                    except Exception as ex:
-                        exceptions.append(ex)
-                if exceptions:
-                    logger.error('%d exceptions occurred fetching BMSs', len(exceptions))
-                    raise exceptions[0]
-
-        await fetch_loop(fn, period=sample_period, max_errors=max_errors)
+    for task in list(connect_tasks) + list(push_tasks.values()):
+        task.cancel()
 
     logger.info('All fetch loops ended. shutdown is already %s', shutdown)
     shutdown = True
@@ -331,7 +675,7 @@ async def main():
         except:
             pass
 
-    for bms in bms_list:
+    for bms in [s.bms for s in sampler_list]:
         try:
             logger.info("Disconnecting %s", bms)
             await bms.disconnect()
@@ -339,6 +683,228 @@ async def main():
         except:
             pass
 
+    await stop_scanners()
+
+
+async def config_reload_loop(sampler_list: List[BmsSampler], dev_args: dict, bms_by_name: dict, sinks,
+                             add_samplers, remove_samplers):
+    """
+    Watch the config file (and the MQTT topic `batmon/reload_config`) and start/stop the samplers of devices that
+    were added, removed or changed. Samplers of unchanged devices keep running.
+    """
+    reload_event = asyncio.Event()
+    mqtt_client = next((s.mqtt_client for s in sampler_list), None)
+
+    async def on_reload_command(_payload):
+        reload_event.set()
+
+    if mqtt_client:
+        mqtt_util.subscribe_command(mqtt_client, "batmon/reload_config", on_reload_command)
+
+    def config_mtime():
+        try:
+            return os.stat(user_config_file()).st_mtime
+        except OSError:
+            return None
+
+    mtime = config_mtime()
+    while not shutdown:
+        try:
+            await asyncio.wait_for(reload_event.wait(), timeout=CONFIG_POLL_PERIOD)
+        except asyncio.TimeoutError:
+            pass
+
+        if not reload_event.is_set() and config_mtime() == mtime:
+            continue
+        reload_event.clear()
+        mtime = config_mtime()
+
+        try:
+            await reload_devices(sampler_list, dev_args, bms_by_name, sinks, mqtt_client, add_samplers,
+                                 remove_samplers)
+        except Exception as e:
+            logger.error('Error reloading config: %s', e, exc_info=True)
+
+
+async def reload_devices(sampler_list, dev_args, bms_by_name, sinks, mqtt_client, add_samplers, remove_samplers):
+    global user_config_loaded
+    new_config = load_user_config()
+
+    for k in set(user_config_loaded.keys()) | set(new_config.keys()):
+        if k != 'devices' and user_config_loaded.get(k) != new_config.get(k):
+            logger.warning('Option %s changed, restart the add-on to apply', k)
+    user_config_loaded = json.loads(json.dumps(new_config))
+
+    removed, added = diff_device_confs(user_config.get('devices', []), new_config.get('devices', []))
+    if not removed and not added:
+        logger.info('Config reload: devices unchanged')
+        return
+
+    stop = [s for s in sampler_list if dev_args.get(s.bms.name) in removed]
+    logger.info('Config reload: stopping %s, starting %s', [s.bms.name for s in stop],
+                [d.get('alias') or d.get('address') for d in added])
+
+    # stop first, connected devices don't advertise (discovery)
+    await remove_samplers(stop)
+    stopped_args = {s.bms.name: dev_args.pop(s.bms.name) for s in stop if s.bms.name in dev_args}
+    stopped_names = {k: bms for k, bms in bms_by_name.items() if any(bms is s.bms for s in stop)}
+    for k in stopped_names:
+        del bms_by_name[k]
+
+    try:
+        discovered = await discover_devices() if discovery_needed(added) else []
+        bms_list, new_dev_args, groups_by_bms, new_bms_by_name = construct_devices(
+            added, discovered, verbose_log=user_config.get('verbose_log', False))
+        samplers = create_samplers(bms_list, new_dev_args, groups_by_bms, mqtt_client, sinks,
+                                   load_meter_states_or_init())
+    except Exception:
+        # keep the previous devices and config
+        logger.warning('Config reload failed, restarting %s', [s.bms.name for s in stop])
+        dev_args.update(stopped_args)
+        bms_by_name.update(stopped_names)
+        await add_samplers(stop)
+        raise
+
+    user_config['devices'] = new_config.get('devices', [])
+    for s in stop:
+        mqtt_util.unsubscribe_switches(s.mqtt_client, s.mqtt_topic_prefix)
+        connection_manager.forget(s.bms)
+
+    dev_args.update(new_dev_args)
+    bms_by_name.update(new_bms_by_name)
+    await add_samplers(samplers)
+
+
+async def run_sharded(discovered_devices):
+    """
+    Sharded mode: one worker process per bluetooth adapter samples the devices, this process publishes.
+    """
+    global shutdown
+    from bmslib.shard import ShardHost, assign_shards
+
+    watchdog_en = user_config.get('watchdog', False)
+    sample_period = float(user_config.get('sample_period', 1.0))
+
+    # workers resolve names with the discovery results of this process
+    worker_config = dict(user_config, _discovered=[dict(address=d.address, name=d.name) for d in discovered_devices],
+                         _t_start=t_process_start)
+
+    host = ShardHost(mqtt_client=None, sinks=[], target=shard_worker, worker_config=worker_config,
+                     silence_timeout=max(5 * 60., sample_period * 4) if watchdog_en else 0)
+    host.mqtt_client = connect_mqtt(on_message=host.on_mqtt_message)
+    host.sinks = create_sinks(bms_by_name=host.bms_by_name)
+    host.meter_states = load_meter_states_or_init()
+
+    shards = assign_shards(user_config.get('devices', []))
+    logger.info('Sharded sampling with %d worker processes: %s', len(shards),
+                {k: [d.get('alias') or d['address'] for d in v] for k, v in shards.items()})
+    for name, devices in shards.items():
+        host.start(name, devices)
+
+    t_last_store = time.time()
+    while not shutdown:
+        await asyncio.sleep(1)
+        host.check()
+
+        if time.time() - t_last_store > 30:
+            t_last_store = time.time()
+            try:
+                from bmslib.store import store_meter_states
+                store_meter_states(host.meter_states)
+            except Exception as e:
+                logger.error('Error storing states: %s', e)
+
+    host.stop()
+    from bmslib.store import store_meter_states
+    store_meter_states(host.meter_states)
+    for sink in host.sinks:
+        try:
+            sink.flush()
+        except:
+            pass
+
+
+def shard_worker(shard_name: str, devices: List[dict], worker_config: dict, conn, meter_states: dict):
+    """
+    Entry point of a worker process in sharded mode.
+    :param meter_states: meter states of the parent process
+    """
+    from bmslib.shard import ShardMqttClient, ShardSink
+    from bmslib.util import dotdict
+
+    global meter_state_forward
+
+    global t_process_start
+    user_config.update(worker_config)
+    t_process_start = worker_config.get('_t_start', t_process_start)
+    setup_signal_handlers()
+    logger.info('shard worker %s starting, pid %d', shard_name, os.getpid())
+
+    client = ShardMqttClient(conn)
+    meter_state_forward = client.send_meter_states
+    threading.Thread(target=lambda: client.read_commands(mqtt_message_handler), daemon=True).start()
+
+    async def worker_main():
+        bms_list, dev_args, groups_by_bms, _ = construct_devices(
+            devices, [dotdict(d) for d in user_config.get('_discovered', [])],
+            verbose_log=user_config.get('verbose_log', False))
+        client.send('devices', {bms.name: bms.address for bms in bms_list})
+        sinks = [ShardSink(client)] if user_config.get('influxdb_host') or user_config.get('telemetry') else []
+        sampler_list = create_samplers(bms_list, dev_args, groups_by_bms, mqtt_client=client, sinks=sinks,
+                                       meter_states=meter_states)
+        await run_samplers(sampler_list, sinks=[], extra_tasks=[])
+
+    try:
+        asyncio.run(worker_main())
+    except Exception as e:
+        logger.error("Shard %s loop exception: %s", shard_name, e)
+        logger.error("Stack: %s", traceback.format_exc())
+
+    sys.exit(1)
+
+
+async def main():
+    extra_tasks = []  # currently unused, add custom coroutines here. must return True on success and can raise
+
+    if user_config.get('bt_power_cycle'):
+        await bt_power_cycle()
+
+    devices = []
+    background_discovery = None
+    if len(sys.argv) > 1 and sys.argv[1] == "skip-discovery":
+        logger.info('skip-discovery')
+    elif discovery_needed(user_config.get('devices', [])):
+        devices = await discover_devices()
+    else:
+        # all addresses are known, don't delay the connects. the results are stored for name lookups
+        background_discovery = asyncio.create_task(discover_devices(store_names=True))
+
+    verbose_log = user_config.get('verbose_log', False)
+    if verbose_log:
+        logger.info('Verbose logging enabled')
+
+    logger.info('Bleak version %s, BtBackend version %s', bmslib.bt.bleak_version(), bmslib.bt.bt_stack_version())
+
+    try:
+        if user_config.get('sharded_sampling'):
+            await run_sharded(devices)
+            return
+
+        bms_list, dev_args, groups_by_bms, bms_by_name = construct_devices(user_config.get('devices', []), devices,
+                                                                           verbose_log)
+
+        mqtt_client = connect_mqtt(on_message=mqtt_message_handler)
+
+        meter_states = load_meter_states_or_init()
+
+        sinks = create_sinks(bms_by_name)
+
+        sampler_list = create_samplers(bms_list, dev_args, groups_by_bms, mqtt_client, sinks, meter_states)
+
+        await run_samplers(sampler_list, sinks, extra_tasks, dev_args=dev_args, bms_by_name=bms_by_name)
+    finally:
+        background_discovery and background_discovery.cancel()
+
 
 def on_exit(*args, **kwargs):
     global shutdown
@@ -349,16 +915,21 @@ def on_exit(*args, **kwargs):
         sys.exit(1)
 
 
-atexit.register(on_exit)
-# noinspection PyTypeChecker
-signal.signal(signal.SIGTERM, on_exit)
-# noinspection PyTypeChecker
-signal.signal(signal.SIGINT, on_exit)
+def setup_signal_handlers():
+    atexit.register(on_exit)
+    # noinspection PyTypeChecker
+    signal.signal(signal.SIGTERM, on_exit)
+    # noinspection PyTypeChecker
+    signal.signal(signal.SIGINT, on_exit)
 
-try:
-    asyncio.run(main())
-except Exception as e:
-    logger.error("Main loop exception: %s", e)
-    logger.error("Stack: %s", traceback.format_exc())
 
-sys.exit(1)
+if __name__ == '__main__':
+    setup_signal_handlers()
+
+    try:
+        asyncio.run(main())
+    except Exception as e:
+        logger.error("Main loop exception: %s", e)
+        logger.error("Stack: %s", traceback.format_exc())
+
+    sys.exit(1)
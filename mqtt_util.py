@@ -7,10 +7,11 @@ HA mdi: icons https://pictogrammers.com/library/mdi/
 import asyncio
 import json
 import math
-import queue
 import statistics
+import threading
 import time
 import traceback
+from typing import Optional, Dict, Set, List
 
 import paho.mqtt.client as paho
 
@@ -385,24 +386,94 @@ def publish_hass_discovery(client, device_topic, expire_after_seconds: int, samp
 
 
 _switch_callbacks = {}
-_message_queue = queue.Queue()
 
-
-async def mqtt_process_action_queue():
-    while not _message_queue.empty():
-        callback, arg = _message_queue.get(block=False)
-        try:
-            await callback(arg)
-        except Exception as e:
-            logger.error('exception in action callback: %s', e)
-            logger.error('Stack: %s', traceback.format_exc())
-            await asyncio.sleep(1)
-
-
-def subscribe_switches(mqtt_client: paho.Client, device_topic, bms: BtBms, switches):
+# switch commands arrive on paho's thread and are dispatched to this event loop
+_action_loop: Optional[asyncio.AbstractEventLoop] = None
+_action_lock: Optional[asyncio.Lock] = None
+_pending_actions: Dict[str, tuple] = {}  # topic -> (callback, payload, t_received), only the latest per topic
+_running_actions: Set[str] = set()
+# commands received before the event loop is set (retained messages right after subscribing)
+_early_actions: List[tuple] = []
+_early_actions_lock = threading.Lock()
+_ACTION_STATS_INIT = dict(num_received=0, num_coalesced=0, num_executed=0, num_errors=0, exec_time_max=0.,
+                         exec_time_sum=0., latency_max=0.)
+action_stats = dict(_ACTION_STATS_INIT)
+_action_tasks: Set[asyncio.Task] = set()
+
+
+def pop_action_stats() -> dict:
+    """ Switch command stats since the last call, times in seconds """
+    stats = dict(action_stats)
+    action_stats.update(_ACTION_STATS_INIT)
+    num_runs = stats['num_executed'] + stats['num_errors']
+    stats['exec_time_mean'] = stats.pop('exec_time_sum') / max(1, num_runs)
+    return {k: round(v, 3) if isinstance(v, float) else v for k, v in stats.items()}
+
+
+def set_action_loop(loop: Optional[asyncio.AbstractEventLoop]):
+    global _action_loop, _action_lock
+    with _early_actions_lock:
+        _action_loop = loop
+        _action_lock = None
+        if loop is None:
+            return
+        for action in _early_actions:
+            loop.call_soon_threadsafe(_enqueue_action, *action)
+        _early_actions.clear()
+
+
+def _enqueue_action(topic, callback, payload, t_received):
+    global _action_lock
+    action_stats['num_received'] += 1
+    if topic in _pending_actions:
+        # a burst of commands for the same switch, only the latest state is sent
+        action_stats['num_coalesced'] += 1
+        logger.info('coalesce %s: %s replaces %s', topic, payload, _pending_actions[topic][1])
+    _pending_actions[topic] = callback, payload, t_received
+
+    if topic not in _running_actions:
+        if _action_lock is None:
+            _action_lock = asyncio.Lock()
+        _running_actions.add(topic)
+        task = asyncio.ensure_future(_run_actions(topic))
+        _action_tasks.add(task)
+        task.add_done_callback(_action_tasks.discard)
+
+
+async def _run_actions(topic):
+    try:
+        while topic in _pending_actions:
+            # execute one command at a time, so we don't issue concurrent writes to the BMS
+            async with _action_lock:
+                if topic not in _pending_actions:
+                    break
+                callback, payload, t_received = _pending_actions.pop(topic)
+                t_start = time.time()
+                try:
+                    await callback(payload)
+                except Exception as e:
+                    action_stats['num_errors'] += 1
+                    logger.error('exception in action callback: %s', e)
+                    logger.error('Stack: %s', traceback.format_exc())
+                    await asyncio.sleep(1)
+                else:
+                    action_stats['num_executed'] += 1
+                t_end = time.time()
+
+            action_stats['exec_time_sum'] += t_end - t_start
+            action_stats['exec_time_max'] = max(action_stats['exec_time_max'], t_end - t_start)
+            action_stats['latency_max'] = max(action_stats['latency_max'], t_start - t_received)
+            logger.info('action %s=%s took %.3fs (queued %.3fs)', topic, payload, t_end - t_start,
+                        t_start - t_received)
+    finally:
+        _running_actions.discard(topic)
+
+
+def subscribe_switches(mqtt_client: paho.Client, device_topic, bms: BtBms, switches, on_command=None):
     async def set_switch(switch_name: str, state: bool):
         assert isinstance(state, bool)
         logger.info('Set %s %s switch %s', bms.name, switch_name, state)
+        on_command and on_command()
         await bms.set_switch(switch_name, state)
         topic = f"{device_topic}/switch/{switch_name}"
         mqtt_single_out(mqtt_client, topic, 'ON' if state else 'OFF')
@@ -415,12 +486,33 @@ def subscribe_switches(mqtt_client: paho.Client, device_topic, bms: BtBms, switc
             lambda msg, sn=switch_name: set_switch(sn, msg.lower() == "on")
 
 
+def subscribe_command(mqtt_client: paho.Client, topic: str, callback):
+    """ Subscribe the coroutine function `callback(payload: str)` to a command topic """
+    logger.debug("subscribe %s", topic)
+    mqtt_client.subscribe(topic, qos=2)
+    _switch_callbacks[topic] = callback
+
+
+def unsubscribe_switches(mqtt_client: paho.Client, device_topic):
+    """ Drop the switch subscriptions of a device that is no longer sampled """
+    prefix = f"homeassistant/switch/{device_topic}/"
+    for topic in [t for t in _switch_callbacks if t.startswith(prefix)]:
+        del _switch_callbacks[topic]
+        if hasattr(mqtt_client, 'unsubscribe'):
+            mqtt_client.unsubscribe(topic)
+
+
 def mqtt_message_handler(client, userdata, message: paho.MQTTMessage):
     payload = message.payload.decode("utf-8")
     logger.info("received msg %s: %s", message.topic, payload)
     callback = _switch_callbacks.get(message.topic, None)
     if callback:
-        _message_queue.put((callback, payload))
+        with _early_actions_lock:
+            if _action_loop is None or _action_loop.is_closed():
+                logger.info("No event loop yet, queue %s (payload %s)", message.topic, payload)
+                _early_actions.append((message.topic, callback, payload, time.time()))
+                return
+            _action_loop.call_soon_threadsafe(_enqueue_action, message.topic, callback, payload, time.time())
     else:
         logger.warning("No callback for topic %s (payload %s)", message.topic, payload)
 
@@ -0,0 +1,80 @@
+"""
+Decode benchmark of the BMS frame layouts.
+
+Decodes the frames of the dummy devices (`bmslib.models.dummy`) with the drivers' decoders and prints the time per
+frame. `jk-int.from_bytes` is the per-field slicing decoder the layouts replaced, as reference.
+
+Usage: python tools/bench_decode.py [-n NUMBER]
+
+"""
+import argparse
+import os
+import sys
+import timeit
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+
+def _jk_int_from_bytes(buf):
+    # reference: field-by-field decoding of the 24 cell JK02 frame
+    i16 = lambda i: int.from_bytes(buf[i:(i + 2)], byteorder='little', signed=True)
+    u32 = lambda i: int.from_bytes(buf[i:(i + 4)], byteorder='little', signed=False)
+    temp = lambda x: float('nan') if x == -2000 else (x / 10)
+    return dict(
+        voltage=u32(118) * 1e-3, current=-int.from_bytes(buf[126:130], byteorder='little', signed=True) * 1e-3,
+        soc=buf[141], cycle_capacity=u32(154) * 1e-3, capacity=u32(146) * 1e-3, charge=u32(142) * 1e-3,
+        temperatures=[temp(i16(130)), temp(i16(132))], mos_temperature=i16(134) / 10,
+        balance_current=i16(138) / 1000, num_cycles=u32(150), uptime=float(u32(162)),
+        voltages=[int.from_bytes(buf[(6 + i * 2):(6 + i * 2 + 2)], byteorder='little') for i in range(16)],
+    )
+
+
+def decoders():
+    """
+    :return: dict name -> function decoding a dummy frame
+    """
+    from bmslib.models import jbd, jikong
+    from bmslib.models.dummy import JKDummy
+
+    benches = {}
+
+    for name, is_new_11x in (('jk', False), ('jk11', True)):
+        settings, cell_info = map(bytearray, JKDummy(is_new_11x=is_new_11x).MSGS)
+        bms = jikong.JKBt('bench_' + name, name=name)
+        bms._resp_table[0x01] = settings, 0.
+        bms._resp_table[0x02] = cell_info, 0.
+        bms._is_new_11fw, bms._is_new_11fw_checked = is_new_11x, True  # skip detection (writes the device meta)
+        bms.num_cells = 16
+
+        def decode_jk(bms=bms, buf=cell_info):
+            bms._decode_sample(buf, 0.)
+            jikong.JK02_CELL_VOLTAGES.decode(buf, 6, bms.num_cells).tolist()  # fetch_voltages()
+
+        benches[name] = decode_jk
+
+    jk_frame = bytearray(JKDummy().MSGS[1])
+    benches['jk-int.from_bytes'] = lambda: _jk_int_from_bytes(jk_frame)
+
+    jbd_frame = bytearray.fromhex('dd03001b0a50fda4b717dac000002cf300000000000016540308020b7d0b77f8e277')
+
+    def decode_jbd():
+        d = jbd.JBD_BASIC_INFO.decode(jbd_frame, base=4)
+        [(t - 2731) / 10 for t in jbd.JBD_UINT16.decode(jbd_frame, 4 + 23, d['num_temp'])]
+
+    benches['jbd'] = decode_jbd
+    return benches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    for name, fn in decoders().items():
+        t = min(timeit.repeat(fn, number=args.number, repeat=3)) / args.number
+        print('%-20s %8.2f us/frame' % (name, t * 1e6))
+
+
+if __name__ == '__main__':
+    main()
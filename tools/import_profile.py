@@ -0,0 +1,66 @@
+"""
+Import time profile of the add-on start-up.
+
+Runs `python -X importtime` in a fresh interpreter, importing `main` and the drivers of the given device types, and
+prints the modules with the highest cumulative import time.
+
+Usage: python tools/import_profile.py [--top N] [device_type ...]
+e.g.   python tools/import_profile.py jk daly
+
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+
+def import_times(device_types=(), cwd=None):
+    """
+    Import `main` (and the driver classes of `device_types`) in a fresh interpreter.
+    :return: list of (module, self_us, cumulative_us) in import order
+    """
+    from bmslib.models import bms_registry
+
+    # plain import statements, -X importtime doesn't see importlib.import_module() of the lazy registry
+    code = "import main\n"
+    code += "".join("import %s\n" % bms_registry[t].split(':')[0] for t in device_types)
+    env = dict(os.environ, PYTHONPATH=repo_dir + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    with tempfile.TemporaryDirectory() as tmp:
+        # run in a temp dir with an empty config, so main doesn't pick up a local options.json
+        with open(os.path.join(tmp, 'options.json'), 'w') as f:
+            f.write('{"devices": []}')
+        res = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=cwd or tmp, env=env,
+                             capture_output=True, text=True)
+    if res.returncode != 0:
+        raise RuntimeError("import failed: %s" % res.stderr[-2000:])
+
+    times = []
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cum_us, module = line[len('import time:'):].split('|')
+        times.append((module.strip(), int(self_us), int(cum_us)))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--top', type=int, default=25)
+    parser.add_argument('device_types', nargs='*')
+    args = parser.parse_args()
+
+    times = import_times(args.device_types)
+    total = sum(t[1] for t in times)
+
+    print('%d modules, total import time %.1f ms' % (len(times), total / 1000))
+    print('%10s %10s  %s' % ('self [ms]', 'cum [ms]', 'module'))
+    for module, self_us, cum_us in sorted(times, key=lambda t: t[2], reverse=True)[:args.top]:
+        print('%10.1f %10.1f  %s' % (self_us / 1000, cum_us / 1000, module))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Simulate the add-on with dummy devices on virtual time.
+
+Runs `main.main()` on a virtual clock (see bmslib/sim.py) with dummy devices that have latency and failure profiles,
+so the effect of scheduling and timeout changes can be evaluated without waiting hours on real hardware.
+Reports the achieved sample periods, MQTT publish counts, recovery times and meter drift (integrated charge vs. the
+exact integral of the dummy current).
+
+Usage: python tools/simulate.py [--duration SECONDS] [--concurrent] [--seed N] [--json] [-v]
+e.g.   python tools/simulate.py --duration 86400
+
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from functools import partial
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+
+def scenario(duration: float):
+    """
+    :return: (device confs, profile kwargs by address)
+    """
+    devices = [
+        dict(address='sim-a', type='dummy', alias='d1', adapter='hci0'),
+        dict(address='sim-b', type='dummy', alias='d2', adapter='hci1'),
+        dict(address='sim-c', type='dummy', alias='d3', adapter='hci1'),
+        dict(address='d2,d3', type='group_parallel', alias='g'),
+    ]
+    profiles = {
+        'sim-a': dict(latency=.3, jitter=.1),
+        'sim-b': dict(latency=.5, jitter=.3, failure_rate=.02),
+        # unreachable for 6 minutes in the middle of the run, longer than the watchdog timeout
+        'sim-c': dict(latency=.4, jitter=.1, outages=[(duration / 2, 6 * 60)]),
+    }
+    return devices, profiles
+
+
+def _period_stats(times):
+    dts = sorted(b - a for a, b in zip(times, times[1:]))
+    if not dts:
+        return dict(period_mean=math.nan, period_p50=math.nan, period_p99=math.nan, period_max=math.nan)
+    return dict(period_mean=round(sum(dts) / len(dts), 3), period_p50=round(dts[len(dts) // 2], 3),
+                period_p99=round(dts[min(len(dts) - 1, int(len(dts) * .99))], 3), period_max=round(dts[-1], 3))
+
+
+def simulate(duration=3600., concurrent=False, sample_period=1., seed=1, watchdog=True, options=None):
+    """
+    Must run in a fresh process, `main` reads its config on import.
+    :param options: add-on options overriding the defaults
+    :return: report dict
+    """
+    from bmslib.sim import VirtualClock, VirtualTimeLoop, RecordingMqttClient, patch_time
+
+    random.seed(seed)
+    devices, profiles = scenario(duration)
+    options = dict(devices=devices, sample_period=sample_period, concurrent_sampling=concurrent,
+                   keep_alive=True, watchdog=watchdog, sharded_sampling=False, **(options or {}))
+
+    tmp = tempfile.TemporaryDirectory()
+    os.chdir(tmp.name)
+    with open('options.json', 'w') as f:
+        json.dump(options, f)
+
+    clock = VirtualClock(t0=1.7e9)
+    with patch_time(clock):
+        with contextlib.redirect_stdout(sys.stderr):  # keep stdout clean for --json
+            import main
+        import bmslib.models.dummy as dummy
+        from bmslib.loopmon import LoopMonitor
+        from bmslib.connection import connection_manager
+        from bmslib.recovery import recovery_stats
+
+        t0 = clock.time()
+        for address, kwargs in profiles.items():
+            kwargs = dict(kwargs, outages=[(t0 + ts, dt) for ts, dt in kwargs.get('outages', [])])
+            dummy.dummy_profiles[address] = dummy.DummyProfile(**kwargs)
+
+        mqtt_client = RecordingMqttClient()
+        power_cycles = []
+
+        async def recovery_power_cycle():
+            power_cycles.append(clock.time())
+
+        sys.argv = [sys.argv[0], 'skip-discovery']
+        main.connect_mqtt = lambda on_message: mqtt_client
+        main.recovery_power_cycle = recovery_power_cycle
+        main.exit_process = lambda *args, **kwargs: None
+        # loop lag is meaningless on virtual time, don't spend the simulation on heartbeats
+        main.LoopMonitor = partial(LoopMonitor, interval=60.)
+
+        samplers = []
+        create_samplers = main.create_samplers
+        main.create_samplers = lambda *args, **kwargs: samplers.extend(create_samplers(*args, **kwargs)) or samplers
+
+        loop = VirtualTimeLoop(clock)
+        asyncio.set_event_loop(loop)
+
+        def stop():
+            main.shutdown = True
+            main.bmslib.bt.BtBms.shutdown = True
+
+        loop.call_at(t0 + duration, stop)
+        t_real = time.perf_counter()
+        try:
+            loop.run_until_complete(main.main())
+        finally:
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+        t_real = time.perf_counter() - t_real
+
+    # the simulation ends early if the add-on shuts down (e.g. recovery failed)
+    report = dict(duration=round(clock.time() - t0, 1), real_time=round(t_real, 2), concurrent=concurrent,
+                  publishes_total=sum(mqtt_client.num_published.values()), power_cycles=len(power_cycles),
+                  devices={}, recovery={}, connections=connection_manager.stats())
+    for s in samplers:
+        bms = s.bms
+        dev = dict(samples=s.num_samples, publishes=mqtt_client.count(s.mqtt_topic_prefix + '/'),
+                   freshness_missed=s.num_freshness_missed)
+        profile = getattr(bms, 'profile', None)
+        if profile:
+            times = profile.fetch_times
+            dev.update(_period_stats(times), failures=profile.num_failures)
+            if len(times) > 1:
+                true_charge = bms.true_charge(times[0], times[-1])
+                meter = s.current_integrator.get()
+                dev.update(meter_charge=round(meter, 4), true_charge=round(true_charge, 4),
+                           meter_drift=round(meter - true_charge, 4))
+        if s.t_last_sample:
+            dev['last_sample_age'] = round(clock.time() - s.t_last_sample, 1)
+        ttr = mqtt_client.last_values.get(s.mqtt_topic_prefix + '/stats/time_to_recover')
+        if ttr is not None:
+            dev['last_time_to_recover'] = ttr
+        report['devices'][bms.name] = dev
+    for tier, stats in recovery_stats.items():
+        report['recovery'][tier] = dict(attempts=stats.num_attempts, recovered=stats.num_recovered,
+                                        ttr_mean=round(stats.ttr_sum / stats.num_recovered, 1)
+                                        if stats.num_recovered else None,
+                                        ttr_max=round(stats.ttr_max, 1))
+    tmp.cleanup()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=3600., help='virtual seconds to simulate')
+    parser.add_argument('--concurrent', action='store_true', help='concurrent_sampling')
+    parser.add_argument('--sample-period', type=float, default=1.)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--option', action='append', default=[], metavar='KEY=VALUE',
+                        help='add-on option, e.g. -o connection_slots=1 (JSON values)')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the add-on log')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        # the add-on resets the root logger level, filter at the handler
+        from bmslib.util import get_logger
+        get_logger()
+        for handler in logging.getLogger().handlers:
+            handler.setLevel(logging.CRITICAL)
+
+    options = {}
+    for opt in args.option:
+        key, value = opt.split('=', 1)
+        try:
+            options[key] = json.loads(value)
+        except ValueError:
+            options[key] = value
+
+    report = simulate(args.duration, concurrent=args.concurrent, sample_period=args.sample_period, seed=args.seed,
+                      options=options)
+
+    if args.json:
+        print(json.dumps(report, indent=1))
+        return
+
+    print('simulated %.0fs in %.1fs (%s sampling), %d publishes, %d power cycles' % (
+        report['duration'], report['real_time'], 'concurrent' if report['concurrent'] else 'serial',
+        report['publishes_total'], report['power_cycles']))
+    if report['duration'] < args.duration - 1:
+        print('the add-on shut down before the end of the simulation')
+    for name, dev in report['devices'].items():
+        print('%-4s %s' % (name, ' '.join('%s=%s' % kv for kv in dev.items())))
+    for adapter, stats in report['connections'].items():
+        print('connections %-6s %s' % (adapter, ' '.join('%s=%s' % kv for kv in stats.items())))
+    for tier, stats in report['recovery'].items():
+        print('recovery %-10s %s' % (tier, ' '.join('%s=%s' % kv for kv in stats.items())))
+
+
+if __name__ == "__main__":
+    main()